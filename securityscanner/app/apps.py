@@ -4,3 +4,8 @@ from django.apps import AppConfig
 class AppConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'app'
+
+    def ready(self):
+        # Web and worker processes both load the app, so tracing starts here for both
+        from . import tracing
+        tracing.configure()
@@ -0,0 +1,374 @@
+"""
+Asyncio scan engine.
+
+Runs the same analyzers as ``scan_website_task`` but on non-blocking sockets,
+so a single worker process can keep hundreds of scans in flight. Network I/O
+uses aiohttp, ``asyncio.open_connection`` and the shared async resolver; result
+building, scoring and the checkpoint-and-retry of transiently failed phases
+are shared with the threaded engine in ``tasks.py`` so both produce the same
+scan record. Deep (``tls_deep``) and incremental scans are only run by
+``scan_website_task``.
+"""
+import asyncio
+import contextvars
+import functools
+import os
+import aiohttp
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+from django.conf import settings
+from requests.structures import CaseInsensitiveDict
+from .convex_client import ConvexClient
+from .host_limiter import HostLimiter, target_host
+from .http_fetch import PageFetch
+from . import metrics, resolver, tracing
+from .scan_cache import ScanCache
+from .scan_errors import TRANSIENT, backoff_delay, error_section
+from .single_flight import SingleFlight
+from .tls_cache import get_ssl_context
+from .tasks import (
+    DNS_RECORD_TYPES,
+    PHASE_NAMES,
+    analyze_fingerprinting,
+    analyze_headers,
+    build_dns_result,
+    describe_tls_session,
+    finalize_result,
+    new_tls_result,
+    persist_later,
+    phase_done,
+    phase_progress,
+    resume_result,
+    scoring_sections,
+)
+
+
+async def analyze_tls_async(domain, port=443, context=None):
+    """
+    Analyze TLS/SSL configuration without blocking the event loop. asyncio
+    can't offer a saved session, so unlike ``analyze_tls`` this always does a
+    full handshake.
+    """
+    result = new_tls_result()
+
+    try:
+        if context is None:
+            context = get_ssl_context()
+
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(domain, port), timeout=settings.SCAN_TIMEOUT)
+        try:
+            # Upgrade the open connection so the handshake is timed on its own
+            loop = asyncio.get_running_loop()
+            started = loop.time()
+            await asyncio.wait_for(writer.start_tls(context, server_hostname=domain), timeout=settings.SCAN_TIMEOUT)
+            result['handshake_ms'] = round((loop.time() - started) * 1000, 2)
+            describe_tls_session(result, writer.get_extra_info('ssl_object'), domain, port)
+        finally:
+            writer.close()
+
+    except asyncio.TimeoutError:
+        result.update(error='timed out', error_kind=TRANSIENT)
+    except Exception as e:
+        result.update(error_section(e))
+
+    return result
+
+
+async def analyze_dns_async(domain):
+    """Analyze DNS configuration, resolving all record types concurrently"""
+    answers = await asyncio.gather(*(
+        resolver.lookup_async(domain, record_type) for record_type, _ in DNS_RECORD_TYPES
+    ))
+    return build_dns_result({record_type: answer for (record_type, _), answer in zip(DNS_RECORD_TYPES, answers)})
+
+
+def _joined_headers(raw_headers):
+    """Collapse repeated headers the way requests does, keeping lookups case-insensitive"""
+    headers = CaseInsensitiveDict()
+    for name, value in raw_headers.items():
+        headers[name] = f'{headers[name]}, {value}' if name in headers else value
+    return headers
+
+
+async def fetch_page_async(session, url):
+    """Async counterpart of ``http_fetch.fetch_page`` returning the same page dict"""
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    deadline = started + settings.SCAN_FETCH_DEADLINE
+
+    try:
+        async with session.get(url, allow_redirects=True) as response:
+            metrics.observe_fetch_headers(loop.time() - started)
+            chunks = []
+            size = 0
+            truncated = False
+            try:
+                while size < settings.SCAN_MAX_BODY_BYTES:
+                    chunk = await asyncio.wait_for(
+                        response.content.read(settings.SCAN_MAX_BODY_BYTES - size),
+                        timeout=max(0, deadline - loop.time())
+                    )
+                    if not chunk:
+                        break
+                    chunks.append(chunk)
+                    size += len(chunk)
+                else:
+                    truncated = not response.content.at_eof()
+            except (asyncio.TimeoutError, aiohttp.ClientError):
+                # Deadline reached or connection lost mid-body; keep what arrived
+                truncated = True
+            metrics.observe_body(size, truncated)
+
+            return {
+                'url': str(response.url),
+                'status_code': response.status,
+                'headers': _joined_headers(response.headers),
+                'history': [
+                    {
+                        'url': str(hop.url),
+                        'status_code': hop.status,
+                        'location': hop.headers.get('Location')
+                    }
+                    for hop in response.history
+                ],
+                'cookies': {
+                    name: morsel.value
+                    for hop in [*response.history, response]
+                    for name, morsel in hop.cookies.items()
+                },
+                'body': b''.join(chunks),
+                'body_truncated': truncated
+            }
+    except Exception as e:
+        metrics.observe_fetch_headers(loop.time() - started, e)
+        raise
+
+
+async def _shared_page(session, url):
+    """Fetch the page once and wrap it (or the error) for the header analyzers"""
+    try:
+        with tracing.span('http.fetch', {'http.url': url}):
+            page = await fetch_page_async(session, url)
+        return PageFetch.resolved(url, page=page)
+    except asyncio.TimeoutError:
+        return PageFetch.resolved(url, error=TimeoutError('timed out'))
+    except Exception as e:
+        return PageFetch.resolved(url, error=e)
+
+
+async def run_phases_async(phases, deadline):
+    """
+    Async counterpart of ``tasks.run_phases``.
+
+    ``phases`` maps a phase name to a coroutine. Yields ``(name, result,
+    completed)`` as each phase finishes; phases still pending at the deadline
+    are cancelled and yield a timeout error.
+    """
+    loop = asyncio.get_running_loop()
+
+    async def named(name, coro):
+        started = loop.time()
+        with tracing.span(f'analyze_{name}'):
+            try:
+                phase_result = await coro
+            except Exception as e:
+                phase_result = error_section(e)
+            tracing.record_outcome(phase_result)
+        metrics.observe_phase(name, phase_result, loop.time() - started)
+        return name, phase_result
+
+    end = loop.time() + deadline
+    pending = {asyncio.ensure_future(named(name, coro)) for name, coro in phases.items()}
+    finished = set()
+
+    try:
+        while pending:
+            remaining = end - loop.time()
+            if remaining <= 0:
+                break
+            done, pending = await asyncio.wait(pending, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                name, phase_result = task.result()
+                finished.add(name)
+                yield name, phase_result, len(finished)
+    finally:
+        for task in pending:
+            task.cancel()
+
+    for name in phases:
+        if name not in finished:
+            finished.add(name)
+            phase_result = {'error': f'Scan deadline of {deadline}s exceeded', 'error_kind': TRANSIENT}
+            metrics.observe_phase(name, phase_result, deadline)
+            yield name, phase_result, len(finished)
+
+
+class ScanRun:
+    """
+    What the scans of one ``run_scans`` call share: the HTTP session, the SSL
+    context, the record store and two thread pools. Blocking Redis calls run
+    on a pool sized like the Redis connection pool, and CPU-heavy signature
+    matching on its own small pool, so neither waits behind the other and the
+    event loop never runs either itself.
+    """
+
+    def __init__(self, session, context, convex_client, concurrency):
+        self.session = session
+        self.context = context
+        self.convex_client = convex_client
+        self.single_flight = SingleFlight(convex_client.redis_client)
+        self.io_executor = ThreadPoolExecutor(
+            max_workers=max(1, min(concurrency, settings.REDIS_MAX_CONNECTIONS)), thread_name_prefix='scan-io'
+        )
+        self.cpu_executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix='scan-cpu')
+
+    @staticmethod
+    def _run_in(executor, func, *args, **kwargs):
+        # Like asyncio.to_thread, carry the caller's context (the tracing span) over
+        context = contextvars.copy_context()
+        return asyncio.get_running_loop().run_in_executor(executor, functools.partial(context.run, func, *args, **kwargs))
+
+    def io(self, func, *args, **kwargs):
+        """Await a blocking Redis call"""
+        return self._run_in(self.io_executor, func, *args, **kwargs)
+
+    def cpu(self, func, *args, **kwargs):
+        """Await CPU-bound work"""
+        return self._run_in(self.cpu_executor, func, *args, **kwargs)
+
+    def shutdown(self):
+        self.io_executor.shutdown(wait=False, cancel_futures=True)
+        self.cpu_executor.shutdown(wait=False, cancel_futures=True)
+
+
+async def scan_website_async(job_id, url, run, attempt=0):
+    """
+    Scan one website in its own span; mirrors ``scan_website_task``. Returns
+    the final result, or None when phases failed transiently and should be
+    retried: the record is back in ``queued`` with the finished phases
+    checkpointed, and attempt ``attempt + 1`` reruns only the others.
+    """
+    with tracing.span('scan_website_async', {'scan.job_id': job_id, 'scan.url': url, 'scan.attempt': attempt}):
+        return await _scan_website_async(job_id, url, run, attempt)
+
+
+async def _scan_website_async(job_id, url, run, attempt):
+    convex_client = run.convex_client
+
+    async def update(**fields):
+        await run.io(convex_client.update_scan, job_id, **fields)
+        await run.io(run.single_flight.refresh, url, job_id)
+
+    # Carry over the phases an earlier attempt already finished
+    result = resume_result(await run.io(convex_client.get_scan, job_id) if attempt else None)
+    pending = [name for name in PHASE_NAMES if not phase_done(result[name])]
+    checkpointed = len(PHASE_NAMES) - len(pending)
+
+    await update(status='running', progress=phase_progress(checkpointed, len(PHASE_NAMES)), result=result)
+
+    parsed_url = urlparse(url)
+    domain = parsed_url.hostname
+
+    # Headers and fingerprinting share a single fetch of the page
+    page = asyncio.ensure_future(_shared_page(run.session, url)) if {'headers', 'fingerprinting'} & set(pending) else None
+
+    async def headers_phase():
+        return analyze_headers(url, await page)
+
+    async def fingerprinting_phase():
+        # Signature matching is CPU-bound; the fetch is done, so this only computes
+        return await run.cpu(analyze_fingerprinting, url, await page)
+
+    phases = {
+        'tls': lambda: analyze_tls_async(domain, parsed_url.port or 443, run.context),
+        'headers': headers_phase,
+        'dns': lambda: analyze_dns_async(domain),
+        'fingerprinting': fingerprinting_phase,
+    }
+    phases = {name: phases[name]() for name in pending}
+
+    try:
+        async for name, phase_result, completed in run_phases_async(phases, settings.SCAN_DEADLINE):
+            result[name] = phase_result
+            progress = phase_progress(checkpointed + completed, len(PHASE_NAMES))
+            await update(progress=progress, sections={name: phase_result})
+    finally:
+        if page is not None:
+            page.cancel()
+
+    # Retry phases that failed transiently; the rest stay checkpointed in the record
+    if attempt < settings.SCAN_MAX_RETRIES and not all(phase_done(result[name]) for name in PHASE_NAMES):
+        await run.io(convex_client.update_scan, job_id, status='queued')
+        return None
+
+    final_result = finalize_result(result)
+    await update(status='done', progress=100, sections=scoring_sections(final_result))
+    await run.io(ScanCache(convex_client.redis_client).set, url, final_result)
+    await run.io(run.single_flight.release, url, job_id)
+    await run.io(persist_later, job_id)
+
+    return final_result
+
+
+async def run_scans(jobs, concurrency=None, deep=False, incremental=False):
+    """
+    Run ``[job_id, url]`` scans concurrently, at most ``concurrency`` at a time
+    (ASYNC_SCAN_CONCURRENCY by default). Returns one summary per job.
+
+    Phases that fail transiently are retried with the same backoff and
+    checkpointing as ``scan_website_task``. Deep and incremental scans only
+    run on ``scan_website_task``; asking for them here raises ValueError
+    rather than silently scanning differently.
+    """
+    if deep or incremental:
+        raise ValueError('Deep and incremental scans run on scan_website_task, not the asyncio engine')
+
+    concurrency = concurrency or settings.ASYNC_SCAN_CONCURRENCY
+    semaphore = asyncio.Semaphore(concurrency)
+    convex_client = ConvexClient()
+
+    # The process-wide SSL context and one connection pool for the whole run
+    context = get_ssl_context()
+    timeout = aiohttp.ClientTimeout(sock_connect=settings.SCAN_TIMEOUT, sock_read=settings.SCAN_TIMEOUT)
+    connector = aiohttp.TCPConnector(limit=concurrency, ssl=context)
+
+    host_limiter = HostLimiter(convex_client.redis_client)
+
+    async def run_one(run, job_id, url):
+        host = target_host(url)
+        attempt = 0
+        while True:
+            async with semaphore:
+                wait = await run.io(host_limiter.acquire, host, job_id)
+                if not wait:
+                    try:
+                        final_result = await scan_website_async(job_id, url, run, attempt)
+                        if final_result is not None:
+                            return {'job_id': job_id, 'status': 'completed', 'score': final_result['score']}
+                        wait = backoff_delay(attempt)
+                        attempt += 1
+                    except Exception as e:
+                        error = error_section(e)
+                        if error['error_kind'] == TRANSIENT and attempt < settings.SCAN_MAX_RETRIES:
+                            await run.io(convex_client.update_scan, job_id, status='queued')
+                            wait = backoff_delay(attempt)
+                            attempt += 1
+                        else:
+                            # Keep the sections written so far; only record why the scan stopped
+                            await run.io(convex_client.update_scan, job_id, status='error', sections=error)
+                            await run.io(run.single_flight.release, url, job_id)
+                            await run.io(persist_later, job_id)
+                            return {'job_id': job_id, 'status': 'error', **error}
+                    finally:
+                        await run.io(host_limiter.release, host, job_id)
+            # Host busy or a retry backing off: give the concurrency slot to other scans while waiting
+            await run.io(run.single_flight.refresh, url, job_id)
+            await asyncio.sleep(wait)
+
+    headers = {'User-Agent': settings.SCANNER_USER_AGENT}
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout, headers=headers, cookie_jar=aiohttp.DummyCookieJar()) as session:
+        run = ScanRun(session, context, convex_client, concurrency)
+        try:
+            return await asyncio.gather(*(run_one(run, job_id, url) for job_id, url in jobs))
+        finally:
+            run.shutdown()
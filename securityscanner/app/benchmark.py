@@ -0,0 +1,547 @@
+"""
+Offline benchmark harness for the scan pipeline.
+
+``MockFarm`` starts local stand-ins for everything a scan talks to: an HTTPS
+server with a self-signed certificate authority, whose response latency and
+header set are configurable, and a DNS server answering for the
+``bench.test`` zone. Every ``*.bench.test`` name resolves to the farm. While
+the farm runs, the scanner's resolvers, its shared SSL context and its HTTP
+session are pointed at it, so a benchmark never leaves the machine.
+
+``run_benchmark`` drives ``scan_website_task`` (``mode='task'``, through
+Celery's eager ``apply`` and the configured Redis), or only the analyzer
+phases (``mode='phases'``, no Redis needed). It runs them at a given
+concurrency and reports scans/sec, scan and per-phase latency percentiles,
+Redis commands per scan and the size of a stored scan record in the current
+SCAN_RECORD_CODEC. Incremental runs scan every site once, unmeasured, and
+then measure incremental rescans of them. Used by ``manage.py benchmark_scans``.
+"""
+import hashlib
+import math
+import os
+import random
+import socket
+import socketserver
+import ssl
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+import dns.flags
+import dns.message
+import dns.rcode
+import dns.rdataclass
+import dns.rdatatype
+import dns.rrset
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+from django.conf import settings
+from . import codec, resolver, tasks, tls_cache
+from .host_limiter import HostLimiter
+from .http_fetch import PageFetch
+from .http_session import get_session
+
+ZONE = 'bench.test'
+FARM_ADDRESS = '127.0.0.1'
+
+# Response header sets; a site picks one with its host name (s1-secure.bench.test)
+HEADER_PROFILES = {
+    'secure': {
+        'Server': 'nginx/1.25.3',
+        'Strict-Transport-Security': 'max-age=31536000; includeSubDomains',
+        'Content-Security-Policy': "default-src 'self'",
+        'X-Frame-Options': 'DENY',
+        'X-Content-Type-Options': 'nosniff',
+        'Referrer-Policy': 'no-referrer',
+        'Permissions-Policy': 'camera=()',
+    },
+    'bare': {
+        'Server': 'Apache/2.4.58',
+    },
+    'wordpress': {
+        'Server': 'nginx',
+        'X-Powered-By': 'PHP/8.2.1',
+        'Link': '<https://bench.test/wp-json/>; rel="https://api.w.org/"',
+        'Set-Cookie': 'PHPSESSID=bench; Path=/; Secure; HttpOnly',
+    },
+}
+
+SOA_RECORD = f'ns1.{ZONE}. hostmaster.{ZONE}. 2024010101 3600 600 604800 300'
+
+PAGE_BODY = """<!DOCTYPE html>
+<html><head>
+<meta name="generator" content="WordPress 6.4.2">
+<link rel="stylesheet" href="/wp-content/themes/bench/style.css">
+<script src="/wp-includes/js/jquery/jquery.min.js?ver=3.7.1"></script>
+</head><body>
+{filler}
+</body></html>
+"""
+
+PHASES = ('tls', 'headers', 'dns', 'fingerprinting')
+PHASE_FUNCTIONS = {
+    'tls': 'analyze_tls',
+    'headers': 'analyze_headers',
+    'dns': 'analyze_dns',
+    'fingerprinting': 'analyze_fingerprinting',
+    'tls_deep': 'analyze_tls_deep',
+}
+
+
+def make_certificates(directory):
+    """Write a throwaway CA and a ``*.bench.test`` leaf it signed; returns (ca, cert, key) paths"""
+    now = datetime.utcnow()
+
+    def build(subject, issuer, public_key, signing_key, extensions):
+        builder = (
+            x509.CertificateBuilder()
+            .subject_name(x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, subject)]))
+            .issuer_name(x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, issuer)]))
+            .public_key(public_key)
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(now - timedelta(days=1))
+            .not_valid_after(now + timedelta(days=30))
+        )
+        for extension, critical in extensions:
+            builder = builder.add_extension(extension, critical=critical)
+        return builder.sign(signing_key, hashes.SHA256())
+
+    ca_key = ec.generate_private_key(ec.SECP256R1())
+    ca = build('Bench CA', 'Bench CA', ca_key.public_key(), ca_key, [
+        (x509.BasicConstraints(ca=True, path_length=None), True),
+        (x509.KeyUsage(False, False, False, False, False, True, True, False, False), True),
+    ])
+    key = ec.generate_private_key(ec.SECP256R1())
+    cert = build(f'*.{ZONE}', 'Bench CA', key.public_key(), ca_key, [
+        (x509.SubjectAlternativeName([x509.DNSName(f'*.{ZONE}'), x509.DNSName(ZONE)]), False),
+        (x509.BasicConstraints(ca=False, path_length=None), True),
+    ])
+
+    paths = tuple(os.path.join(directory, name) for name in ('ca.pem', 'cert.pem', 'key.pem'))
+    with open(paths[0], 'wb') as f:
+        f.write(ca.public_bytes(serialization.Encoding.PEM))
+    with open(paths[1], 'wb') as f:
+        f.write(cert.public_bytes(serialization.Encoding.PEM))
+    with open(paths[2], 'wb') as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()))
+    return paths
+
+
+class SiteHandler(BaseHTTPRequestHandler):
+    """Serves every site of the farm; the header profile comes from the Host header"""
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        farm = self.server.farm
+        farm.delay()
+
+        host = (self.headers.get('Host') or '').split(':')[0]
+        profile = next((name for name in HEADER_PROFILES if host.split('.')[0].endswith(f'-{name}')), 'secure')
+        body = farm.body
+
+        # Conditional requests for the unchanged page get a 304, as incremental rescans send
+        if self.headers.get('If-None-Match') == farm.etag:
+            self.send_response(304)
+            self.send_header('ETag', farm.etag)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        for name, value in HEADER_PROFILES[profile].items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('ETag', farm.etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MockHTTPSServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, farm, context):
+        self.farm = farm
+        self.context = context
+        super().__init__((FARM_ADDRESS, 0), SiteHandler)
+
+    def get_request(self):
+        # Handshake on the handler's thread so slow handshakes don't serialize accepts
+        sock, address = self.socket.accept()
+        return self.context.wrap_socket(sock, server_side=True, do_handshake_on_connect=False), address
+
+    def handle_error(self, request, client_address):
+        # Scanners probing ciphers and dropping connections are expected
+        pass
+
+
+class DNSHandler(socketserver.BaseRequestHandler):
+    """
+    Answers A, MX, NS and TXT for the bench zone, and its SOA (in the
+    authority section below the apex); other names are NXDOMAIN
+    """
+
+    def handle(self):
+        data, sock = self.request
+        try:
+            query = dns.message.from_wire(data)
+        except Exception:
+            return
+        response = dns.message.make_response(query)
+        response.flags |= dns.flags.AA
+
+        for question in query.question:
+            name = question.name.to_text().rstrip('.').lower()
+            if name != ZONE and not name.endswith(f'.{ZONE}'):
+                response.set_rcode(dns.rcode.NXDOMAIN)
+                continue
+            records = {
+                dns.rdatatype.A: [FARM_ADDRESS],
+                dns.rdatatype.MX: [f'10 mail.{ZONE}.'],
+                dns.rdatatype.NS: [f'ns1.{ZONE}.'],
+                dns.rdatatype.TXT: ['"v=spf1 -all"'],
+            }.get(question.rdtype)
+            if records:
+                response.answer.append(dns.rrset.from_text(question.name, 300, dns.rdataclass.IN, question.rdtype, *records))
+            elif question.rdtype == dns.rdatatype.SOA:
+                soa = dns.rrset.from_text(f'{ZONE}.', 300, dns.rdataclass.IN, dns.rdatatype.SOA, SOA_RECORD)
+                (response.answer if name == ZONE else response.authority).append(soa)
+
+        sock.sendto(response.to_wire(), self.client_address)
+
+
+class MockDNSServer(socketserver.ThreadingUDPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__((FARM_ADDRESS, 0), DNSHandler)
+
+
+class MockFarm:
+    """
+    Local HTTPS and DNS stand-ins for benchmark targets. Use as a context
+    manager: entering starts the servers and points the scanner at them,
+    leaving restores the scanner's configuration and stops them. Verified
+    handshakes use a separate SSL context trusting the farm's CA, so the
+    process's shared context is never changed.
+    """
+
+    def __init__(self, latency_ms=0, jitter_ms=0, body_bytes=16 * 1024):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        filler = '<p>benchmark page</p>\n' * max(1, body_bytes // 22)
+        self.body = PAGE_BODY.format(filler=filler).encode()
+        self.etag = f'"{hashlib.sha256(self.body).hexdigest()[:16]}"'
+        self._directory = None
+        self._servers = []
+        self._restore = []
+
+    def delay(self):
+        """Sleep for the configured response latency"""
+        latency = self.latency_ms + random.uniform(0, self.jitter_ms)
+        if latency:
+            time.sleep(latency / 1000)
+
+    def url(self, index, profile='secure'):
+        return f'https://s{index}-{profile}.{ZONE}:{self.https_port}/'
+
+    def __enter__(self):
+        self._directory = tempfile.TemporaryDirectory(prefix='scan-bench-')
+        self.ca_path, cert_path, key_path = make_certificates(self._directory.name)
+
+        context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        context.load_cert_chain(cert_path, key_path)
+        https = MockHTTPSServer(self, context)
+        dns_server = MockDNSServer()
+        self.https_port = https.server_address[1]
+        self.dns_port = dns_server.server_address[1]
+        for server in (https, dns_server):
+            threading.Thread(target=server.serve_forever, name='scan-bench-farm', daemon=True).start()
+            self._servers.append(server)
+
+        self._configure_scanner()
+        return self
+
+    def __exit__(self, *exc_info):
+        for restore in reversed(self._restore):
+            restore()
+        for server in self._servers:
+            server.shutdown()
+            server.server_close()
+        self._directory.cleanup()
+
+    def _patch(self, target, name, value):
+        original = getattr(target, name)
+        setattr(target, name, value)
+        self._restore.append(lambda: setattr(target, name, original))
+
+    def _configure_scanner(self):
+        # DNS phase and the HTTP session's resolver query the farm's DNS server
+        for shared in (resolver.get_resolver(), resolver.get_async_resolver()):
+            self._patch(shared, 'nameservers', [FARM_ADDRESS])
+            self._patch(shared, 'port', self.dns_port)
+
+        # Direct socket connections (TLS analysis, aiohttp) resolve bench names the same way
+        getaddrinfo = socket.getaddrinfo
+
+        def bench_getaddrinfo(host, *args, **kwargs):
+            if isinstance(host, str) and (host == ZONE or host.endswith(f'.{ZONE}')):
+                records, error, _ = resolver.lookup(host, 'A')
+                host = records[0] if records else host
+            return getaddrinfo(host, *args, **kwargs)
+
+        self._patch(socket, 'getaddrinfo', bench_getaddrinfo)
+
+        # Trust the farm's CA for verified handshakes and page fetches
+        # (ignoring REQUESTS_CA_BUNDLE and proxy variables, which would override it)
+        context = ssl.create_default_context(cafile=self.ca_path)
+        context.check_hostname = True
+        context.verify_mode = ssl.CERT_REQUIRED
+        self._patch(tls_cache, '_context', context)
+        self._patch(get_session(), 'verify', self.ca_path)
+        self._patch(get_session(), 'trust_env', False)
+
+        # Benchmark scans stay out of the scan history
+        self._patch(settings, 'SCAN_HISTORY', False)
+
+
+def percentiles(samples):
+    """Nearest-rank p50/p95/p99 of ``samples`` in milliseconds"""
+    if not samples:
+        return {'p50': None, 'p95': None, 'p99': None}
+    ordered = sorted(samples)
+
+    def rank(p):
+        return round(ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)], 2)
+
+    return {'p50': rank(50), 'p95': rank(95), 'p99': rank(99)}
+
+
+class PhaseTimer:
+    """Wraps the analyzer functions in ``tasks`` to record per-phase latencies"""
+
+    def __init__(self, names):
+        self.names = names
+        self.samples = {name: [] for name in names}
+        self.errors = {name: 0 for name in names}
+        self._lock = threading.Lock()
+        self._originals = {}
+
+    def _wrap(self, name, function):
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            result = function(*args, **kwargs)
+            elapsed = (time.perf_counter() - started) * 1000
+            with self._lock:
+                self.samples[name].append(elapsed)
+                if isinstance(result, dict) and result.get('error'):
+                    self.errors[name] += 1
+            return result
+        return timed
+
+    def __enter__(self):
+        for name in self.names:
+            attribute = PHASE_FUNCTIONS[name]
+            self._originals[attribute] = getattr(tasks, attribute)
+            setattr(tasks, attribute, self._wrap(name, self._originals[attribute]))
+        return self
+
+    def __exit__(self, *exc_info):
+        for attribute, function in self._originals.items():
+            setattr(tasks, attribute, function)
+
+
+class HostDeferrals:
+    """
+    Makes scans that find their host busy wait out the deferral, as a worker
+    honouring the retry countdown would, instead of the eager task retrying
+    at once. Counts the deferrals and the time spent waiting.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.wait_s = 0.0
+        self._lock = threading.Lock()
+        self._acquire = None
+
+    def __enter__(self):
+        self._acquire = acquire = HostLimiter.acquire
+
+        def acquire_waiting(limiter, host, holder):
+            while True:
+                wait = acquire(limiter, host, holder)
+                if not wait:
+                    return 0
+                with self._lock:
+                    self.count += 1
+                    self.wait_s += wait
+                time.sleep(wait)
+
+        HostLimiter.acquire = acquire_waiting
+        return self
+
+    def __exit__(self, *exc_info):
+        HostLimiter.acquire = self._acquire
+
+
+def redis_command_counts(client):
+    """Calls per command from ``INFO commandstats``"""
+    stats = client.info('commandstats')
+    return {name.replace('cmdstat_', ''): values['calls'] for name, values in stats.items()}
+
+
+def record_size(client, key):
+    """``(payload bytes, Redis memory bytes or None)`` of a stored scan record"""
+    payload = sum(len(field) + len(value) for field, value in client.hgetall(key).items())
+    try:
+        memory = client.memory_usage(key, samples=0)
+    except Exception:
+        # Not every Redis stand-in implements MEMORY USAGE
+        memory = None
+    return payload, memory
+
+
+def _run_task_scan(url, deep, incremental=False):
+    """Returns the scan's status and its job id"""
+    from .convex_client import ConvexClient
+
+    job_id = f'bench-{uuid.uuid4()}'
+    ConvexClient().create_scan(job_id, url)
+    kwargs = {'deep': deep, 'incremental': incremental}
+    outcome = tasks.scan_website_task.apply(args=(job_id, url), kwargs=kwargs).get(propagate=False)
+    return outcome.get('status') if isinstance(outcome, dict) else 'error', job_id
+
+
+def _run_phase_scan(url, deep, incremental=False):
+    """Returns the scan's status and the payload bytes its result fields would be stored in"""
+    from .convex_client import ConvexClient
+
+    parsed = urlparse(url)
+    domain, port = parsed.hostname, parsed.port or 443
+    page = PageFetch(url)
+    phases = {
+        'tls': (tasks.analyze_tls, (domain, port)),
+        'headers': (tasks.analyze_headers, (url, page)),
+        'dns': (tasks.analyze_dns, (domain,)),
+        'fingerprinting': (tasks.analyze_fingerprinting, (url, page)),
+    }
+    if deep:
+        phases['tls_deep'] = (tasks.analyze_tls_deep, (domain, port))
+    try:
+        workers = len(phases) if deep else None
+        results = {name: result for name, result, _ in tasks.run_phases(phases, settings.SCAN_DEADLINE, workers)}
+    finally:
+        page.close()
+    status = 'error' if any(result.get('error') for result in results.values()) else 'completed'
+    return status, sum(len(field) + len(value) for field, value in ConvexClient._result_fields(results).items())
+
+
+def run_benchmark(farm, scans=100, concurrency=10, mode='task', deep=False, profiles=tuple(HEADER_PROFILES), hosts=0,
+                  incremental=False):
+    """
+    Run ``scans`` scans against ``farm``, ``concurrency`` at a time, and
+    return the report. Each scan targets its own host unless ``hosts`` caps
+    the number of distinct hosts; in task mode, reusing hosts makes the
+    per-host limiter defer scans. Deferred scans wait for their host and
+    are counted under ``host_deferrals``, not as scan errors.
+    ``incremental`` (task mode only) measures incremental rescans of sites
+    scanned once beforehand.
+    """
+    names = PHASES + ('tls_deep',) if deep else PHASES
+    run_scan = _run_task_scan if mode == 'task' else _run_phase_scan
+    urls = [farm.url(index % hosts if hosts else index, profiles[index % len(profiles)]) for index in range(scans)]
+
+    if incremental:
+        # Leave a baseline for every site; these scans aren't measured
+        with HostDeferrals(), ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='scan-bench') as executor:
+            list(executor.map(lambda url: run_scan(url, deep, True), dict.fromkeys(urls)))
+
+    redis_client = None
+    if mode == 'task':
+        from .redis_pool import get_redis
+        redis_client = get_redis()
+        before = redis_command_counts(redis_client)
+
+    latencies = []
+    statuses = {}
+    records = []
+    lock = threading.Lock()
+
+    def timed_scan(url):
+        started = time.perf_counter()
+        try:
+            status, record = run_scan(url, deep, incremental)
+        except Exception as e:
+            status, record = f'exception: {type(e).__name__}', None
+        elapsed = (time.perf_counter() - started) * 1000
+        with lock:
+            latencies.append(elapsed)
+            statuses[status] = statuses.get(status, 0) + 1
+            if record is not None:
+                records.append(record)
+
+    with PhaseTimer(names) as timer, HostDeferrals() as deferrals:
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='scan-bench') as executor:
+            list(executor.map(timed_scan, urls))
+        elapsed = time.perf_counter() - started
+
+    report = {
+        'mode': mode,
+        'scans': scans,
+        'concurrency': concurrency,
+        'deep': deep,
+        'incremental': incremental,
+        'latency_ms': farm.latency_ms,
+        'elapsed_s': round(elapsed, 3),
+        'scans_per_sec': round(scans / elapsed, 2) if elapsed else None,
+        'statuses': statuses,
+        'scan_ms': percentiles(latencies),
+        'phases': {
+            name: {**percentiles(timer.samples[name]), 'errors': timer.errors[name]}
+            for name in names
+        },
+        'redis_ops_per_scan': None,
+        'redis_commands': None,
+        'record_codec': codec.current_format(),
+        'record_bytes': None,
+        'record_memory': None,
+        'reused_per_scan': None,
+        'host_deferrals': {'count': deferrals.count, 'wait_s': round(deferrals.wait_s, 3)},
+    }
+
+    if redis_client is not None:
+        after = redis_command_counts(redis_client)
+        # The two INFO calls are the harness's own
+        delta = {name: calls - before.get(name, 0) for name, calls in after.items() if name != 'info'}
+        delta = {name: calls for name, calls in delta.items() if calls}
+        report['redis_ops_per_scan'] = round(sum(delta.values()) / scans, 2)
+        report['redis_commands'] = {name: round(calls / scans, 2) for name, calls in sorted(delta.items(), key=lambda item: -item[1])}
+
+        # Measured after the command counts, so they don't include these reads
+        if incremental:
+            from .convex_client import ConvexClient
+            convex_client = ConvexClient()
+            reused = [
+                len(((convex_client.get_scan(job_id) or {}).get('result') or {}).get('rescan', {}).get('reused', []))
+                for job_id in records
+            ]
+            report['reused_per_scan'] = round(sum(reused) / len(reused), 2) if reused else None
+        sizes = [record_size(redis_client, f'scan:{job_id}') for job_id in records]
+        records = [payload for payload, _ in sizes]
+        memory = [usage for _, usage in sizes if usage is not None]
+        if memory:
+            report['record_memory'] = round(sum(memory) / len(memory))
+
+    if records:
+        report['record_bytes'] = round(sum(records) / len(records))
+
+    return report
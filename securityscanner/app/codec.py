@@ -0,0 +1,113 @@
+"""
+Storage codec for scan record values.
+
+Each top-level section of a scan result is stored as its own hash field (see
+``convex_client.py``), and finished results are cached whole
+(``scan_cache.py``). SCAN_RECORD_CODEC selects how new values are encoded:
+
+- ``json``: plain JSON, the original format;
+- ``msgpack``: MessagePack;
+- ``zstd``: JSON compressed with Zstandard at SCAN_RECORD_ZSTD_LEVEL.
+
+Values in the ``msgpack`` and ``zstd`` formats start with a two-byte header:
+a NUL byte, which never starts a JSON document, and the format version.
+Values without it are read as JSON. That way records written before the
+codec existed, or while it was set to ``json``, stay readable whatever the
+current setting. Under ``zstd``, values whose JSON is shorter than
+SCAN_RECORD_COMPRESS_MIN bytes are kept as plain JSON, because the frame
+overhead would outweigh the saving.
+
+msgpack and zstandard are optional. If the configured codec's library is
+missing, values are written as JSON with a warning.
+"""
+import json
+import threading
+from django.conf import settings
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MAGIC = b'\x00'
+
+# Format version byte following MAGIC
+MSGPACK = 1
+ZSTD_JSON = 2
+
+FORMATS = {MSGPACK: 'msgpack', ZSTD_JSON: 'zstd'}
+
+_local = threading.local()
+_warned = set()
+
+
+def _available(name):
+    library = {'msgpack': msgpack, 'zstd': zstandard}.get(name)
+    if name == 'json' or library is not None:
+        return True
+    if name not in _warned:
+        _warned.add(name)
+        print(f"Codec warning: SCAN_RECORD_CODEC={name!r} is unavailable, writing JSON")
+    return False
+
+
+def current_format():
+    """The format new values are written in"""
+    name = settings.SCAN_RECORD_CODEC
+    return name if name in ('msgpack', 'zstd') and _available(name) else 'json'
+
+
+def _compressor():
+    # zstandard compressors and decompressors must not be shared between threads
+    if getattr(_local, 'compressor', None) is None:
+        _local.compressor = zstandard.ZstdCompressor(level=settings.SCAN_RECORD_ZSTD_LEVEL)
+        _local.decompressor = zstandard.ZstdDecompressor()
+    return _local.compressor
+
+
+def _decompressor():
+    _compressor()
+    return _local.decompressor
+
+
+def encode(value, json_text=None):
+    """
+    Encode ``value`` in the current format. ``json_text`` is its JSON
+    encoding if the caller already has it, saving a second ``json.dumps``.
+    """
+    name = current_format()
+    if name == 'msgpack':
+        return MAGIC + bytes([MSGPACK]) + msgpack.packb(value, use_bin_type=True)
+
+    text = json_text if json_text is not None else json.dumps(value)
+    if name == 'zstd' and len(text) >= settings.SCAN_RECORD_COMPRESS_MIN:
+        return MAGIC + bytes([ZSTD_JSON]) + _compressor().compress(text.encode())
+    return text
+
+
+def format_of(data):
+    """Format a stored value was written in: ``json``, ``msgpack`` or ``zstd``"""
+    if isinstance(data, bytes) and data[:1] == MAGIC:
+        return FORMATS.get(data[1], 'unknown')
+    return 'json'
+
+
+def decode(data):
+    """Decode a stored value in any format"""
+    name = format_of(data)
+    if name == 'json':
+        return json.loads(data)
+    if name == 'msgpack':
+        if msgpack is None:
+            raise RuntimeError('msgpack is required to read this record')
+        return msgpack.unpackb(data[2:], raw=False, strict_map_key=False)
+    if name == 'zstd':
+        if zstandard is None:
+            raise RuntimeError('zstandard is required to read this record')
+        return json.loads(_decompressor().decompress(data[2:]))
+    raise ValueError(f'Unknown record format {data[1]}')
@@ -0,0 +1,379 @@
+"""
+Signature-driven technology fingerprinting.
+
+Signatures use the Wappalyzer ``technologies.json`` format and are matched
+against response headers, cookies, ``<meta>`` tags, script URLs, the page
+URL and the HTML body. The database (FINGERPRINT_SIGNATURES) is compiled
+once per worker process. The file's modification time is checked every
+FINGERPRINT_RELOAD_INTERVAL seconds and a changed file is recompiled in
+place; a file that fails to load leaves the previous index in use.
+
+Body and URL signatures are indexed by a keyword: a whole word that every
+match of the signature must contain. Matching a page tokenizes it into words
+in one pass and runs only the signatures whose keyword occurs, plus the few
+with no usable keyword, so the cost of a page grows with what it contains
+rather than with the size of the database. (Python's ``re`` doesn't optimise
+a single alternation of thousands of patterns; it is slower than running
+them one by one.)
+"""
+import json
+import os
+import re
+import threading
+import time
+from collections import namedtuple
+from django.conf import settings
+
+_lock = threading.Lock()
+_index = None
+_mtime = None
+_checked = 0.0
+
+# Fields matched against one text each, and fields keyed by a header, cookie or meta name
+LIST_FIELDS = ('html', 'scriptSrc', 'url')
+KEYED_FIELDS = ('headers', 'cookies', 'meta')
+
+META_TAG = re.compile(r'<meta\s[^>]*>', re.I)
+META_ATTRIBUTE = re.compile(r'''([\w:-]+)\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'>]+))''')
+SCRIPT_SRC = re.compile(r'''<script\b[^>]*?\ssrc\s*=\s*["']?([^"'\s>]+)''', re.I)
+
+WORD = re.compile(r'\w+')
+
+Signature = namedtuple('Signature', 'technology regex pattern version confidence')
+
+
+def parse_pattern(technology, value):
+    """A Signature from a Wappalyzer pattern with optional ``\\;version:`` and ``\\;confidence:`` tags"""
+    regex, *tags = str(value).split('\\;')
+    version = None
+    confidence = 100
+    for tag in tags:
+        key, _, tag_value = tag.partition(':')
+        if key == 'version':
+            version = tag_value
+        elif key == 'confidence' and tag_value.isdigit():
+            confidence = int(tag_value)
+
+    # Wappalyzer patterns are case-insensitive JavaScript regexes
+    if regex.startswith('(?i)'):
+        regex = regex[4:]
+    return Signature(technology, regex, re.compile(regex, re.I), version, confidence)
+
+
+def _class_end(regex, i):
+    """Index just past the ``[...]`` character class opening at ``regex[i]``"""
+    i += 1
+    if regex[i:i + 1] == '^':
+        i += 1
+    if regex[i:i + 1] == ']':
+        i += 1  # a leading ']' is literal
+    while i < len(regex) and regex[i] != ']':
+        i += 2 if regex[i] == '\\' else 1
+    return i + 1
+
+
+def _group_end(regex, i):
+    """Index just past the group opening at ``regex[i]``"""
+    depth = 0
+    while i < len(regex):
+        char = regex[i]
+        if char == '\\':
+            i += 2
+            continue
+        if char == '[':
+            i = _class_end(regex, i)
+            continue
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+            if depth == 0:
+                return i + 1
+        i += 1
+    return len(regex)
+
+
+def _class_has_word(body):
+    """Whether a ``[...]`` character class body can match a word character"""
+    if body.startswith('^'):
+        return True
+    i = 0
+    while i < len(body):
+        char = body[i]
+        if char == '\\':
+            escaped = body[i + 1:i + 2]
+            if escaped and escaped.isalnum() and escaped not in 'sW':
+                return True
+            i += 2
+            continue
+        if char.isalnum() or char == '_':
+            return True
+        i += 1
+    return False
+
+
+def _atoms(regex):
+    """
+    Top-level atoms of ``regex`` as ``(literal, wordlike)`` pairs: ``literal``
+    is the lowercased character the atom always matches exactly once (None
+    otherwise) and ``wordlike`` whether it can match a word character. None
+    if the pattern has a top-level alternation.
+    """
+    atoms = []
+    i = 0
+    while i < len(regex):
+        char = regex[i]
+        if char == '|':
+            return None
+        if char == '(':
+            end = _group_end(regex, i)
+            atom = (None, True)
+        elif char == '[':
+            end = _class_end(regex, i)
+            atom = (None, _class_has_word(regex[i + 1:end - 1]))
+        elif char == '\\':
+            escaped = regex[i + 1:i + 2]
+            end = i + 2 + {'x': 2, 'u': 4, 'U': 8}.get(escaped, 0)
+            if escaped in ('s', 'W', 'b'):
+                atom = (None, False)
+            elif escaped.isalnum():
+                atom = (None, True)
+            else:
+                atom = (escaped, False)
+        elif char in '^$':
+            end = i + 1
+            atom = (None, False)
+        elif char == '.':
+            end = i + 1
+            atom = (None, True)
+        else:
+            end = i + 1
+            atom = (char.lower(), char.isalnum() or char == '_')
+
+        # A quantified atom is no longer a single required character
+        if regex[end:end + 1] in ('?', '*', '+', '{'):
+            atom = (None, atom[1])
+            end = regex.find('}', end) + 1 or len(regex) if regex[end] == '{' else end + 1
+            if regex[end:end + 1] in ('?', '+'):
+                end += 1
+        atoms.append(atom)
+        i = end
+    return atoms
+
+
+def required_keyword(regex):
+    """
+    Longest whole word every match of ``regex`` contains, or None. A word at
+    the edge of a literal run only counts if the pattern can't extend it with
+    more word characters there.
+    """
+    atoms = _atoms(regex)
+    if not atoms:
+        return None
+
+    best = None
+    i = 0
+    while i < len(atoms):
+        if atoms[i][0] is None:
+            i += 1
+            continue
+        start = i
+        while i < len(atoms) and atoms[i][0] is not None:
+            i += 1
+        run = ''.join(literal for literal, _ in atoms[start:i])
+        open_left = start == 0 or atoms[start - 1][1]
+        open_right = i == len(atoms) or atoms[i][1]
+        for word in WORD.finditer(run):
+            if (word.start() == 0 and open_left) or (word.end() == len(run) and open_right):
+                continue
+            if best is None or len(word.group()) > len(best):
+                best = word.group()
+    return best
+
+
+def resolve_version(template, match):
+    """Fill a ``\\1``-style version template from ``match``, including the ``\\1?a:b`` ternary"""
+    if not template:
+        return None
+
+    def group(ref):
+        index = int(ref.group(1))
+        return (match.group(index) or '') if index <= (match.re.groups or 0) else ''
+
+    ternary = re.fullmatch(r'(.*?)\?(.*):(.*)', template)
+    if ternary:
+        condition, when_true, when_false = ternary.groups()
+        template = when_true if re.sub(r'\\(\d+)', group, condition) else when_false
+    return re.sub(r'\\(\d+)', group, template).strip() or None
+
+
+class PatternIndex:
+    """Signatures for one field, optionally indexed by their required keyword"""
+
+    def __init__(self, signatures, keywords=False):
+        self.signatures = signatures
+        self.by_keyword = {}
+        self.unkeyed = []
+        for signature in signatures:
+            keyword = required_keyword(signature.regex) if keywords else None
+            if keyword is None:
+                self.unkeyed.append(signature)
+            else:
+                self.by_keyword.setdefault(keyword, []).append(signature)
+
+    def __len__(self):
+        return len(self.signatures)
+
+    def search(self, text):
+        """``{signature: first match}`` for every signature matching ``text``"""
+        if not text:
+            return {}
+
+        candidates = list(self.unkeyed)
+        if self.by_keyword:
+            for keyword in self.by_keyword.keys() & set(WORD.findall(text.lower())):
+                candidates.extend(self.by_keyword[keyword])
+
+        matches = {}
+        for signature in candidates:
+            match = signature.pattern.search(text)
+            if match:
+                matches[signature] = match
+        return matches
+
+
+class SignatureIndex:
+    """A compiled signature database"""
+
+    def __init__(self, database):
+        self.categories = {
+            int(key): category.get('name', key)
+            for key, category in database.get('categories', {}).items()
+            if str(key).isdigit()
+        }
+        self.technologies = database.get('technologies', database)
+
+        lists = {field: [] for field in LIST_FIELDS}
+        keyed = {field: {} for field in KEYED_FIELDS}
+        for name, technology in self.technologies.items():
+            for field in LIST_FIELDS:
+                values = technology.get(field) or []
+                for value in [values] if isinstance(values, str) else values:
+                    self._add(lists[field], name, value)
+            for field in KEYED_FIELDS:
+                for key, values in (technology.get(field) or {}).items():
+                    for value in values if isinstance(values, list) else [values]:
+                        self._add(keyed[field].setdefault(key.lower(), []), name, value)
+
+        self.fields = {field: PatternIndex(signatures, keywords=True) for field, signatures in lists.items()}
+        self.keyed = {
+            field: {key: PatternIndex(signatures) for key, signatures in by_key.items()}
+            for field, by_key in keyed.items()
+        }
+        self.needs_body = bool(len(self.fields['html']) or len(self.fields['scriptSrc']) or self.keyed['meta'])
+
+    @staticmethod
+    def _add(signatures, name, value):
+        try:
+            signatures.append(parse_pattern(name, value))
+        except re.error as e:
+            print(f"Fingerprint signature error ({name}): {e}")
+
+    def __len__(self):
+        return len(self.technologies)
+
+    def detect(self, page):
+        """
+        Technologies detected on a fetched page: ``name``, ``categories``,
+        ``version`` and ``confidence``, including those implied by others.
+        """
+        matches = []
+        headers = page.get('headers') or {}
+        for key, index in self.keyed['headers'].items():
+            if key in headers:
+                matches.extend(index.search(headers[key]).items())
+        cookies = {name.lower(): value for name, value in (page.get('cookies') or {}).items()}
+        for key, index in self.keyed['cookies'].items():
+            if key in cookies:
+                # An empty pattern only requires the cookie to be set
+                matches.extend(index.search(cookies[key] or ' ').items())
+        matches.extend(self.fields['url'].search(page.get('url') or '').items())
+
+        body = page.get('body')
+        if body:
+            html = body.decode('utf-8', errors='replace') if isinstance(body, bytes) else body
+            matches.extend(self.fields['html'].search(html).items())
+            matches.extend(self.fields['scriptSrc'].search('\n'.join(SCRIPT_SRC.findall(html))).items())
+            for name, content in meta_tags(html).items():
+                index = self.keyed['meta'].get(name)
+                if index is not None:
+                    matches.extend(index.search(content).items())
+
+        detected = {}
+        for signature, match in matches:
+            entry = detected.setdefault(signature.technology, {'version': None, 'confidence': 0})
+            entry['confidence'] = min(100, entry['confidence'] + signature.confidence)
+            entry['version'] = entry['version'] or resolve_version(signature.version, match)
+        self._add_implied(detected)
+
+        return [
+            {
+                'name': name,
+                'categories': [self.categories.get(category, category) for category in self.technologies[name].get('cats', [])],
+                'version': entry['version'],
+                'confidence': entry['confidence'],
+            }
+            for name, entry in sorted(detected.items())
+        ]
+
+    def _add_implied(self, detected):
+        pending = list(detected)
+        while pending:
+            implies = self.technologies[pending.pop()].get('implies') or []
+            for value in [implies] if isinstance(implies, str) else implies:
+                name, *tags = value.split('\\;')
+                if name in self.technologies and name not in detected:
+                    confidence = next((int(tag[11:]) for tag in tags if tag.startswith('confidence:') and tag[11:].isdigit()), 100)
+                    detected[name] = {'version': None, 'confidence': confidence}
+                    pending.append(name)
+
+
+def meta_tags(html):
+    """``{name: content}`` of the page's ``<meta>`` tags, keyed by name, property or http-equiv"""
+    tags = {}
+    for tag in META_TAG.findall(html):
+        attributes = {
+            match.group(1).lower(): next(value for value in match.groups()[1:] if value is not None)
+            for match in META_ATTRIBUTE.finditer(tag)
+        }
+        name = attributes.get('name') or attributes.get('property') or attributes.get('http-equiv')
+        if name and 'content' in attributes:
+            tags.setdefault(name.lower(), attributes['content'])
+    return tags
+
+
+def load_index(path):
+    with open(path, encoding='utf-8') as f:
+        return SignatureIndex(json.load(f))
+
+
+def get_index():
+    """The process's compiled signature index, recompiled when the database file changes"""
+    global _index, _mtime, _checked
+    with _lock:
+        now = time.monotonic()
+        if _index is not None and now - _checked < settings.FINGERPRINT_RELOAD_INTERVAL:
+            return _index
+        _checked = now
+
+        path = settings.FINGERPRINT_SIGNATURES
+        try:
+            mtime = os.stat(path).st_mtime_ns
+            if _index is None or mtime != _mtime:
+                _index = load_index(path)
+                _mtime = mtime
+        except (OSError, ValueError) as e:
+            print(f"Fingerprint signatures error: {e}")
+            if _index is None:
+                _index = SignatureIndex({})
+        return _index
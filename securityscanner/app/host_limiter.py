@@ -0,0 +1,103 @@
+"""
+Per-target-host concurrency cap and politeness spacing.
+
+A batch with many URLs on one domain would otherwise open TLS, HTTP and DNS
+connections to that host from every worker at once, and some targets answer by
+throttling us. Each host gets at most SCAN_HOST_CONCURRENCY scans in flight
+across all workers, and scan starts on a host are at least
+SCAN_HOST_SPACING_MS apart.
+
+Slots are members of the sorted set ``host_slots:{host}`` scored by their
+lease expiry, so a slot held by a worker that died is reclaimed once
+SCAN_HOST_SLOT_TTL lapses. ``host_next:{host}`` holds the earliest time the
+next scan may start. Acquiring is one Lua call; callers that don't get a slot
+are told how long to wait and are expected to defer, not block.
+"""
+import random
+from urllib.parse import urlparse
+from django.conf import settings
+
+# KEYS[1] = slots, KEYS[2] = next start; ARGV = holder, limit, lease (ms), spacing (ms).
+# Returns 0 once the slot is held, -1 when the host is at capacity, or the
+# milliseconds left until the spacing allows the next start.
+ACQUIRE_SCRIPT = """
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) * 1000 + math.floor(tonumber(clock[2]) / 1000)
+local limit = tonumber(ARGV[2])
+local lease = tonumber(ARGV[3])
+local spacing = tonumber(ARGV[4])
+
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+if redis.call('ZSCORE', KEYS[1], ARGV[1]) then
+    redis.call('ZADD', KEYS[1], now + lease, ARGV[1])
+    return 0
+end
+if redis.call('ZCARD', KEYS[1]) >= limit then
+    return -1
+end
+
+local next_start = tonumber(redis.call('GET', KEYS[2]) or '0')
+if now < next_start then
+    return next_start - now
+end
+
+redis.call('ZADD', KEYS[1], now + lease, ARGV[1])
+redis.call('PEXPIRE', KEYS[1], lease)
+if spacing > 0 then
+    redis.call('SET', KEYS[2], now + spacing, 'PX', spacing)
+end
+return 0
+"""
+
+
+def target_host(url):
+    """Host whose connections a scan of ``url`` opens"""
+    return (urlparse(url).hostname or '').rstrip('.')
+
+
+class HostLimiter:
+    """Redis-backed per-host scan slots shared by every worker"""
+
+    def __init__(self, redis_client):
+        self.redis_client = redis_client
+        self.limit = settings.SCAN_HOST_CONCURRENCY
+        self.lease_ms = settings.SCAN_HOST_SLOT_TTL * 1000
+        self.spacing_ms = settings.SCAN_HOST_SPACING_MS
+        self._acquire = redis_client.register_script(ACQUIRE_SCRIPT)
+
+    def acquire(self, host, holder):
+        """
+        Take a scan slot on ``host`` for ``holder`` (a job_id).
+
+        Returns 0 when the slot is held, otherwise the seconds to wait before
+        trying again. A full host is retried after SCAN_HOST_DEFER_SECONDS
+        with jitter so deferred scans don't all come back at once.
+        """
+        if self.limit <= 0:
+            return 0
+
+        try:
+            wait_ms = self._acquire(
+                keys=[f'host_slots:{host}', f'host_next:{host}'],
+                args=[holder, self.limit, self.lease_ms, self.spacing_ms]
+            )
+        except Exception as e:
+            # If Redis is down, continue without per-host limits
+            print(f"Redis error: {e}")
+            return 0
+
+        if wait_ms == 0:
+            return 0
+        if wait_ms < 0:
+            return max(settings.SCAN_HOST_DEFER_SECONDS, 0.1) * random.uniform(1, 2)
+        return wait_ms / 1000 + random.uniform(0, self.spacing_ms / 1000)
+
+    def release(self, host, holder):
+        """Give back ``holder``'s slot on ``host``"""
+        if self.limit <= 0:
+            return
+
+        try:
+            self.redis_client.zrem(f'host_slots:{host}', holder)
+        except Exception as e:
+            print(f"Redis error: {e}")
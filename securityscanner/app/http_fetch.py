@@ -0,0 +1,186 @@
+import threading
+import time
+from django.conf import settings
+from . import metrics, tracing
+from .http_session import FetchWatch, get_session, watching
+
+# Bytes read from the body per iteration
+BODY_CHUNK_SIZE = 16 * 1024
+
+
+def _headers_timeout():
+    return TimeoutError(f'Page fetch deadline of {settings.SCAN_FETCH_DEADLINE}s exceeded before the headers arrived')
+
+
+def open_page(url, headers=None, deadline=None):
+    """
+    Request a URL with a streamed body and return as soon as the final
+    response's headers have arrived: final URL, status, headers and redirect
+    history, plus the open response for ``read_body``. ``headers`` are sent
+    on top of the session's, e.g. conditional request headers.
+
+    Connecting, redirects and the headers must all arrive by ``deadline`` (a
+    ``time.monotonic()`` value, SCAN_FETCH_DEADLINE from now by default);
+    the request's sockets are shut down when it passes.
+    """
+    if deadline is None:
+        deadline = time.monotonic() + settings.SCAN_FETCH_DEADLINE
+
+    with tracing.span('http.fetch', {'http.url': url}):
+        started = time.monotonic()
+        watch = FetchWatch()
+        watchdog = threading.Timer(max(0, deadline - started), watch.expire)
+        watchdog.daemon = True
+        watchdog.start()
+        try:
+            with watching(watch):
+                response = get_session().get(url, headers=headers, timeout=settings.SCAN_TIMEOUT, allow_redirects=True, stream=True)
+            watchdog.cancel()
+            if watch.expired:
+                # A response cut short at the deadline can still parse
+                response.close()
+                raise _headers_timeout()
+        except Exception as e:
+            if watch.expired and not isinstance(e, TimeoutError):
+                e = _headers_timeout()
+            metrics.observe_fetch_headers(time.monotonic() - started, e)
+            raise e
+        finally:
+            watchdog.cancel()
+        metrics.observe_fetch_headers(time.monotonic() - started)
+        tracing.annotate({'http.status_code': response.status_code, 'http.redirects': len(response.history)})
+
+    page = {
+        'url': response.url,
+        'status_code': response.status_code,
+        'headers': response.headers,
+        'history': [
+            {
+                'url': hop.url,
+                'status_code': hop.status_code,
+                'location': hop.headers.get('Location')
+            }
+            for hop in response.history
+        ],
+        # Cookies set anywhere along the redirect chain (the session itself keeps none)
+        'cookies': {
+            cookie.name: cookie.value
+            for hop in [*response.history, response]
+            for cookie in hop.cookies
+        }
+    }
+    return page, response
+
+
+@tracing.traced('http.read_body')
+def read_body(response, deadline):
+    """
+    Read at most SCAN_MAX_BODY_BYTES of the body, stopping at ``deadline``
+    (a ``time.monotonic()`` value) however slowly the server sends it.
+    Returns ``(body, truncated)`` and always closes the response.
+    """
+    chunks = []
+    size = 0
+    truncated = False
+
+    # Shutting the connection's socket down from another thread ends a read
+    # still running at the deadline. Only this response's connection is
+    # watched: earlier redirect hops went back to the pool for other fetches.
+    watch = FetchWatch()
+    connection = response.raw.connection
+    if connection is not None and connection.sock is not None:
+        watch.add(connection.sock)
+    watchdog = threading.Timer(max(0, deadline - time.monotonic()), watch.expire)
+    watchdog.daemon = True
+    watchdog.start()
+    try:
+        for chunk in response.iter_content(chunk_size=BODY_CHUNK_SIZE):
+            chunks.append(chunk)
+            size += len(chunk)
+            if size >= settings.SCAN_MAX_BODY_BYTES:
+                truncated = True
+                break
+    except Exception:
+        # Deadline reached or connection lost mid-body; keep what arrived
+        truncated = True
+    finally:
+        watchdog.cancel()
+        response.close()
+
+    body = b''.join(chunks)[:settings.SCAN_MAX_BODY_BYTES]
+    truncated = truncated or watch.expired
+    metrics.observe_body(len(body), truncated)
+    tracing.annotate({'http.body_bytes': len(body), 'http.body_truncated': truncated})
+    return body, truncated
+
+
+def fetch_page(url):
+    """
+    Fetch a URL once and keep what the analyzers need from the response:
+    final URL, status, headers, redirect history and a capped body.
+    """
+    deadline = time.monotonic() + settings.SCAN_FETCH_DEADLINE
+    page, response = open_page(url, deadline=deadline)
+    page['body'], page['body_truncated'] = read_body(response, deadline)
+    return page
+
+
+class PageFetch:
+    """
+    Lazily fetched page shared by the analyzers of one scan.
+
+    The first caller of ``head()`` or ``get()`` performs the request;
+    concurrent callers wait for it and reuse the stored response (or its
+    error). ``head()`` returns once the headers have arrived, so header-only
+    analyzers never wait for the body; ``get()`` also reads the capped body,
+    within SCAN_FETCH_DEADLINE of the request starting. ``headers`` are
+    extra request headers.
+    """
+
+    def __init__(self, url, headers=None):
+        self.url = url
+        self.headers = headers
+        self._lock = threading.Lock()
+        self._body_lock = threading.Lock()
+        self._page = None
+        self._error = None
+        self._response = None
+        self._deadline = None
+
+    @classmethod
+    def resolved(cls, url, page=None, error=None):
+        """Wrap a page (or fetch error) obtained elsewhere, e.g. by the async engine"""
+        fetch = cls(url)
+        fetch._page = page
+        fetch._error = error
+        return fetch
+
+    def head(self):
+        """The page without waiting for its body (``'body'`` is set once read)"""
+        with self._lock:
+            if self._page is None and self._error is None:
+                try:
+                    self._deadline = time.monotonic() + settings.SCAN_FETCH_DEADLINE
+                    self._page, self._response = open_page(self.url, self.headers, self._deadline)
+                except Exception as e:
+                    self._error = e
+
+        if self._error is not None:
+            raise self._error
+        return self._page
+
+    def get(self):
+        """The page including its capped body"""
+        page = self.head()
+        with self._body_lock:
+            if 'body' not in page:
+                page['body'], page['body_truncated'] = read_body(self._response, self._deadline)
+                self._response = None
+        return page
+
+    def close(self):
+        """Release the connection if the body was never read"""
+        with self._body_lock:
+            if self._response is not None:
+                self._response.close()
+                self._response = None
@@ -0,0 +1,184 @@
+"""
+Process-wide pooled HTTP session for the scanners.
+
+Every page fetch in a worker process goes through one ``requests.Session``,
+so keep-alive connections are reused across redirects and across scans of the
+same host. Its adapter:
+
+- pools HTTP_POOL_CONNECTIONS hosts with up to HTTP_POOL_MAXSIZE connections
+  each (scan phases run on several threads at once);
+- retries failed connection attempts HTTP_CONNECT_RETRIES times, but never
+  reads, which the scan's own retry logic handles;
+- resolves host names through the shared caching resolver (``resolver.py``),
+  so a scan's DNS phase and page fetch share one set of lookups. Names it
+  can't resolve (``localhost``, IPv6-only hosts) fall back to the system
+  resolver;
+- sends SCANNER_USER_AGENT and keeps no cookies between requests, so one
+  scan never sees cookies set during another;
+- registers every socket a request uses with the calling thread's
+  ``FetchWatch``, if any, so a page fetch can abort them at its deadline
+  however slowly the server answers.
+
+The session is rebuilt in a forked child (Celery prefork, gunicorn), since
+pooled sockets must not be shared between processes. urllib3's pools are
+thread-safe, so threads of one process share it.
+"""
+import ipaddress
+import os
+import socket
+import threading
+from contextlib import contextmanager
+from http.cookiejar import DefaultCookiePolicy
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
+from . import resolver
+
+_lock = threading.Lock()
+_session = None
+_pid = None
+_watching = threading.local()
+
+
+def _shutdown(sock):
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+
+class FetchWatch:
+    """Sockets used by one fetch, shut down together by ``expire`` to abort it from another thread"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sockets = []
+        self.expired = False
+
+    def add(self, sock):
+        with self._lock:
+            if not self.expired:
+                self._sockets.append(sock)
+                return
+        # Connections opened after the deadline (a redirect hop) are cut at once
+        _shutdown(sock)
+
+    def expire(self):
+        with self._lock:
+            self.expired = True
+            sockets, self._sockets = self._sockets, []
+        for sock in sockets:
+            _shutdown(sock)
+
+
+@contextmanager
+def watching(watch):
+    """Register the sockets of requests made by this thread with ``watch``"""
+    _watching.watch = watch
+    try:
+        yield watch
+    finally:
+        _watching.watch = None
+
+
+def _register(sock):
+    watch = getattr(_watching, 'watch', None)
+    if watch is not None and sock is not None:
+        watch.add(sock)
+
+
+def resolve_host(host):
+    """IPv4 address for ``host`` from the shared resolver, or ``host`` itself to let the system resolve it"""
+    try:
+        ipaddress.ip_address(host)
+        return host
+    except ValueError:
+        pass
+
+    records, error, _ = resolver.lookup(host, 'A')
+    return records[0] if records else host
+
+
+class CachedDNSMixin:
+    """Open the socket to the cached address of ``_dns_host``, registering it with the thread's ``FetchWatch``"""
+
+    def _new_conn(self):
+        # urllib3 also derives the Host header, SNI and certificate checks
+        # from _dns_host, so swap the address in only while connecting
+        dns_host = self._dns_host
+        self._dns_host = resolve_host(dns_host)
+        try:
+            sock = super()._new_conn()
+        finally:
+            self._dns_host = dns_host
+        _register(sock)
+        return sock
+
+    def request(self, *args, **kwargs):
+        # Keep-alive connections taken from the pool skip _new_conn
+        _register(self.sock)
+        return super().request(*args, **kwargs)
+
+
+class CachedDNSHTTPConnection(CachedDNSMixin, HTTPConnection):
+    pass
+
+
+class CachedDNSHTTPSConnection(CachedDNSMixin, HTTPSConnection):
+    pass
+
+
+class CachedDNSHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = CachedDNSHTTPConnection
+
+
+class CachedDNSHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = CachedDNSHTTPSConnection
+
+
+class ScannerAdapter(HTTPAdapter):
+    """HTTPAdapter whose pools resolve names through the shared resolver"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': CachedDNSHTTPConnectionPool,
+            'https': CachedDNSHTTPSConnectionPool,
+        }
+
+
+def new_session():
+    session = requests.Session()
+    session.headers['User-Agent'] = settings.SCANNER_USER_AGENT
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+
+    retries = Retry(
+        total=settings.HTTP_CONNECT_RETRIES,
+        connect=settings.HTTP_CONNECT_RETRIES,
+        read=0,
+        status=0,
+        redirect=False,
+        backoff_factor=0.2,
+        raise_on_status=False,
+    )
+    adapter = ScannerAdapter(
+        pool_connections=settings.HTTP_POOL_CONNECTIONS,
+        pool_maxsize=settings.HTTP_POOL_MAXSIZE,
+        max_retries=retries,
+    )
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_session():
+    """The process's shared scanner session, rebuilt after a fork"""
+    global _session, _pid
+    with _lock:
+        if _session is None or _pid != os.getpid():
+            _session = new_session()
+            _pid = os.getpid()
+        return _session
@@ -0,0 +1,115 @@
+import json
+from django.core.management.base import BaseCommand, CommandError
+from app.benchmark import HEADER_PROFILES, MockFarm, run_benchmark
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark the scan pipeline against a local mock target farm (HTTPS '
+        'and DNS servers on 127.0.0.1), without network access. Task mode '
+        'runs scan_website_task in-process and needs the configured Redis; '
+        'use a dedicated instance so its command counts are only the scans\'.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scans', type=int, default=100, help='Scans to run')
+        parser.add_argument('--concurrency', type=int, default=10, help='Scans in flight at once')
+        parser.add_argument('--mode', choices=('task', 'phases'), default='task',
+                            help='task: full scan_website_task; phases: analyzer phases only, no Redis')
+        parser.add_argument('--deep', action='store_true', help='Include the deep TLS phase')
+        parser.add_argument('--incremental', action='store_true',
+                            help='Measure incremental rescans of sites scanned once beforehand (task mode)')
+        parser.add_argument('--latency-ms', type=int, default=0, help='Mock server response latency')
+        parser.add_argument('--jitter-ms', type=int, default=0, help='Random extra latency, up to this much')
+        parser.add_argument('--body-bytes', type=int, default=16 * 1024, help='Size of the mock page body')
+        parser.add_argument('--profiles', default=','.join(HEADER_PROFILES),
+                            help=f'Header sets cycled across sites ({", ".join(HEADER_PROFILES)})')
+        parser.add_argument('--hosts', type=int, default=0, help='Distinct target hosts (0: one per scan)')
+        parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+        parser.add_argument('--baseline', help='JSON report to compare against; fails on regressions')
+        parser.add_argument('--tolerance', type=float, default=0.2,
+                            help='Allowed relative regression against the baseline')
+
+    def handle(self, *args, **options):
+        profiles = tuple(name.strip() for name in options['profiles'].split(',') if name.strip())
+        unknown = [name for name in profiles if name not in HEADER_PROFILES]
+        if unknown or not profiles:
+            raise CommandError(f'Unknown header profiles: {", ".join(unknown) or "none given"}')
+        if options['scans'] < 1 or options['concurrency'] < 1:
+            raise CommandError('--scans and --concurrency must be positive')
+        if options['incremental'] and options['mode'] != 'task':
+            raise CommandError('--incremental needs --mode task')
+
+        with MockFarm(options['latency_ms'], options['jitter_ms'], options['body_bytes']) as farm:
+            report = run_benchmark(
+                farm,
+                scans=options['scans'],
+                concurrency=options['concurrency'],
+                mode=options['mode'],
+                deep=options['deep'],
+                profiles=profiles,
+                hosts=options['hosts'],
+                incremental=options['incremental'],
+            )
+
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+        else:
+            self.print_report(report)
+
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                regressions = self.compare(report, json.load(f), options['tolerance'])
+            if regressions:
+                raise CommandError('Regressions against baseline:\n  ' + '\n  '.join(regressions))
+            self.stdout.write(self.style.SUCCESS('No regressions against baseline'))
+
+    def print_report(self, report):
+        self.stdout.write(
+            f"{report['scans']} scans ({report['mode']} mode), concurrency {report['concurrency']}, "
+            f"{report['elapsed_s']}s: {report['scans_per_sec']} scans/sec"
+        )
+        self.stdout.write(f"Statuses: {report['statuses']}")
+        if report['host_deferrals']['count']:
+            deferrals = report['host_deferrals']
+            self.stdout.write(f"Host deferrals: {deferrals['count']} ({deferrals['wait_s']}s waiting for a host slot)")
+        if report.get('reused_per_scan') is not None:
+            self.stdout.write(f"Incremental rescans: {report['reused_per_scan']} sections reused per scan")
+        self.stdout.write(f"{'':16}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'errors':>8}")
+        rows = [('scan', {**report['scan_ms'], 'errors': ''})] + list(report['phases'].items())
+        for name, stats in rows:
+            self.stdout.write(
+                f"{name:16}{self.format(stats['p50']):>10}{self.format(stats['p95']):>10}"
+                f"{self.format(stats['p99']):>10}{stats['errors']:>8}"
+            )
+        if report['redis_ops_per_scan'] is not None:
+            top = ', '.join(f'{name} {calls}' for name, calls in list(report['redis_commands'].items())[:8])
+            self.stdout.write(f"Redis commands per scan: {report['redis_ops_per_scan']} ({top})")
+        if report['record_bytes'] is not None:
+            memory = f", {report['record_memory']} bytes in Redis" if report['record_memory'] is not None else ''
+            self.stdout.write(f"Scan record ({report['record_codec']}): {report['record_bytes']} bytes of fields{memory}")
+
+    @staticmethod
+    def format(value):
+        return '-' if value is None else f'{value:.1f}'
+
+    @staticmethod
+    def compare(report, baseline, tolerance):
+        """Throughput, p95 latencies, Redis commands and record size that got worse by more than ``tolerance``"""
+        regressions = []
+
+        def check(label, current, previous, higher_is_better=False):
+            if current is None or not previous:
+                return
+            change = (current - previous) / previous
+            if (-change if higher_is_better else change) > tolerance:
+                regressions.append(f'{label}: {previous} -> {current}')
+
+        check('scans/sec', report['scans_per_sec'], baseline.get('scans_per_sec'), higher_is_better=True)
+        check('scan p95 ms', report['scan_ms']['p95'], baseline.get('scan_ms', {}).get('p95'))
+        for name, stats in report['phases'].items():
+            check(f'{name} p95 ms', stats['p95'], baseline.get('phases', {}).get(name, {}).get('p95'))
+        check('redis ops/scan', report['redis_ops_per_scan'], baseline.get('redis_ops_per_scan'))
+        check('record bytes', report.get('record_bytes'), baseline.get('record_bytes'))
+        check('record memory', report.get('record_memory'), baseline.get('record_memory'))
+        return regressions
@@ -0,0 +1,180 @@
+import time
+from django.core.management.base import BaseCommand
+from app import codec
+from app.convex_client import RESULT_PREFIX, ConvexClient
+
+# Replace each field still holding its expected value; ARGV: field, expected,
+# replacement triples. Fields a running scan rewrote in the meantime are skipped.
+REENCODE_SCRIPT = """
+local changed = 0
+for i = 1, #ARGV, 3 do
+    if redis.call('HGET', KEYS[1], ARGV[i]) == ARGV[i + 1] then
+        redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 2])
+        changed = changed + 1
+    end
+end
+return changed
+"""
+
+# Replace a legacy JSON string record with its hash layout, unless it changed.
+# ARGV: the JSON read, then field/value pairs.
+UPGRADE_SCRIPT = """
+if redis.call('TYPE', KEYS[1]).ok ~= 'string' or redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+redis.call('DEL', KEYS[1])
+redis.call('HSET', KEYS[1], unpack(ARGV, 2))
+return 1
+"""
+
+FINISHED = (b'done', b'error')
+
+
+class Command(BaseCommand):
+    help = (
+        'Re-encode stored scan records (scan:*) in the current SCAN_RECORD_CODEC, '
+        'upgrading legacy JSON string records to the hash layout, and report '
+        'their size before and after. Safe to run while scans are in progress.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Keys read per round trip')
+        parser.add_argument('--dry-run', action='store_true', help='Only report what would change')
+        parser.add_argument('--apply-ttl', action='store_true',
+                            help='Also expire finished records that have no TTL, counted from their creation')
+
+    def handle(self, *args, **options):
+        convex_client = ConvexClient()
+        self.redis_client = convex_client.redis_client
+        self.convex_client = convex_client
+        self.dry_run = options['dry_run']
+        self.apply_ttl = options['apply_ttl']
+        self.reencode = self.redis_client.register_script(REENCODE_SCRIPT)
+        self.upgrade = self.redis_client.register_script(UPGRADE_SCRIPT)
+        self.stats = {'records': 0, 'legacy_upgraded': 0, 'fields_reencoded': 0, 'expired': 0,
+                      'bytes_before': 0, 'bytes_after': 0}
+
+        used_before = self.used_memory()
+        started = time.monotonic()
+        batch = []
+        for key in self.redis_client.scan_iter(match='scan:*', count=options['batch_size']):
+            batch.append(key)
+            if len(batch) >= options['batch_size']:
+                self.migrate(batch)
+                batch = []
+        if batch:
+            self.migrate(batch)
+        used_after = self.used_memory()
+
+        stats = self.stats
+        prefix = 'Would migrate' if self.dry_run else 'Migrated'
+        self.stdout.write(
+            f"{prefix} {stats['records']} records in {time.monotonic() - started:.1f}s "
+            f"(codec {codec.current_format()}): {stats['fields_reencoded']} fields re-encoded, "
+            f"{stats['legacy_upgraded']} legacy records upgraded, {stats['expired']} TTLs set"
+        )
+        saved = stats['bytes_before'] - stats['bytes_after']
+        share = f" ({100 * saved / stats['bytes_before']:.1f}%)" if stats['bytes_before'] else ''
+        self.stdout.write(
+            f"Record payload: {stats['bytes_before']} -> {stats['bytes_after']} bytes, {saved} saved{share}"
+        )
+        if used_before is not None and used_after is not None and not self.dry_run:
+            self.stdout.write(f"Redis used_memory: {used_before} -> {used_after} bytes")
+
+    def used_memory(self):
+        try:
+            return self.redis_client.info('memory')['used_memory']
+        except Exception:
+            return None
+
+    def migrate(self, keys):
+        pipe = self.redis_client.pipeline(transaction=False)
+        for key in keys:
+            pipe.type(key)
+            pipe.ttl(key)
+        types = pipe.execute()
+
+        pipe = self.redis_client.pipeline(transaction=False)
+        for key, key_type in zip(keys, types[::2]):
+            if key_type == b'hash':
+                pipe.hgetall(key)
+            else:
+                pipe.get(key)
+        values = pipe.execute()
+
+        for key, key_type, ttl, value in zip(keys, types[::2], types[1::2], values):
+            if not value:
+                # Expired or deleted since the scan
+                continue
+            if key_type == b'hash':
+                fields = value
+                self.reencode_fields(key, fields)
+            elif key_type == b'string':
+                fields = self.upgrade_legacy(key, value)
+                if fields is None:
+                    continue
+            else:
+                continue
+            self.stats['records'] += 1
+            if self.apply_ttl and ttl == -1:
+                self.expire(key, fields)
+
+    def upgrade_legacy(self, key, value):
+        """Hash fields for a legacy JSON string record, written unless it's a dry run"""
+        try:
+            scan_data = codec.decode(value)
+        except ValueError:
+            return None
+        fields = {name: field for name, field in scan_data.items() if name != 'result'}
+        fields.update(self.convex_client._result_fields(scan_data.get('result') or {}))
+        fields = {
+            str(name).encode(): field if isinstance(field, bytes) else str(field).encode()
+            for name, field in fields.items()
+        }
+
+        self.stats['bytes_before'] += len(value)
+        self.stats['bytes_after'] += sum(len(name) + len(field) for name, field in fields.items())
+        if not self.dry_run:
+            args = [value]
+            for name, field in fields.items():
+                args.extend([name, field])
+            if not self.upgrade(keys=[key], args=args):
+                return None
+        self.stats['legacy_upgraded'] += 1
+        return fields
+
+    def reencode_fields(self, key, fields):
+        """Re-encode result fields not in the current format, unless it's a dry run"""
+        target = codec.current_format()
+        args = []
+        for name, value in fields.items():
+            size = len(name) + len(value)
+            self.stats['bytes_before'] += size
+            if not name.startswith(RESULT_PREFIX.encode()) or codec.format_of(value) == target:
+                self.stats['bytes_after'] += size
+                continue
+            encoded = codec.encode(codec.decode(value))
+            encoded = encoded if isinstance(encoded, bytes) else encoded.encode()
+            if encoded == value:
+                self.stats['bytes_after'] += size
+                continue
+            self.stats['bytes_after'] += len(name) + len(encoded)
+            args.extend([name, value, encoded])
+
+        if args:
+            changed = len(args) // 3 if self.dry_run else self.reencode(keys=[key], args=args)
+            self.stats['fields_reencoded'] += changed
+
+    def expire(self, key, fields):
+        """Set the TTL a finished record would have got, counted from its creation"""
+        status = fields.get(b'status')
+        if status not in FINISHED:
+            return
+        ttl = self.convex_client._expiry(status.decode())
+        if ttl <= 0:
+            return
+        created = int(fields.get(b'createdAt') or 0) / 1000
+        remaining = max(1, int(ttl - (time.time() - created))) if created else ttl
+        if not self.dry_run:
+            self.redis_client.expire(key, remaining)
+        self.stats['expired'] += 1
@@ -0,0 +1,192 @@
+"""
+Prometheus metrics for the web app and the Celery workers.
+
+Scans record per-phase durations and outcomes, page fetch timings and body
+sizes, DNS lookups, TLS handshakes, every command on the shared Redis client
+and how long each task waited in its queue. The Django app serves them at
+``/metrics``; a Celery worker serves them on WORKER_METRICS_PORT.
+
+Under gunicorn and Celery prefork each process keeps its own values, so set
+PROMETHEUS_MULTIPROC_DIR to a directory shared by all processes on the host
+(emptied before they start). Both endpoints then aggregate every process's
+values from it; without it they only report the serving process.
+"""
+import os
+import time
+from datetime import datetime
+import redis
+from celery.signals import before_task_publish, task_postrun, task_prerun
+from django.conf import settings
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    generate_latest,
+    multiprocess,
+    start_http_server,
+)
+from .scan_errors import PERMANENT, TRANSIENT, classify_error
+
+# Network phases range from a cached DNS answer to the whole scan deadline
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+QUEUE_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+REDIS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+BYTES_BUCKETS = (0, 1024, 4096, 16384, 65536, 131072, 262144, 524288, 1048576)
+
+PHASE_DURATION = Histogram(
+    'scan_phase_duration_seconds', 'Analyzer phase duration by outcome',
+    ['phase', 'outcome'], buckets=DURATION_BUCKETS,
+)
+FETCH_HEADERS = Histogram(
+    'scan_fetch_headers_seconds', 'Time until the page fetch received the final response headers',
+    ['outcome'], buckets=DURATION_BUCKETS,
+)
+FETCH_BODY_BYTES = Histogram(
+    'scan_fetch_body_bytes', 'Body bytes read per page fetch', buckets=BYTES_BUCKETS,
+)
+FETCH_TRUNCATED = Counter(
+    'scan_fetch_truncated_total', 'Page bodies cut short by SCAN_MAX_BODY_BYTES or SCAN_FETCH_DEADLINE',
+)
+DNS_LOOKUP = Histogram(
+    'dns_lookup_duration_seconds', 'DNS lookup duration by record type and outcome',
+    ['record_type', 'outcome'], buckets=DURATION_BUCKETS,
+)
+TLS_HANDSHAKE = Histogram(
+    'tls_handshake_duration_seconds', 'TLS handshake duration of the TLS phase',
+    ['resumed'], buckets=DURATION_BUCKETS,
+)
+REDIS_COMMAND = Histogram(
+    'redis_command_duration_seconds', 'Round trip of commands on the shared Redis client',
+    ['command'], buckets=REDIS_BUCKETS,
+)
+REDIS_ERRORS = Counter(
+    'redis_command_errors_total', 'Failed commands on the shared Redis client',
+    ['command', 'error'],
+)
+QUEUE_WAIT = Histogram(
+    'celery_task_queue_wait_seconds', 'Time from publishing (or the countdown ending) to a worker starting the task',
+    ['task', 'queue'], buckets=QUEUE_BUCKETS,
+)
+TASK_DURATION = Histogram(
+    'celery_task_duration_seconds', 'Task run time by final state',
+    ['task', 'state'], buckets=DURATION_BUCKETS,
+)
+
+_task_started = {}
+
+
+def registry():
+    """Registry to export: every process's values in multiprocess mode, else this process's"""
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        collector_registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(collector_registry)
+        return collector_registry
+    return REGISTRY
+
+
+def export():
+    """``(body, content_type)`` of the current metrics"""
+    return generate_latest(registry()), CONTENT_TYPE_LATEST
+
+
+def outcome(result):
+    """
+    ``ok``, or the ``error_kind`` of a failed phase result (``transient`` or
+    ``permanent``, see ``scan_errors.py``). Error messages aren't looked at,
+    so labels don't change when their wording does.
+    """
+    if not isinstance(result, dict) or not result.get('error'):
+        return 'ok'
+    return TRANSIENT if result.get('error_kind') == TRANSIENT else PERMANENT
+
+
+def observe_phase(name, result, seconds):
+    PHASE_DURATION.labels(name, outcome(result)).observe(seconds)
+
+
+def observe_handshake(result):
+    if result.get('handshake_ms') is not None:
+        TLS_HANDSHAKE.labels(str(bool(result.get('session_reused'))).lower()).observe(result['handshake_ms'] / 1000)
+
+
+def observe_fetch_headers(seconds, error=None):
+    FETCH_HEADERS.labels('ok' if error is None else classify_error(error)).observe(seconds)
+
+
+def observe_body(size, truncated):
+    FETCH_BODY_BYTES.observe(size)
+    if truncated:
+        FETCH_TRUNCATED.inc()
+
+
+class InstrumentedPipeline(redis.client.Pipeline):
+    """Pipeline timing each ``execute`` as one PIPELINE round trip"""
+
+    def execute(self, raise_on_error=True):
+        started = time.perf_counter()
+        try:
+            return super().execute(raise_on_error)
+        except Exception as e:
+            REDIS_ERRORS.labels('PIPELINE', type(e).__name__).inc()
+            raise
+        finally:
+            REDIS_COMMAND.labels('PIPELINE').observe(time.perf_counter() - started)
+
+
+class InstrumentedRedis(redis.Redis):
+    """``redis.Redis`` recording each command's duration and failures"""
+
+    def execute_command(self, *args, **options):
+        command = str(args[0]).split(' ')[0].upper() if args else 'UNKNOWN'
+        started = time.perf_counter()
+        try:
+            return super().execute_command(*args, **options)
+        except Exception as e:
+            REDIS_ERRORS.labels(command, type(e).__name__).inc()
+            raise
+        finally:
+            REDIS_COMMAND.labels(command).observe(time.perf_counter() - started)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+@before_task_publish.connect
+def stamp_sent_at(headers=None, **kwargs):
+    # Re-stamped on every publish, so a retry's wait starts at the retry
+    if headers is not None:
+        headers['sent_at'] = time.time()
+
+
+@task_prerun.connect
+def observe_queue_wait(task_id=None, task=None, **kwargs):
+    _task_started[task_id] = time.perf_counter()
+
+    request = task.request
+    sent_at = getattr(request, 'sent_at', None)
+    if request.is_eager or sent_at is None:
+        return
+    ready_at = float(sent_at)
+    if request.eta:
+        # A countdown isn't queueing; count from when the task became due
+        eta = datetime.fromisoformat(request.eta) if isinstance(request.eta, str) else request.eta
+        ready_at = max(ready_at, eta.timestamp())
+    queue = (request.delivery_info or {}).get('routing_key') or 'unknown'
+    QUEUE_WAIT.labels(task.name, queue).observe(max(0.0, time.time() - ready_at))
+
+
+@task_postrun.connect
+def observe_task_duration(task_id=None, task=None, state=None, **kwargs):
+    started = _task_started.pop(task_id, None)
+    if started is not None:
+        TASK_DURATION.labels(task.name, state or 'UNKNOWN').observe(time.perf_counter() - started)
+
+
+def start_worker_exporter():
+    """Serve the worker's metrics on WORKER_METRICS_PORT, if set; called in the worker's main process"""
+    if settings.WORKER_METRICS_PORT:
+        if 'PROMETHEUS_MULTIPROC_DIR' not in os.environ:
+            print("Metrics warning: PROMETHEUS_MULTIPROC_DIR is unset, pool process metrics won't be exported")
+        start_http_server(settings.WORKER_METRICS_PORT, registry=registry())
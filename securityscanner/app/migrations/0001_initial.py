@@ -0,0 +1,34 @@
+# Generated by Django 4.2.7 on 2026-10-16 23:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScanRecord',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('job_id', models.CharField(max_length=64, unique=True)),
+                ('url', models.CharField(max_length=2048)),
+                ('domain', models.CharField(max_length=253)),
+                ('status', models.CharField(max_length=16)),
+                ('score', models.PositiveSmallIntegerField(null=True)),
+                ('grade', models.CharField(blank=True, max_length=3)),
+                ('deep', models.BooleanField(default=False)),
+                ('result', models.JSONField(default=dict)),
+                ('created_at', models.DateTimeField()),
+                ('finished_at', models.DateTimeField()),
+            ],
+            options={
+                'ordering': ['-finished_at', '-id'],
+                'indexes': [models.Index(fields=['domain', '-finished_at'], name='scan_domain_finished_idx'), models.Index(fields=['-finished_at'], name='scan_finished_idx'), models.Index(fields=['grade', '-finished_at'], name='scan_grade_finished_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,31 @@
+from django.db import models
+
+
+class ScanRecord(models.Model):
+    """
+    A finished scan, copied from its Redis record by ``persist_scan_task``.
+    Redis only keeps scans by job id, and only until they expire; these
+    rows answer per-domain history and trend queries.
+    """
+    job_id = models.CharField(max_length=64, unique=True)
+    url = models.CharField(max_length=2048)
+    domain = models.CharField(max_length=253)
+    status = models.CharField(max_length=16)
+    score = models.PositiveSmallIntegerField(null=True)
+    grade = models.CharField(max_length=3, blank=True)
+    deep = models.BooleanField(default=False)
+    result = models.JSONField(default=dict)
+    created_at = models.DateTimeField()
+    finished_at = models.DateTimeField()
+
+    class Meta:
+        ordering = ['-finished_at', '-id']
+        indexes = [
+            # Latest scans of a domain, and a domain's trend over a window
+            models.Index(fields=['domain', '-finished_at'], name='scan_domain_finished_idx'),
+            models.Index(fields=['-finished_at'], name='scan_finished_idx'),
+            models.Index(fields=['grade', '-finished_at'], name='scan_grade_finished_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.domain} {self.grade or self.status} ({self.job_id})'
@@ -0,0 +1,67 @@
+"""
+Process-wide Redis connection pool.
+
+Views, ConvexClient, the scan cache and the rate limiter all share one
+``redis.Redis`` client per process instead of opening new connections per
+request or task. redis-py resets a pool when it notices it is running in a
+forked child, so this is safe under gunicorn and Celery prefork workers.
+"""
+import threading
+import redis
+import redis.asyncio
+from django.conf import settings
+from .metrics import InstrumentedRedis
+
+_lock = threading.Lock()
+_pool = None
+_client = None
+
+
+def get_pool():
+    """Shared connection pool configured from the REDIS_* settings"""
+    global _pool
+    with _lock:
+        if _pool is None:
+            _pool = redis.ConnectionPool.from_url(
+                settings.REDIS_URL,
+                max_connections=settings.REDIS_MAX_CONNECTIONS,
+                socket_timeout=settings.REDIS_SOCKET_TIMEOUT,
+                socket_connect_timeout=settings.REDIS_SOCKET_CONNECT_TIMEOUT,
+                health_check_interval=settings.REDIS_HEALTH_CHECK_INTERVAL,
+            )
+        return _pool
+
+
+def get_redis():
+    """Shared Redis client backed by the process-wide pool, timing every command"""
+    global _client
+    if _client is None:
+        client = InstrumentedRedis(connection_pool=get_pool())
+        with _lock:
+            if _client is None:
+                _client = client
+    return _client
+
+
+def new_async_redis():
+    """
+    New asyncio Redis client with the same settings. asyncio connections are
+    bound to the event loop that opened them, so callers keep one per loop.
+    """
+    return redis.asyncio.Redis.from_url(
+        settings.REDIS_URL,
+        max_connections=settings.REDIS_MAX_CONNECTIONS,
+        socket_connect_timeout=settings.REDIS_SOCKET_CONNECT_TIMEOUT,
+        health_check_interval=settings.REDIS_HEALTH_CHECK_INTERVAL,
+    )
+
+
+def pool_stats():
+    """Connection counts for the health check"""
+    pool = get_pool()
+    return {
+        'max_connections': pool.max_connections,
+        'created': pool._created_connections,
+        'in_use': len(pool._in_use_connections),
+        'idle': len(pool._available_connections),
+    }
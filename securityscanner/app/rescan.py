@@ -0,0 +1,249 @@
+"""
+Incremental rescans.
+
+Scheduled rescans of a URL mostly find what the previous scan found. An
+incremental scan (``"incremental": true``) keeps the result layout of a full
+scan but, before running each reusable phase, makes a cheap check against the
+baseline the previous incremental scan of the URL left. If the check shows
+nothing changed, the phase returns the baseline's section instead of running:
+
+- ``tls_deep``: the certificate serial, expiry and fingerprint seen by the
+  ``tls`` phase, which always runs (it is a single, usually resumed, handshake);
+- ``dns``: the zone's SOA serial and timers, one query instead of one per
+  record type;
+- ``headers`` and ``fingerprinting``: the page is requested with the
+  baseline's ETag / Last-Modified, and a 304 reuses both. Otherwise
+  ``headers`` is rebuilt from the new response's headers, which costs
+  nothing more, and ``fingerprinting`` is reused without reading the body
+  when the ETag, Last-Modified or a hash of the stable response headers
+  match.
+
+The score is always recomputed from the assembled result, and the scan's
+``rescan`` section lists the reused phases. Baselines are stored with the
+record codec under ``rescan:<normalized URL>`` for RESCAN_BASELINE_TTL
+seconds. A section is reused for at most RESCAN_MAX_REUSE_AGE seconds after
+it was last computed, so every section is periodically recomputed in full.
+"""
+import functools
+import hashlib
+import threading
+import time
+from django.conf import settings
+from . import codec, resolver, tracing
+from .scan_cache import normalize_url
+
+# Phases whose section can be reused; ``tls`` always runs as the certificate check
+REUSABLE_PHASES = ('headers', 'dns', 'fingerprinting', 'tls_deep')
+
+# Page validators compared by the fingerprinting check
+PAGE_VALIDATORS = ('etag', 'last_modified', 'header_hash')
+
+# Response headers that change between requests whatever the site's configuration
+VOLATILE_HEADERS = frozenset({
+    'age', 'cf-cache-status', 'cf-ray', 'content-length', 'date', 'etag', 'expires',
+    'last-modified', 'nel', 'report-to', 'server-timing', 'set-cookie', 'via',
+    'x-amz-cf-id', 'x-amz-cf-pop', 'x-amz-request-id', 'x-cache', 'x-cache-hits',
+    'x-request-id', 'x-runtime', 'x-served-by', 'x-timer',
+})
+
+# Check result of a page fetch answered with 304 Not Modified
+NOT_MODIFIED = 'not-modified'
+
+
+def tls_fingerprint(tls):
+    """Certificate serial, expiry and fingerprint from a ``tls`` section, or None without a certificate"""
+    if not tls or tls.get('error') or not tls.get('fingerprint_sha256'):
+        return None
+    return f"{tls.get('serial_number')}|{tls.get('expiry_date')}|{tls['fingerprint_sha256']}"
+
+
+def dns_fingerprint(domain):
+    """Zone, serial and timers of the SOA record covering ``domain``, or None if it can't be read"""
+    try:
+        zone, soa = resolver.lookup_soa(domain)
+    except Exception:
+        return None
+    return f'{zone}|{soa.serial}|{soa.refresh}|{soa.retry}|{soa.expire}|{soa.minimum}'
+
+
+def header_hash(page):
+    """Hash of a fetched page's final URL, status, stable headers and cookie names"""
+    headers = sorted(
+        f'{name.lower()}: {value}'
+        for name, value in page['headers'].items()
+        if name.lower() not in VOLATILE_HEADERS
+    )
+    parts = [page['url'], str(page['status_code']), *headers, *sorted(page['cookies'])]
+    return hashlib.sha256('\n'.join(parts).encode()).hexdigest()
+
+
+def page_validators(page):
+    """ETag, Last-Modified and header hash of a fetched page"""
+    return {
+        'etag': page['headers'].get('ETag'),
+        'last_modified': page['headers'].get('Last-Modified'),
+        'header_hash': header_hash(page),
+    }
+
+
+class RescanBaselines:
+    """Redis store of the baseline each URL's last incremental scan left, keyed by normalized URL"""
+
+    def __init__(self, redis_client):
+        self.redis_client = redis_client
+        self.ttl = settings.RESCAN_BASELINE_TTL
+
+    def _key(self, url):
+        return f'rescan:{normalize_url(url)}'
+
+    def get(self, url):
+        """The baseline for ``url`` or None"""
+        try:
+            stored = self.redis_client.get(self._key(url))
+            return codec.decode(stored) if stored else None
+        except Exception as e:
+            print(f"Redis error: {e}")
+            return None
+
+    def set(self, url, baseline):
+        """Store the baseline for the next incremental scan of ``url``"""
+        try:
+            self.redis_client.set(self._key(url), codec.encode(baseline), ex=self.ttl or None)
+        except Exception as e:
+            print(f"Redis error: {e}")
+
+
+class Rescan:
+    """
+    One incremental scan: wraps the reusable phases so each checks the
+    baseline first, and builds the baseline for the next scan.
+
+    Baseline sections are ``{'result': section, 'check': value,
+    'computed_at': timestamp}``, where ``check`` is what the phase's check
+    observed when the section was last computed or confirmed.
+    """
+
+    def __init__(self, baseline):
+        self.baseline = baseline or {}
+        self.sections = self.baseline.get('sections') or {}
+        self.started = time.time()
+        self.checks = {}
+        self.reused = set()
+        self.ran = set()
+        self._tls = None
+        self._tls_checked = threading.Event()
+
+    def _reusable(self, name):
+        saved = self.sections.get(name)
+        return (
+            saved is not None
+            and not saved['result'].get('error')
+            and self.started - saved['computed_at'] < settings.RESCAN_MAX_REUSE_AGE
+        )
+
+    def request_headers(self):
+        """Conditional headers for the page fetch, if a 304 would let both page sections be reused"""
+        if not (self._reusable('headers') and self._reusable('fingerprinting')):
+            return None
+        check = self.sections['headers']['check']
+        headers = {}
+        if check.get('etag'):
+            headers['If-None-Match'] = check['etag']
+        if check.get('last_modified'):
+            headers['If-Modified-Since'] = check['last_modified']
+        return headers or None
+
+    def wrap(self, phases, result):
+        """
+        ``phases`` (name -> ``(function, args)``) with each reusable phase
+        checking the baseline first. ``result`` holds the sections a previous
+        attempt already finished.
+        """
+        phases = dict(phases)
+        self.ran = set(phases)
+        if 'tls' in phases:
+            function, args = phases['tls']
+            phases['tls'] = (self._tls_phase(function), args)
+        else:
+            self._tls = result.get('tls')
+            self._tls_checked.set()
+        for name in REUSABLE_PHASES:
+            if name in phases:
+                function, args = phases[name]
+                phases[name] = (self._reusable_phase(name, function), args)
+        return phases
+
+    def _tls_phase(self, function):
+        @functools.wraps(function)
+        def phase(*args):
+            try:
+                self._tls = function(*args)
+                return self._tls
+            finally:
+                self._tls_checked.set()
+        return phase
+
+    def _reusable_phase(self, name, function):
+        @functools.wraps(function)
+        def phase(*args):
+            observed = self._observe(name, *args)
+            if self._unchanged(name, observed):
+                self.reused.add(name)
+                self.checks[name] = self.sections[name]['check'] if observed == NOT_MODIFIED else observed
+                tracing.annotate({'scan.reused': True})
+                return self.sections[name]['result']
+            self.checks[name] = observed
+            return function(*args)
+        return phase
+
+    def _observe(self, name, *args):
+        """What the check for phase ``name`` sees now; None if it can't tell"""
+        if name == 'dns':
+            return dns_fingerprint(args[0])
+        if name == 'tls_deep':
+            # The tls phase was submitted first, so it is running or done by now
+            self._tls_checked.wait(settings.SCAN_DEADLINE)
+            return tls_fingerprint(self._tls)
+        url, page = args
+        try:
+            response = page.head()
+        except Exception:
+            # The phase runs and reports the fetch error
+            return None
+        return NOT_MODIFIED if response['status_code'] == 304 else page_validators(response)
+
+    def _unchanged(self, name, observed):
+        if observed is None or not self._reusable(name):
+            return False
+        if observed == NOT_MODIFIED:
+            return True
+        if name == 'headers':
+            return False
+        check = self.sections[name]['check']
+        if name == 'fingerprinting':
+            return any(observed[key] and observed[key] == check.get(key) for key in PAGE_VALIDATORS)
+        return observed == check
+
+    def summary(self):
+        """The scan's ``rescan`` section"""
+        return {
+            'baseline_job_id': self.baseline.get('job_id'),
+            'reused': [name for name in REUSABLE_PHASES if name in self.reused],
+        }
+
+    def next_baseline(self, job_id, result):
+        """
+        Baseline for the next incremental scan. Sections this scan didn't
+        run (``tls_deep`` on a regular scan) are carried over, and so are
+        those a failed attempt checkpointed before a retry, whose checks only
+        that attempt saw; sections that failed or couldn't be checked are
+        dropped.
+        """
+        sections = {name: saved for name, saved in self.sections.items() if name not in self.ran}
+        for name in REUSABLE_PHASES:
+            section = result.get(name)
+            if not section or section.get('error') or self.checks.get(name) is None:
+                continue
+            computed_at = self.sections[name]['computed_at'] if name in self.reused else self.started
+            sections[name] = {'result': section, 'check': self.checks[name], 'computed_at': computed_at}
+        return {'job_id': job_id, 'sections': sections}
@@ -0,0 +1,118 @@
+"""
+Process-wide DNS resolvers.
+
+All lookups in a worker process share one dnspython ``LRUCache``, which
+honours record TTLs, so repeated NS/MX/TXT lookups for sibling hosts of the
+same apex are answered from memory. The sync and async resolvers share the
+cache, so both scan engines benefit from each other's lookups.
+"""
+import threading
+import time
+import dns.asyncresolver
+import dns.rdatatype
+import dns.resolver
+from django.conf import settings
+from . import metrics, tracing
+from .scan_errors import classify_error
+
+_lock = threading.Lock()
+_cache = None
+_resolver = None
+_async_resolver = None
+
+
+def get_cache():
+    """Shared TTL-respecting answer cache"""
+    global _cache
+    with _lock:
+        if _cache is None:
+            _cache = dns.resolver.LRUCache(max_size=settings.DNS_CACHE_SIZE)
+        return _cache
+
+
+def _configure(resolver):
+    resolver.cache = get_cache()
+    resolver.lifetime = settings.DNS_LIFETIME
+    return resolver
+
+
+def get_resolver():
+    """Process-wide blocking resolver"""
+    global _resolver
+    if _resolver is None:
+        resolver = _configure(dns.resolver.Resolver())
+        with _lock:
+            if _resolver is None:
+                _resolver = resolver
+    return _resolver
+
+
+def get_async_resolver():
+    """Process-wide asyncio resolver sharing the blocking resolver's cache"""
+    global _async_resolver
+    if _async_resolver is None:
+        resolver = _configure(dns.asyncresolver.Resolver())
+        with _lock:
+            if _async_resolver is None:
+                _async_resolver = resolver
+    return _async_resolver
+
+
+def _outcome(record_type, answer, error, started):
+    elapsed = time.monotonic() - started
+    elapsed_ms = round(elapsed * 1000, 2)
+    if error is not None:
+        # An empty answer just means there are no records of that type
+        if isinstance(error, dns.resolver.NoAnswer):
+            metrics.DNS_LOOKUP.labels(record_type, 'empty').observe(elapsed)
+            return [], None, elapsed_ms
+        metrics.DNS_LOOKUP.labels(record_type, classify_error(error)).observe(elapsed)
+        tracing.mark_error(error)
+        return [], str(error) or type(error).__name__, elapsed_ms
+    metrics.DNS_LOOKUP.labels(record_type, 'ok').observe(elapsed)
+    return [str(record) for record in answer], None, elapsed_ms
+
+
+def lookup(domain, record_type):
+    """Resolve one record type; returns ``(records, error, elapsed_ms)``"""
+    with tracing.span('dns.lookup', {'dns.name': domain, 'dns.record_type': record_type}):
+        started = time.monotonic()
+        try:
+            answer = get_resolver().resolve(domain, record_type)
+        except Exception as e:
+            return _outcome(record_type, None, e, started)
+        return _outcome(record_type, answer, None, started)
+
+
+async def lookup_async(domain, record_type):
+    """Async counterpart of ``lookup``"""
+    with tracing.span('dns.lookup', {'dns.name': domain, 'dns.record_type': record_type}):
+        started = time.monotonic()
+        try:
+            answer = await get_async_resolver().resolve(domain, record_type)
+        except Exception as e:
+            return _outcome(record_type, None, e, started)
+        return _outcome(record_type, answer, None, started)
+
+
+def lookup_soa(domain):
+    """
+    SOA record of the zone ``domain`` belongs to, taken from the authority
+    section when ``domain`` is below the zone apex. Returns ``(zone, soa)``;
+    raises if the lookup fails or no SOA came back.
+    """
+    with tracing.span('dns.lookup', {'dns.name': domain, 'dns.record_type': 'SOA'}):
+        started = time.monotonic()
+        try:
+            answer = get_resolver().resolve(domain, 'SOA', raise_on_no_answer=False)
+            rrset = answer.rrset or next(
+                (rrset for rrset in answer.response.authority if rrset.rdtype == dns.rdatatype.SOA), None
+            )
+            if rrset is None:
+                raise dns.resolver.NoAnswer(response=answer.response)
+        except Exception as e:
+            metrics.DNS_LOOKUP.labels('SOA', classify_error(e)).observe(time.monotonic() - started)
+            tracing.mark_error(e)
+            raise
+        metrics.DNS_LOOKUP.labels('SOA', 'ok').observe(time.monotonic() - started)
+        return rrset.name.to_text(omit_final_dot=True), rrset[0]
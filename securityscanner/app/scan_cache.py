@@ -0,0 +1,68 @@
+from urllib.parse import urlsplit
+from django.conf import settings
+from . import codec
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+def normalize_url(url):
+    """
+    Normalize a URL to the parts that determine a scan's outcome:
+    lowercased scheme and host, explicit non-default port and path.
+    Query strings and fragments are dropped.
+    """
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or '').rstrip('.')
+    port = parts.port
+    netloc = host if port in (None, DEFAULT_PORTS.get(scheme)) else f'{host}:{port}'
+    return f'{scheme}://{netloc}{parts.path or "/"}'
+
+
+class ScanCache:
+    """Redis cache of finished scan results keyed by normalized URL, stored with the record codec"""
+
+    STATS_KEY = 'scan_cache:stats'
+
+    def __init__(self, redis_client):
+        self.redis_client = redis_client
+        self.ttl = settings.SCAN_CACHE_TTL
+
+    def _key(self, url):
+        return f'scan_cache:{normalize_url(url)}'
+
+    def get(self, url):
+        """Return the cached result for ``url`` or None, counting hits and misses"""
+        if self.ttl <= 0:
+            return None
+
+        try:
+            cached = self.redis_client.get(self._key(url))
+            self.redis_client.hincrby(self.STATS_KEY, 'hits' if cached else 'misses', 1)
+            return codec.decode(cached) if cached else None
+        except Exception as e:
+            print(f"Redis error: {e}")
+            return None
+
+    def set(self, url, result):
+        """Cache a finished scan result for SCAN_CACHE_TTL seconds"""
+        if self.ttl <= 0:
+            return
+
+        try:
+            self.redis_client.set(self._key(url), codec.encode(result), ex=self.ttl)
+        except Exception as e:
+            print(f"Redis error: {e}")
+
+    def stats(self):
+        """Hit/miss counters and the resulting hit ratio"""
+        counters = self.redis_client.hgetall(self.STATS_KEY)
+        hits = int(counters.get(b'hits', 0))
+        misses = int(counters.get(b'misses', 0))
+        lookups = hits + misses
+        return {
+            'ttl': self.ttl,
+            'hits': hits,
+            'misses': misses,
+            'hit_ratio': round(hits / lookups, 4) if lookups else None
+        }
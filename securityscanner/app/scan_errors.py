@@ -0,0 +1,88 @@
+"""
+Classification of scan failures.
+
+Transient failures (timeouts, dropped connections, a resolver that didn't
+answer in time) are worth retrying after a backoff. Permanent ones (a name
+that doesn't resolve, an unreachable network, a refused connection, a
+certificate that fails verification) will fail the same way again, so the scan
+records them and moves on instead of spending worker time on retries.
+"""
+import errno
+import random
+import socket
+import ssl
+import dns.exception
+import dns.resolver
+import redis
+import requests
+from django.conf import settings
+
+TRANSIENT = 'transient'
+PERMANENT = 'permanent'
+
+# Checked first: several of these subclass the transient types below
+PERMANENT_ERRORS = (
+    socket.gaierror,
+    ConnectionRefusedError,
+    ssl.SSLCertVerificationError,
+    dns.resolver.NXDOMAIN,
+    dns.resolver.NoNameservers,
+    requests.exceptions.InvalidURL,
+    requests.exceptions.TooManyRedirects,
+)
+
+TRANSIENT_ERRORS = (
+    TimeoutError,
+    ConnectionError,
+    dns.exception.Timeout,
+    requests.exceptions.Timeout,
+    requests.exceptions.ConnectionError,
+    redis.exceptions.ConnectionError,
+    redis.exceptions.TimeoutError,
+)
+
+UNREACHABLE_ERRNOS = (errno.EHOSTUNREACH, errno.ENETUNREACH)
+
+
+def _error_chain(exc):
+    """``exc`` and the errors it wraps, including those urllib3/aiohttp keep as attributes"""
+    seen = []
+    pending = [exc]
+    while pending:
+        error = pending.pop()
+        if not isinstance(error, BaseException) or any(error is other for other in seen):
+            continue
+        seen.append(error)
+        pending.extend([error.__cause__, error.__context__])
+        pending.extend(getattr(error, name, None) for name in ('reason', 'os_error', 'certificate_error'))
+        pending.extend(error.args[:1])
+    return seen
+
+
+def classify_error(exc):
+    """``TRANSIENT`` or ``PERMANENT``; unrecognised errors are treated as permanent"""
+    chain = _error_chain(exc)
+    for error in chain:
+        if isinstance(error, PERMANENT_ERRORS):
+            return PERMANENT
+        if isinstance(error, OSError) and error.errno in UNREACHABLE_ERRNOS:
+            return PERMANENT
+    for error in chain:
+        if isinstance(error, TRANSIENT_ERRORS):
+            return TRANSIENT
+    return PERMANENT
+
+
+def error_section(exc):
+    """Error fields recorded in a phase result"""
+    return {'error': str(exc), 'error_kind': classify_error(exc)}
+
+
+def backoff_delay(attempt):
+    """
+    Seconds before retry number ``attempt`` (0-based): exponential from
+    SCAN_RETRY_BACKOFF up to SCAN_RETRY_BACKOFF_MAX, half of it jittered so
+    retries of scans that failed together spread out.
+    """
+    delay = min(settings.SCAN_RETRY_BACKOFF_MAX, settings.SCAN_RETRY_BACKOFF * 2 ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
@@ -0,0 +1,157 @@
+"""
+Server-sent event streams of scan progress.
+
+``ConvexClient.update_scan`` publishes every change to ``scan_events:{job_id}``.
+Each event loop keeps one ``ScanEventHub`` holding a single Redis pub/sub
+connection; it subscribes to a job's channel while at least one stream is
+watching that job and fans messages out to the streams' queues. Thousands of
+open scan pages therefore cost one Redis connection per API process instead of
+one poll per page per second. A malformed message is logged and dropped; if
+the connection is lost, every stream ends (clients reconnect and get a fresh
+snapshot) and the next subscription reads from a new connection.
+"""
+import asyncio
+import json
+import weakref
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from .convex_client import ConvexClient, EVENTS_CHANNEL
+from .redis_pool import new_async_redis
+
+# Statuses after which a scan record no longer changes
+FINISHED_STATUSES = ('done', 'error')
+
+_hubs = weakref.WeakKeyDictionary()
+
+
+class ScanEventHub:
+    """Multiplexes scan event channels over one pub/sub connection"""
+
+    def __init__(self):
+        self._redis = new_async_redis()
+        self._pubsub = self._redis.pubsub()
+        self._listeners = {}
+        self._lock = asyncio.Lock()
+        self._reader = None
+
+    async def subscribe(self, job_id):
+        """Queue receiving the job's events; ``None`` signals a lost connection"""
+        queue = asyncio.Queue()
+        channel = EVENTS_CHANNEL.format(job_id=job_id)
+        async with self._lock:
+            listeners = self._listeners.setdefault(channel, set())
+            if not listeners:
+                await self._pubsub.subscribe(channel)
+            listeners.add(queue)
+            if self._reader is None or self._reader.done():
+                self._reader = asyncio.create_task(self._read())
+        return queue
+
+    async def unsubscribe(self, job_id, queue):
+        channel = EVENTS_CHANNEL.format(job_id=job_id)
+        async with self._lock:
+            listeners = self._listeners.get(channel)
+            if listeners is None:
+                # Already dropped along with a lost connection
+                return
+            listeners.discard(queue)
+            if not listeners:
+                self._listeners.pop(channel, None)
+                try:
+                    await self._pubsub.unsubscribe(channel)
+                except Exception as e:
+                    print(f"Redis error: {e}")
+
+    async def _read(self):
+        pubsub = self._pubsub
+        try:
+            while True:
+                message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                if message is not None:
+                    self._dispatch(message)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Redis error: {e}")
+            async with self._lock:
+                # End every stream, since events may have been missed; clients
+                # reconnect for a fresh snapshot, and their subscribe() starts
+                # a new reader on a new connection
+                for listeners in self._listeners.values():
+                    for queue in listeners:
+                        queue.put_nowait(None)
+                self._listeners.clear()
+                self._pubsub = self._redis.pubsub()
+            try:
+                await pubsub.aclose()
+            except Exception:
+                pass
+
+    def _dispatch(self, message):
+        """Fan one pub/sub message out to its channel's streams; malformed ones are logged and dropped"""
+        try:
+            channel = message['channel'].decode()
+            event = json.loads(message['data'])
+            if not isinstance(event, dict) or not isinstance(event.get('version'), int) or not isinstance(event.get('update'), dict):
+                raise ValueError(f'not a scan event: {message["data"][:200]!r}')
+        except (AttributeError, KeyError, TypeError, ValueError) as e:
+            print(f"Scan event error: {e}")
+            return
+        for queue in list(self._listeners.get(channel, ())):
+            queue.put_nowait(event)
+
+
+def get_event_hub():
+    """Hub for the running event loop"""
+    loop = asyncio.get_running_loop()
+    hub = _hubs.get(loop)
+    if hub is None:
+        hub = _hubs[loop] = ScanEventHub()
+    return hub
+
+
+def format_event(event, data, version):
+    """One SSE frame; the record version doubles as the event id"""
+    return f"id: {version}\nevent: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def scan_event_stream(job_id):
+    """
+    Yield SSE frames for a scan: a ``snapshot`` of the full record, then an
+    ``update`` for each change until the scan finishes, the connection is lost
+    or SSE_MAX_STREAM_SECONDS elapse (clients then reconnect).
+    """
+    hub = get_event_hub()
+    # Subscribe before reading the snapshot so no update falls in between
+    queue = await hub.subscribe(job_id)
+    try:
+        scan_data, version = await sync_to_async(ConvexClient().get_scan_versioned, thread_sensitive=False)(job_id)
+        if not scan_data:
+            yield format_event('error', {'error': 'Scan not found'}, 0)
+            return
+
+        yield format_event('snapshot', scan_data, version)
+        if scan_data.get('status') in FINISHED_STATUSES:
+            return
+
+        loop = asyncio.get_running_loop()
+        end = loop.time() + settings.SSE_MAX_STREAM_SECONDS
+        while loop.time() < end:
+            try:
+                message = await asyncio.wait_for(queue.get(), timeout=settings.SSE_HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                yield ": keep-alive\n\n"
+                continue
+
+            if message is None:
+                return
+            if message['version'] <= version:
+                continue
+
+            version = message['version']
+            update = message['update']
+            yield format_event('update', update, version)
+            if update.get('status') in FINISHED_STATUSES:
+                return
+    finally:
+        await hub.unsubscribe(job_id, queue)
@@ -0,0 +1,86 @@
+"""
+Durable scan history.
+
+Redis keeps scan records only by job id and only until they expire, so
+finished scans are also copied into ``ScanRecord`` rows. ``persist_scan_task``
+does the copy on the bulk queue after a scan's final update, so the scan
+never waits on the database. The history and trend endpoints read only
+these rows, never Redis.
+"""
+from datetime import datetime, timedelta, timezone
+from django.db.models import Avg, Count, Max, Min
+from django.db.models.functions import TruncDay, TruncWeek
+from django.utils import timezone as django_timezone
+from .host_limiter import target_host
+from .models import ScanRecord
+
+TREND_BUCKETS = {'day': TruncDay, 'week': TruncWeek}
+
+
+def normalize_domain(value):
+    """Lowercased host name of a domain or URL, as stored in ``ScanRecord.domain``"""
+    value = value.strip().lower()
+    if '://' in value:
+        value = target_host(value)
+    return value.rstrip('.')
+
+
+def save_scan(scan_data, finished_at):
+    """Insert or update the history row of a finished scan record; ``finished_at`` is a Unix time"""
+    result = scan_data.get('result') or {}
+    done = scan_data.get('status') == 'done'
+    finished = datetime.fromtimestamp(finished_at, tz=timezone.utc)
+    created = scan_data.get('createdAt')
+
+    record, _ = ScanRecord.objects.update_or_create(
+        job_id=scan_data['job_id'],
+        defaults={
+            'url': scan_data['url'],
+            'domain': normalize_domain(scan_data['url']),
+            'status': scan_data['status'],
+            'score': result.get('score') if done else None,
+            'grade': result.get('grade', '') if done else '',
+            'deep': 'tls_deep' in result,
+            'result': result,
+            'created_at': datetime.fromtimestamp(created / 1000, tz=timezone.utc) if created else finished,
+            'finished_at': finished,
+        },
+    )
+    return record
+
+
+def history(domain=None, grade=None, status=None, since=None):
+    """History rows, newest first, without their full results"""
+    records = ScanRecord.objects.defer('result')
+    if domain:
+        records = records.filter(domain=normalize_domain(domain))
+    if grade:
+        records = records.filter(grade=grade)
+    if status:
+        records = records.filter(status=status)
+    if since:
+        records = records.filter(finished_at__gte=since)
+    return records
+
+
+def trend(domain, days=90, bucket='day'):
+    """Score statistics of a domain's finished scans per ``bucket`` over the last ``days`` days"""
+    since = django_timezone.now() - timedelta(days=days)
+    rows = (
+        ScanRecord.objects
+        .filter(domain=normalize_domain(domain), status='done', finished_at__gte=since)
+        .annotate(period=TREND_BUCKETS[bucket]('finished_at'))
+        .values('period')
+        .annotate(scans=Count('id'), average=Avg('score'), minimum=Min('score'), maximum=Max('score'))
+        .order_by('period')
+    )
+    return [
+        {
+            'period': row['period'],
+            'scans': row['scans'],
+            'average_score': round(row['average'], 1) if row['average'] is not None else None,
+            'min_score': row['minimum'],
+            'max_score': row['maximum'],
+        }
+        for row in rows
+    ]
@@ -1,42 +1,117 @@
+from django.conf import settings
 from rest_framework import serializers
+from .models import ScanRecord
+from .scan_cache import normalize_url
+
+def validate_scan_url(value):
+    """Validate URL and check for security concerns"""
+    import re
+    from urllib.parse import urlparse
+    
+    # Basic URL validation
+    if not value.startswith(('http://', 'https://')):
+        raise serializers.ValidationError("URL must start with http:// or https://")
+    
+    parsed = urlparse(value)
+    
+    # Reject IP addresses
+    ip_pattern = r'^(\d{1,3}\.){3}\d{1,3}$'
+    if re.match(ip_pattern, parsed.hostname):
+        raise serializers.ValidationError("IP addresses are not allowed")
+    
+    # Reject localhost and private IPs
+    if parsed.hostname in ['localhost', '127.0.0.1', '0.0.0.0']:
+        raise serializers.ValidationError("Localhost addresses are not allowed")
+    
+    # Check for private IP ranges
+    if parsed.hostname:
+        try:
+            import ipaddress
+            ip = ipaddress.ip_address(parsed.hostname)
+            if ip.is_private:
+                raise serializers.ValidationError("Private IP addresses are not allowed")
+        except (ValueError, ipaddress.AddressValueError):
+            # Not an IP address, continue
+            pass
+    
+    return value
 
 class ScanRequestSerializer(serializers.Serializer):
     url = serializers.URLField(required=True)
+    force = serializers.BooleanField(required=False, default=False)
+    priority = serializers.ChoiceField(choices=settings.SCAN_PRIORITIES, required=False, default='interactive')
+    deep = serializers.BooleanField(required=False, default=False)
+    incremental = serializers.BooleanField(required=False, default=False)
     
     def validate_url(self, value):
         """Validate URL and check for security concerns"""
-        import re
-        from urllib.parse import urlparse
-        
-        # Basic URL validation
-        if not value.startswith(('http://', 'https://')):
-            raise serializers.ValidationError("URL must start with http:// or https://")
-        
-        parsed = urlparse(value)
-        
-        # Reject IP addresses
-        ip_pattern = r'^(\d{1,3}\.){3}\d{1,3}$'
-        if re.match(ip_pattern, parsed.hostname):
-            raise serializers.ValidationError("IP addresses are not allowed")
-        
-        # Reject localhost and private IPs
-        if parsed.hostname in ['localhost', '127.0.0.1', '0.0.0.0']:
-            raise serializers.ValidationError("Localhost addresses are not allowed")
+        return validate_scan_url(value)
+
+class BatchScanRequestSerializer(serializers.Serializer):
+    urls = serializers.ListField(
+        child=serializers.URLField(),
+        allow_empty=False,
+        max_length=settings.BATCH_MAX_URLS
+    )
+    force = serializers.BooleanField(required=False, default=False)
+    priority = serializers.ChoiceField(choices=settings.SCAN_PRIORITIES, required=False, default='bulk')
+    incremental = serializers.BooleanField(required=False, default=False)
+    
+    def validate_urls(self, values):
+        """Validate every URL, reporting errors by position, and drop duplicates after normalization"""
+        errors = {}
+        unique_urls = {}
         
-        # Check for private IP ranges
-        if parsed.hostname:
+        for index, value in enumerate(values):
             try:
-                import ipaddress
-                ip = ipaddress.ip_address(parsed.hostname)
-                if ip.is_private:
-                    raise serializers.ValidationError("Private IP addresses are not allowed")
-            except (ValueError, ipaddress.AddressValueError):
-                # Not an IP address, continue
-                pass
+                value = validate_scan_url(value)
+            except serializers.ValidationError as e:
+                errors[index] = e.detail
+                continue
+            unique_urls.setdefault(normalize_url(value), value)
+        
+        if errors:
+            raise serializers.ValidationError(errors)
         
-        return value
+        return list(unique_urls.values())
 
 class ScanResponseSerializer(serializers.Serializer):
     job_id = serializers.CharField()
     status = serializers.CharField()
     message = serializers.CharField()
+    cached = serializers.BooleanField(required=False, default=False)
+
+class BatchScanResponseSerializer(serializers.Serializer):
+    batch_id = serializers.CharField()
+    status = serializers.CharField()
+    total = serializers.IntegerField()
+    queued = serializers.IntegerField()
+    cached = serializers.IntegerField()
+    joined = serializers.IntegerField()
+    message = serializers.CharField()
+
+class ScanHistoryQuerySerializer(serializers.Serializer):
+    domain = serializers.CharField(required=False, max_length=2048)
+    grade = serializers.CharField(required=False, max_length=3)
+    status = serializers.ChoiceField(choices=('done', 'error'), required=False)
+    since = serializers.DateTimeField(required=False)
+    
+    def validate(self, data):
+        """Only API key holders may list scans of every domain"""
+        if 'domain' not in data and not self.context.get('api_key'):
+            raise serializers.ValidationError({'domain': 'This field is required without a valid X-API-Key.'})
+        return data
+
+class ScanTrendQuerySerializer(serializers.Serializer):
+    domain = serializers.CharField(max_length=2048)
+    days = serializers.IntegerField(required=False, default=90, min_value=1, max_value=settings.SCAN_TREND_MAX_DAYS)
+    bucket = serializers.ChoiceField(choices=('day', 'week'), required=False, default='day')
+
+class ScanHistorySerializer(serializers.ModelSerializer):
+    class Meta:
+        model = ScanRecord
+        fields = ('job_id', 'url', 'domain', 'status', 'score', 'grade', 'deep', 'created_at', 'finished_at')
+
+class ScanHistoryDetailSerializer(ScanHistorySerializer):
+    class Meta(ScanHistorySerializer.Meta):
+        fields = ScanHistorySerializer.Meta.fields + ('result',)
@@ -0,0 +1,110 @@
+"""
+Single-flight coalescing of scans for the same URL.
+
+The first submission of a normalized URL becomes the leader and records its
+job_id under ``scan_inflight:{url}`` with a lease. Later submissions are mapped
+to the leader's job_id while the lease is held. The worker renews the lease on
+every progress tick and releases it when the scan finishes, so a worker that
+dies mid-scan stops blocking new scans once SCAN_INFLIGHT_TTL expires.
+
+All state lives in Redis and is changed by Lua scripts, so the behaviour is the
+same across gunicorn workers and API replicas.
+"""
+from django.conf import settings
+from .scan_cache import normalize_url
+
+# Become leader unless one is already recorded; returns the leader's job_id
+CLAIM_SCRIPT = """
+local leader = redis.call('GET', KEYS[1])
+if leader then
+    return leader
+end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+return ARGV[1]
+"""
+
+# Replace a stale leader, but only if it is still the one we inspected
+TAKEOVER_SCRIPT = """
+local leader = redis.call('GET', KEYS[1])
+if leader and leader ~= ARGV[1] then
+    return leader
+end
+redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+return ARGV[2]
+"""
+
+# Renew the lease if we still hold it
+REFRESH_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# Drop the lease if we still hold it
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+# Scan statuses for which a leader is still doing work
+ACTIVE_STATUSES = ('queued', 'running')
+
+
+class SingleFlight:
+    """Redis-backed map from normalized URL to the job currently scanning it"""
+
+    def __init__(self, redis_client):
+        self.redis_client = redis_client
+        self.ttl = settings.SCAN_INFLIGHT_TTL
+        self._claim = redis_client.register_script(CLAIM_SCRIPT)
+        self._takeover = redis_client.register_script(TAKEOVER_SCRIPT)
+        self._refresh = redis_client.register_script(REFRESH_SCRIPT)
+        self._release = redis_client.register_script(RELEASE_SCRIPT)
+
+    def _key(self, url):
+        return f'scan_inflight:{normalize_url(url)}'
+
+    def claim(self, url, job_id, convex_client):
+        """
+        Try to lead the scan of ``url`` as ``job_id``.
+
+        Returns ``job_id`` when this submission leads, otherwise the job_id of
+        the scan already in progress. A recorded leader whose scan record is
+        missing or finished is treated as stale and replaced.
+        """
+        key = self._key(url)
+        leader = self._decode(self._claim(keys=[key], args=[job_id, self.ttl]))
+
+        # Bounded: each pass either returns or observes a newer leader
+        for _ in range(3):
+            if leader == job_id:
+                return job_id
+
+            scan_data = convex_client.get_scan(leader)
+            if scan_data and scan_data.get('status') in ACTIVE_STATUSES:
+                return leader
+
+            leader = self._decode(self._takeover(keys=[key], args=[leader, job_id, self.ttl]))
+
+        return leader
+
+    def refresh(self, url, job_id):
+        """Renew the lease held by ``job_id``"""
+        try:
+            self._refresh(keys=[self._key(url)], args=[job_id, self.ttl])
+        except Exception as e:
+            print(f"Redis error: {e}")
+
+    def release(self, url, job_id):
+        """Release the lease held by ``job_id`` once its scan has finished"""
+        try:
+            self._release(keys=[self._key(url)], args=[job_id])
+        except Exception as e:
+            print(f"Redis error: {e}")
+
+    @staticmethod
+    def _decode(value):
+        return value.decode() if isinstance(value, bytes) else value
@@ -1,135 +1,342 @@
+import asyncio
+import select
 import ssl
 import socket
-import dns.resolver
-import requests
 from urllib.parse import urlparse
 from celery import shared_task
+from celery.exceptions import Retry
 from django.conf import settings
+from django.db import DatabaseError
 from .convex_client import ConvexClient
+from .http_fetch import PageFetch
+from . import fingerprints, metrics, resolver, scan_history, tracing
+from .rescan import Rescan, RescanBaselines
+from .scan_cache import ScanCache
+from .single_flight import SingleFlight
+from .host_limiter import HostLimiter, target_host
+from .tls_deep import analyze_tls_deep
+from .tls_cache import certificate_details, get_session, get_ssl_context, store_session
+from .scan_errors import TRANSIENT, backoff_delay, classify_error, error_section
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import TimeoutError as FuturesTimeoutError
 
-@shared_task(bind=True)
-def scan_website_task(self, job_id, url):
-    """Main security scanning task"""
+# Retries aren't capped by Celery: host deferrals are unlimited and failure
+# retries are bounded by SCAN_MAX_RETRIES below
+@shared_task(bind=True, max_retries=None)
+def scan_website_task(self, job_id, url, deferred=0, deep=False, incremental=False):
+    """
+    Main security scanning task.
+    
+    When the target host already has SCAN_HOST_CONCURRENCY scans in flight,
+    or its last scan started too recently, the task re-queues itself with a
+    countdown instead of holding the worker; ``deferred`` counts those
+    re-queues so they don't use up the retries meant for failures.
+    
+    Each finished phase is checkpointed in the scan record. Phases that fail
+    transiently are retried with exponential backoff, up to SCAN_MAX_RETRIES
+    times, and a retry only reruns the phases that haven't succeeded yet.
+    
+    ``deep`` adds the ``tls_deep`` phase, which enumerates the protocols and
+    cipher suites the server accepts.
+    
+    ``incremental`` reuses the sections of the URL's previous incremental
+    scan that cheap checks show unchanged (``rescan.py``).
+    """
+    tracing.annotate({
+        'scan.job_id': job_id, 'scan.url': url, 'scan.deep': deep,
+        'scan.incremental': incremental, 'scan.deferred': deferred,
+    })
     convex_client = ConvexClient()
+    single_flight = SingleFlight(convex_client.redis_client)
+    host_limiter = HostLimiter(convex_client.redis_client)
+    host = target_host(url)
+    
+    wait = host_limiter.acquire(host, job_id)
+    if wait:
+        # Keep the in-flight lease while the scan waits for its host
+        single_flight.refresh(url, job_id)
+        raise self.retry(kwargs={**self.request.kwargs, 'deferred': deferred + 1}, countdown=wait)
+    
+    # Failure retries so far; host deferrals go through self.retry too
+    attempt = self.request.retries - deferred
     
     try:
-        # Update status to running
-        convex_client.update_scan(job_id, status='running', progress=10)
+        phase_names = PHASE_NAMES + ('tls_deep',) if deep else PHASE_NAMES
         
-        result = {
-            'tls': {},
-            'headers': {},
-            'dns': {},
-            'fingerprinting': {},
-            'score': 0
-        }
+        # Carry over the phases an earlier attempt already finished
+        result = resume_result(convex_client.get_scan(job_id) if self.request.retries else None, phase_names)
+        pending = [name for name in phase_names if not phase_done(result[name])]
+        checkpointed = len(phase_names) - len(pending)
+        
+        # Update status to running
+        convex_client.update_scan(job_id, status='running', progress=phase_progress(checkpointed, len(phase_names)), result=result)
+        single_flight.refresh(url, job_id)
         
         # Parse URL
         parsed_url = urlparse(url)
         domain = parsed_url.hostname
         
-        # 1. TLS/SSL Analysis (20% of progress)
-        try:
-            tls_result = analyze_tls(domain, parsed_url.port or 443)
-            result['tls'] = tls_result
-            convex_client.update_scan(job_id, progress=30, result=result)
-        except Exception as e:
-            result['tls'] = {'error': str(e)}
+        # Compare against the previous incremental scan of this URL
+        rescan = Rescan(RescanBaselines(convex_client.redis_client).get(url)) if incremental else None
         
-        # 2. HTTP Headers Analysis (30% of progress)
-        try:
-            headers_result = analyze_headers(url)
-            result['headers'] = headers_result
-            convex_client.update_scan(job_id, progress=50, result=result)
-        except Exception as e:
-            result['headers'] = {'error': str(e)}
+        # Headers and fingerprinting share a single fetch of the page
+        page = PageFetch(url, rescan.request_headers() if rescan else None)
         
-        # 3. DNS Analysis (20% of progress)
-        try:
-            dns_result = analyze_dns(domain)
-            result['dns'] = dns_result
-            convex_client.update_scan(job_id, progress=70, result=result)
-        except Exception as e:
-            result['dns'] = {'error': str(e)}
+        # Analyzer phases are independent, so run them concurrently and
+        # bound the whole scan by SCAN_DEADLINE instead of per-phase timeouts
+        phases = {
+            'tls': (analyze_tls, (domain, parsed_url.port or 443)),
+            'headers': (analyze_headers, (url, page)),
+            'dns': (analyze_dns, (domain,)),
+            'fingerprinting': (analyze_fingerprinting, (url, page)),
+            'tls_deep': (analyze_tls_deep, (domain, parsed_url.port or 443)),
+        }
+        phases = {name: phases[name] for name in pending}
+        if rescan:
+            phases = rescan.wrap(phases, result)
         
-        # 4. Fingerprinting (10% of progress)
         try:
-            fingerprint_result = analyze_fingerprinting(url)
-            result['fingerprinting'] = fingerprint_result
-            convex_client.update_scan(job_id, progress=80, result=result)
-        except Exception as e:
-            result['fingerprinting'] = {'error': str(e)}
+            # Deep scans run every phase at once so the slow tls_deep phase never queues
+            workers = len(phases) if deep else None
+            for name, phase_result, completed in run_phases(phases, settings.SCAN_DEADLINE, workers):
+                result[name] = phase_result
+                progress = phase_progress(checkpointed + completed, len(phase_names))
+                convex_client.update_scan(job_id, progress=progress, sections={name: phase_result})
+                single_flight.refresh(url, job_id)
+        finally:
+            page.close()
         
-        # 5. Calculate Security Score
-        score = calculate_security_score(result)
-        result['score'] = score
+        # Retry phases that failed transiently; the rest stay checkpointed in the record
+        if attempt < settings.SCAN_MAX_RETRIES and not all(phase_done(result[name]) for name in phase_names):
+            convex_client.update_scan(job_id, status='queued')
+            raise self.retry(countdown=backoff_delay(attempt))
         
-        # Ensure the result object is properly updated with all scoring data
-        final_result = {
-            'tls': result.get('tls', {}),
-            'headers': result.get('headers', {}),
-            'dns': result.get('dns', {}),
-            'fingerprinting': result.get('fingerprinting', {}),
-            'score': score,
-            'grade': result.get('grade', 'N/A'),
-            'score_breakdown': result.get('score_breakdown', {})
-        }
+        # Calculate Security Score
+        final_result = finalize_result(result)
         
-        # Update final result with enhanced scoring
-        convex_client.update_scan(job_id, status='done', progress=100, result=final_result)
+        sections = scoring_sections(final_result)
+        if rescan:
+            final_result['rescan'] = sections['rescan'] = rescan.summary()
+            RescanBaselines(convex_client.redis_client).set(url, rescan.next_baseline(job_id, final_result))
         
-        # Also update the return value to include the enhanced scoring
-        result.update({
-            'score': score,
-            'grade': result.get('grade', 'N/A'),
-            'score_breakdown': result.get('score_breakdown', {})
-        })
+        # Update final result with enhanced scoring
+        convex_client.update_scan(job_id, status='done', progress=100, sections=sections)
+        if not deep and not incremental:
+            # Deep results are scored differently and incremental ones carry
+            # reused sections and rescan bookkeeping, so only full regular
+            # scans are served to regular scans
+            ScanCache(convex_client.redis_client).set(url, final_result)
+        single_flight.release(url, job_id)
+        persist_later(job_id)
         
         return {'status': 'completed', 'result': result}
         
+    except Retry:
+        raise
+    
     except Exception as e:
-        # Update with error status
-        convex_client.update_scan(job_id, status='error', result={'error': str(e)})
-        raise self.retry(exc=e, countdown=60, max_retries=3)
+        error_kind = classify_error(e)
+        if error_kind == TRANSIENT and attempt < settings.SCAN_MAX_RETRIES:
+            convex_client.update_scan(job_id, status='queued')
+            single_flight.refresh(url, job_id)
+            raise self.retry(exc=e, countdown=backoff_delay(attempt))
+        
+        # Update with error status, keeping the phases checkpointed so far
+        tracing.mark_error(e)
+        convex_client.update_scan(job_id, status='error', sections={'error': str(e), 'error_kind': error_kind})
+        single_flight.release(url, job_id)
+        persist_later(job_id)
+        return {'status': 'error', 'error': str(e), 'error_kind': error_kind}
+    
+    finally:
+        host_limiter.release(host, job_id)
+
+@shared_task(bind=True)
+def scan_batch_async_task(self, jobs, deep=False, incremental=False):
+    """
+    Run many scans inside one worker process on the asyncio engine.
+    
+    ``jobs`` is a list of ``[job_id, url]`` pairs whose scan records already
+    exist; at most ASYNC_SCAN_CONCURRENCY of them are in flight at once.
+    The engine rejects ``deep`` and ``incremental`` scans, which only
+    ``scan_website_task`` runs.
+    """
+    from .async_engine import run_scans
+    return asyncio.run(run_scans(jobs, deep=deep, incremental=incremental))
+
+@shared_task
+def finalize_batch_task(batch_id):
+    """Chord callback run once every scan of a batch has finished"""
+    ConvexClient().finish_batch(batch_id)
+    return {'status': 'completed', 'batch_id': batch_id}
+
+@shared_task(autoretry_for=(DatabaseError,), retry_backoff=True, max_retries=5)
+def persist_scan_task(job_id, finished_at):
+    """Copy a finished scan from Redis into the scan history table (``scan_history.py``)"""
+    scan_data = ConvexClient().get_scan(job_id)
+    if not scan_data or scan_data.get('status') not in ('done', 'error'):
+        return {'status': 'skipped', 'job_id': job_id}
+    scan_history.save_scan(scan_data, finished_at)
+    return {'status': 'saved', 'job_id': job_id}
+
+def persist_later(job_id):
+    """Queue a finished scan for the history table; failing to queue never fails the scan"""
+    if not settings.SCAN_HISTORY:
+        return
+    try:
+        persist_scan_task.delay(job_id, time.time())
+    except Exception as e:
+        print(f"Scan history error: {e}")
+
+# Analyzer phases, in the order their sections appear in the result
+PHASE_NAMES = ('tls', 'headers', 'dns', 'fingerprinting')
+
+def phase_done(phase_result):
+    """Whether a phase result is final: present and not a transient failure worth retrying"""
+    return bool(phase_result) and phase_result.get('error_kind') != TRANSIENT
+
+def resume_result(scan_data, phase_names=PHASE_NAMES):
+    """Empty result carrying over the finished phases of a previous attempt's record"""
+    saved = (scan_data or {}).get('result') or {}
+    result = {name: saved[name] if phase_done(saved.get(name)) else {} for name in phase_names}
+    result['score'] = 0
+    return result
+
+def phase_progress(completed, total):
+    """Progress moves from 10% to 80% as each analyzer phase finishes"""
+    return 10 + (70 * completed) // total
+
+def finalize_result(result):
+    """Score a scan result in place and return it with the scoring fields set"""
+    score = calculate_security_score(result)
+    result.update({
+        'score': score,
+        'grade': result.get('grade', 'N/A'),
+        'score_breakdown': result.get('score_breakdown', {})
+    })
+    return result
+
+def scoring_sections(result):
+    """The result keys written once scoring is done; analyzer sections are already stored"""
+    return {key: result[key] for key in ('score', 'grade', 'score_breakdown')}
+
+def run_phases(phases, deadline, workers=None):
+    """
+    Run analyzer phases concurrently on a bounded thread pool of
+    ``workers`` threads (SCAN_PHASE_WORKERS by default).
+    
+    ``phases`` maps a phase name to a ``(function, args)`` tuple. Yields
+    ``(name, result, completed)`` as each phase finishes; phases still
+    running when ``deadline`` seconds have elapsed yield a timeout error.
+    """
+    max_workers = max(1, min(workers or settings.SCAN_PHASE_WORKERS, len(phases)))
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='scan-phase')
+    futures = {executor.submit(tracing.bind_context(_timed_phase), func, args): name for name, (func, args) in phases.items()}
+    finished = set()
+    
+    def _result(name, future):
+        phase_result, seconds = future.result()
+        metrics.observe_phase(name, phase_result, seconds)
+        return phase_result
+    
+    try:
+        try:
+            for future in as_completed(futures, timeout=deadline):
+                finished.add(future)
+                yield futures[future], _result(futures[future], future), len(finished)
+        except FuturesTimeoutError:
+            for future, name in futures.items():
+                if future in finished:
+                    continue
+                finished.add(future)
+                if future.done():
+                    yield name, _result(name, future), len(finished)
+                else:
+                    phase_result = {'error': f'Scan deadline of {deadline}s exceeded', 'error_kind': TRANSIENT}
+                    metrics.observe_phase(name, phase_result, deadline)
+                    yield name, phase_result, len(finished)
+    finally:
+        # Don't wait for stragglers; their sockets are bounded by SCAN_TIMEOUT
+        executor.shutdown(wait=False, cancel_futures=True)
+
+def _timed_phase(func, args):
+    """Run one phase in its own span, returning ``(result, seconds)``"""
+    started = time.monotonic()
+    with tracing.span(func.__name__):
+        try:
+            phase_result = func(*args)
+        except Exception as e:
+            phase_result = error_section(e)
+        tracing.record_outcome(phase_result)
+    return phase_result, time.monotonic() - started
 
 def analyze_tls(domain, port=443):
-    """Analyze TLS/SSL configuration"""
-    result = {
-        'valid': False,
-        'certificate_valid': False,
-        'expiry_date': None,
-        'issuer': None,
-        'protocol_version': None,
-        'cipher_suite': None
-    }
+    """Analyze TLS/SSL configuration, resuming the last session with the same host if possible"""
+    result = new_tls_result()
     
     try:
-        # Create SSL context
-        context = ssl.create_default_context()
-        context.check_hostname = True
-        context.verify_mode = ssl.CERT_REQUIRED
+        # One verifying context per process instead of reloading the CA store
+        context = get_ssl_context()
         
-        # Connect and get certificate info
+        # Connect, then time the handshake on its own
         with socket.create_connection((domain, port), timeout=settings.SCAN_TIMEOUT) as sock:
-            with context.wrap_socket(sock, server_hostname=domain) as ssock:
-                cert = ssock.getpeercert()
-                cipher = ssock.cipher()
-                
-                result['valid'] = True
-                result['certificate_valid'] = True
-                result['expiry_date'] = cert.get('notAfter')
-                result['issuer'] = cert.get('issuer', {}).get('organizationName', 'Unknown')
-                result['protocol_version'] = ssock.version()
-                result['cipher_suite'] = cipher[0] if cipher else None
+            with context.wrap_socket(sock, server_hostname=domain, session=get_session(domain, port), do_handshake_on_connect=False) as ssock:
+                started = time.monotonic()
+                ssock.do_handshake()
+                result['handshake_ms'] = round((time.monotonic() - started) * 1000, 2)
+                describe_tls_session(result, ssock, domain, port)
+                if ssock.version() == 'TLSv1.3':
+                    read_session_tickets(ssock, min(result['handshake_ms'] / 1000, 0.25))
+                store_session(domain, port, ssock.session)
                 
     except Exception as e:
-        result['error'] = str(e)
+        result.update(error_section(e))
     
     return result
 
-def analyze_headers(url):
-    """Analyze HTTP security headers"""
+def read_session_tickets(ssock, wait):
+    """
+    TLS 1.3 servers send session tickets after the handshake and OpenSSL only
+    processes them on a read. Wait up to ``wait`` seconds (about one round
+    trip) for them to arrive so the session can be resumed next time.
+    """
+    if select.select([ssock], [], [], wait)[0]:
+        ssock.setblocking(False)
+        try:
+            ssock.recv(1)
+        except (ssl.SSLWantReadError, ssl.SSLWantWriteError, OSError):
+            pass
+
+def new_tls_result():
+    """Empty TLS result shared by the sync and async engines"""
+    return {
+        'valid': False,
+        'certificate_valid': False,
+        'expiry_date': None,
+        'issuer': None,
+        'protocol_version': None,
+        'cipher_suite': None,
+        'serial_number': None,
+        'fingerprint_sha256': None,
+        'handshake_ms': None,
+        'session_reused': False
+    }
+
+def describe_tls_session(result, ssock, host, port):
+    """Fill a TLS result from an established SSLSocket or SSLObject"""
+    cipher = ssock.cipher()
+    
+    result['valid'] = True
+    result['certificate_valid'] = True
+    result.update(certificate_details(host, port, ssock))
+    result['protocol_version'] = ssock.version()
+    result['cipher_suite'] = cipher[0] if cipher else None
+    result['session_reused'] = ssock.session_reused
+    metrics.observe_handshake(result)
+
+def analyze_headers(url, page=None):
+    """Analyze HTTP security headers, reusing the scan's shared ``page`` fetch if given"""
     result = {
         'security_headers': {},
         'missing_headers': [],
@@ -147,8 +354,8 @@ def analyze_headers(url):
     }
     
     try:
-        response = requests.get(url, timeout=settings.SCAN_TIMEOUT, allow_redirects=True)
-        headers = response.headers
+        response = (page or PageFetch(url)).head()
+        headers = response['headers']
         
         for header, name in security_headers.items():
             if header in headers:
@@ -165,73 +372,65 @@ def analyze_headers(url):
             result['recommendations'].append('Add X-Frame-Options to prevent clickjacking')
             
     except Exception as e:
-        result['error'] = str(e)
+        result.update(error_section(e))
     
     return result
 
-def analyze_dns(domain):
-    """Analyze DNS configuration"""
-    result = {
-        'a_records': [],
-        'aaaa_records': [],
-        'mx_records': [],
-        'ns_records': [],
-        'txt_records': [],
-        'dnssec': False
-    }
+# Record types looked up by the DNS analysis and their result keys
+DNS_RECORD_TYPES = (
+    ('A', 'a_records'),
+    ('AAAA', 'aaaa_records'),
+    ('MX', 'mx_records'),
+    ('NS', 'ns_records'),
+    ('TXT', 'txt_records'),
+)
+
+def build_dns_result(lookups):
+    """
+    Assemble the DNS result from ``{record_type: (records, error, elapsed_ms)}``
+    lookups, adding per-record-type timings and errors.
+    """
+    result = {key: [] for _, key in DNS_RECORD_TYPES}
+    result['dnssec'] = False
+    result['lookup_ms'] = {}
+    result['lookup_errors'] = {}
     
-    try:
-        # A records
-        try:
-            a_records = dns.resolver.resolve(domain, 'A')
-            result['a_records'] = [str(record) for record in a_records]
-        except:
-            pass
-        
-        # AAAA records
-        try:
-            aaaa_records = dns.resolver.resolve(domain, 'AAAA')
-            result['aaaa_records'] = [str(record) for record in aaaa_records]
-        except:
-            pass
-        
-        # MX records
-        try:
-            mx_records = dns.resolver.resolve(domain, 'MX')
-            result['mx_records'] = [str(record) for record in mx_records]
-        except:
-            pass
-        
-        # NS records
-        try:
-            ns_records = dns.resolver.resolve(domain, 'NS')
-            result['ns_records'] = [str(record) for record in ns_records]
-        except:
-            pass
-        
-        # TXT records
-        try:
-            txt_records = dns.resolver.resolve(domain, 'TXT')
-            result['txt_records'] = [str(record) for record in txt_records]
-        except:
-            pass
-            
-    except Exception as e:
-        result['error'] = str(e)
+    for record_type, key in DNS_RECORD_TYPES:
+        records, error, elapsed_ms = lookups[record_type]
+        result[key] = records
+        result['lookup_ms'][record_type] = elapsed_ms
+        if error:
+            result['lookup_errors'][record_type] = error
     
     return result
 
-def analyze_fingerprinting(url):
-    """Analyze server fingerprinting"""
+def analyze_dns(domain):
+    """Analyze DNS configuration, resolving all record types concurrently"""
+    with ThreadPoolExecutor(max_workers=len(DNS_RECORD_TYPES), thread_name_prefix='scan-dns') as executor:
+        futures = {
+            record_type: executor.submit(tracing.bind_context(resolver.lookup), domain, record_type)
+            for record_type, _ in DNS_RECORD_TYPES
+        }
+        return build_dns_result({record_type: future.result() for record_type, future in futures.items()})
+
+def analyze_fingerprinting(url, page=None):
+    """
+    Analyze server fingerprinting, reusing the scan's shared ``page`` fetch if
+    given. Besides the server headers, technologies are detected with the
+    signature index (``fingerprints.py``), which reads the page body when it
+    has body signatures.
+    """
     result = {
         'server': None,
         'powered_by': None,
-        'technologies': []
+        'technologies': [],
+        'detections': []
     }
     
     try:
-        response = requests.get(url, timeout=settings.SCAN_TIMEOUT, allow_redirects=True)
-        headers = response.headers
+        fetch = page or PageFetch(url)
+        response = fetch.head()
+        headers = response['headers']
         
         # Server header
         if 'Server' in headers:
@@ -261,12 +460,20 @@ def analyze_fingerprinting(url):
             result['technologies'].append('Drupal')
         if 'X-Generator' in headers:
             result['technologies'].append(headers['X-Generator'])
+        
+        index = fingerprints.get_index()
+        result['detections'] = index.detect(fetch.get() if index.needs_body else response)
+        known = {technology.lower() for technology in result['technologies']}
+        for detection in result['detections']:
+            if detection['name'].lower() not in known:
+                result['technologies'].append(detection['name'])
             
     except Exception as e:
-        result['error'] = str(e)
+        result.update(error_section(e))
     
     return result
 
+@tracing.traced()
 def calculate_security_score(result):
     """
     Calculate enhanced security score (0-100) with weighted points system
@@ -279,6 +486,9 @@ def calculate_security_score(result):
     +10 pts: DNSSEC or secure DNS record detected
     +10 pts: HTTPS redirection enforced
     +10 pts: Server fingerprint identified
+    
+    Deep scans deduct up to 30 pts more: -10 for TLS 1.0/1.1 support, -10
+    for weak cipher suites, -5 for a weak key, -5 for an incomplete chain.
     """
     score = 0
     max_score = 100
@@ -342,8 +552,23 @@ def calculate_security_score(result):
     score += bonus
     score_breakdown['bonus_points'] = bonus
     
-    # Ensure score doesn't exceed 100
-    final_score = min(score, max_score)
+    # Deep TLS findings, only when a deep scan ran
+    tls_deep = result.get('tls_deep') or {}
+    if tls_deep and not tls_deep.get('error'):
+        penalty = 0
+        if tls_deep.get('weak_protocols'):
+            penalty += 10
+        if tls_deep.get('weak_ciphers'):
+            penalty += 10
+        if tls_deep.get('weak_key'):
+            penalty += 5
+        if tls_deep.get('chain_complete') is False:
+            penalty += 5
+        score -= penalty
+        score_breakdown['tls_configuration'] = -penalty
+    
+    # Ensure score stays within 0-100
+    final_score = max(0, min(score, max_score))
     
     # Add score breakdown to result
     result['score_breakdown'] = score_breakdown
@@ -0,0 +1,791 @@
+import asyncio
+import datetime
+import io
+import json
+import os
+import socket
+import ssl
+import tempfile
+import threading
+import time
+from unittest import mock
+import fakeredis
+import fakeredis.aioredis
+import redis
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
+from django.conf import settings
+from django.core.management import call_command
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from rest_framework.request import Request
+from rest_framework.response import Response
+from rest_framework.views import APIView
+from . import async_engine, codec, convex_client, fingerprints, http_fetch, metrics, scan_events, tasks, throttles, tls_deep
+from .benchmark import MockFarm
+from .management.commands.migrate_scan_records import REENCODE_SCRIPT
+from .models import ScanRecord
+from .rescan import Rescan
+from .scan_errors import PERMANENT, TRANSIENT, error_section
+from .single_flight import SingleFlight
+from .throttles import ScanRateThrottle
+
+
+@override_settings(SCAN_MAX_RETRIES=3)
+class HostDeferralTests(SimpleTestCase):
+    """Host deferrals re-queue the scan without using up its retries"""
+
+    def test_scan_deferred_more_than_celery_default_retries(self):
+        deferrals = 6
+        host_limiter = mock.Mock()
+        host_limiter.acquire.side_effect = [5] * deferrals + [0]
+        convex_client = mock.Mock()
+        convex_client.get_scan.return_value = None
+        phase_results = {'error': None}
+
+        def run_phases(phases, deadline, workers=None):
+            for completed, name in enumerate(phases, 1):
+                yield name, dict(phase_results), completed
+
+        with mock.patch.object(tasks, 'ConvexClient', return_value=convex_client), \
+                mock.patch.object(tasks, 'SingleFlight'), \
+                mock.patch.object(tasks, 'HostLimiter', return_value=host_limiter), \
+                mock.patch.object(tasks, 'PageFetch'), \
+                mock.patch.object(tasks, 'ScanCache'), \
+                mock.patch.object(tasks, 'persist_later'), \
+                mock.patch.object(tasks, 'run_phases', side_effect=run_phases):
+            outcome = tasks.scan_website_task.apply(args=('job', 'https://example.com/'))
+
+        self.assertNotIsInstance(outcome.result, Exception)
+        self.assertEqual(host_limiter.acquire.call_count, deferrals + 1)
+        statuses = [call.kwargs.get('status') for call in convex_client.update_scan.call_args_list]
+        self.assertEqual(statuses[-1], 'done')
+
+
+class ScanOptionTests(SimpleTestCase):
+    """How deep and incremental scans run differently from regular ones"""
+
+    def scan(self, **options):
+        convex_client = mock.Mock()
+        convex_client.get_scan.return_value = None
+        host_limiter = mock.Mock()
+        host_limiter.acquire.return_value = 0
+        scan_cache = mock.Mock()
+        baselines = mock.Mock()
+        baselines.get.return_value = None
+        self.workers = []
+
+        def run_phases(phases, deadline, workers=None):
+            self.workers.append(workers)
+            for completed, name in enumerate(phases, 1):
+                yield name, {'error': None}, completed
+
+        with mock.patch.object(tasks, 'ConvexClient', return_value=convex_client), \
+                mock.patch.object(tasks, 'SingleFlight'), \
+                mock.patch.object(tasks, 'HostLimiter', return_value=host_limiter), \
+                mock.patch.object(tasks, 'PageFetch'), \
+                mock.patch.object(tasks, 'RescanBaselines', return_value=baselines), \
+                mock.patch.object(tasks, 'ScanCache', return_value=scan_cache), \
+                mock.patch.object(tasks, 'persist_later'), \
+                mock.patch.object(tasks, 'run_phases', side_effect=run_phases):
+            tasks.scan_website_task.apply(args=('job', 'https://example.com/'), kwargs=options)
+        return scan_cache.set.call_args_list
+
+    def test_regular_scan_cached(self):
+        self.assertEqual(len(self.scan()), 1)
+
+    def test_incremental_and_deep_scans_not_cached(self):
+        self.assertEqual(self.scan(incremental=True), [])
+        self.assertEqual(self.scan(deep=True), [])
+
+    def test_deep_scan_runs_every_phase_at_once(self):
+        self.scan(deep=True)
+        self.assertEqual(self.workers, [5])
+        self.scan()
+        self.assertEqual(self.workers, [None])
+
+
+class WeakCipherProbeTests(SimpleTestCase):
+    """Deep TLS probes can negotiate the weak suites they look for"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'localhost')])
+        now = datetime.datetime.now(datetime.timezone.utc)
+        cert = (
+            x509.CertificateBuilder()
+            .subject_name(name)
+            .issuer_name(name)
+            .public_key(key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(now - datetime.timedelta(days=1))
+            .not_valid_after(now + datetime.timedelta(days=1))
+            .sign(key, hashes.SHA256())
+        )
+        cls.directory = tempfile.TemporaryDirectory()
+        cert_path = os.path.join(cls.directory.name, 'cert.pem')
+        key_path = os.path.join(cls.directory.name, 'key.pem')
+        with open(cert_path, 'wb') as f:
+            f.write(cert.public_bytes(serialization.Encoding.PEM))
+        with open(key_path, 'wb') as f:
+            f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()))
+
+        # Only accepts TLS 1.2 with a NULL cipher or plain AES
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.minimum_version = context.maximum_version = ssl.TLSVersion.TLSv1_2
+        context.set_ciphers('NULL-SHA:AES128-SHA:@SECLEVEL=0')
+        context.load_cert_chain(cert_path, key_path)
+        cls.server = socket.create_server(('127.0.0.1', 0))
+        cls.port = cls.server.getsockname()[1]
+
+        def serve():
+            while True:
+                try:
+                    sock, _ = cls.server.accept()
+                except OSError:
+                    return
+                threading.Thread(target=handshake, args=(sock,), daemon=True).start()
+
+        def handshake(sock):
+            try:
+                with context.wrap_socket(sock, server_side=True):
+                    pass
+            except (ssl.SSLError, OSError):
+                sock.close()
+
+        threading.Thread(target=serve, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.close()
+        cls.directory.cleanup()
+        super().tearDownClass()
+
+    def test_null_cipher_reported_weak(self):
+        chain = {'chain_length': 1, 'chain_complete': False, 'ocsp_stapled': None}
+        with mock.patch.object(tls_deep, '_chain_openssl', return_value=chain), \
+                mock.patch.object(tls_deep, '_chain_ssl', return_value=chain):
+            result = tls_deep.analyze_tls_deep('127.0.0.1', self.port)
+
+        self.assertNotIn('error', result)
+        self.assertTrue(result['protocols']['TLSv1.2'])
+        self.assertIn('NULL-SHA', result['ciphers']['TLSv1.2'])
+        self.assertIn('NULL-SHA', result['weak_ciphers'])
+        self.assertNotIn('AES128-SHA', result['weak_ciphers'])
+
+
+class ThrottleIdentityTests(SimpleTestCase):
+    """Per-IP buckets can't be picked by a client-supplied X-Forwarded-For"""
+
+    def bucket(self, **meta):
+        request = Request(RequestFactory().post('/api/scan/', **meta))
+        return ScanRateThrottle().get_bucket(request)[0]
+
+    def test_forwarded_for_ignored_without_proxies(self):
+        direct = self.bucket(REMOTE_ADDR='203.0.113.7')
+        spoofed = self.bucket(REMOTE_ADDR='203.0.113.7', HTTP_X_FORWARDED_FOR='198.51.100.1')
+        self.assertEqual(spoofed, direct)
+
+    def test_proxy_appended_address_used_behind_proxy(self):
+        rest_framework = {**settings.REST_FRAMEWORK, 'NUM_PROXIES': 1}
+        with override_settings(REST_FRAMEWORK=rest_framework):
+            first = self.bucket(REMOTE_ADDR='10.0.0.2', HTTP_X_FORWARDED_FOR='198.51.100.1, 203.0.113.7')
+            second = self.bucket(REMOTE_ADDR='10.0.0.2', HTTP_X_FORWARDED_FOR='192.0.2.99, 203.0.113.7')
+        self.assertEqual(first, second)
+        self.assertTrue(first.endswith(':203.0.113.7'))
+
+
+class FetchDeadlineTests(SimpleTestCase):
+    """The page fetch deadline covers the response headers and the body"""
+
+    def serve(self, prefix):
+        """URL of a server answering with ``prefix`` then one more byte every 100ms, forever"""
+        server = socket.create_server(('127.0.0.1', 0))
+        self.addCleanup(server.close)
+        stop = threading.Event()
+        self.addCleanup(stop.set)
+
+        def drip():
+            sock, _ = server.accept()
+            with sock:
+                sock.recv(65536)
+                try:
+                    sock.sendall(prefix)
+                    while not stop.wait(0.1):
+                        sock.sendall(b'X')
+                except OSError:
+                    pass
+
+        threading.Thread(target=drip, daemon=True).start()
+        return f'http://127.0.0.1:{server.getsockname()[1]}/'
+
+    @override_settings(SCAN_FETCH_DEADLINE=1, SCAN_TIMEOUT=5)
+    def test_slow_headers_abort_at_deadline(self):
+        url = self.serve(b'HTTP/1.1 200 OK\r\n')
+        started = time.monotonic()
+        with self.assertRaises(TimeoutError):
+            http_fetch.PageFetch(url).head()
+        self.assertLess(time.monotonic() - started, 3)
+
+    @override_settings(SCAN_FETCH_DEADLINE=1, SCAN_TIMEOUT=5)
+    def test_slow_body_truncated_at_deadline(self):
+        url = self.serve(b'HTTP/1.1 200 OK\r\nContent-Type: text/html\r\nContent-Length: 100000\r\n\r\n<html>')
+        started = time.monotonic()
+        page = http_fetch.PageFetch(url).get()
+        self.assertLess(time.monotonic() - started, 3)
+        self.assertEqual(page['status_code'], 200)
+        self.assertTrue(page['body_truncated'])
+        self.assertLess(len(page['body']), 100000)
+
+
+class ScanHistoryAccessTests(TestCase):
+    """Listing the history needs a domain filter or an API key, and is throttled"""
+
+    def setUp(self):
+        finished_at = timezone.now()
+        for job_id, url in (('job-a', 'https://a.example/'), ('job-b', 'https://b.example/')):
+            ScanRecord.objects.create(
+                job_id=job_id, url=url, domain=url.split('/')[2], status='done',
+                score=50, grade='D', result={}, created_at=finished_at, finished_at=finished_at,
+            )
+        self.allowed = True
+        bucket = mock.patch('app.throttles._script', return_value=lambda keys, args: [int(self.allowed), '1', '2', '2'])
+        bucket.start()
+        self.addCleanup(bucket.stop)
+
+    def test_listing_without_domain_rejected(self):
+        response = self.client.get('/api/history/')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('domain', response.json())
+
+    def test_listing_by_domain(self):
+        response = self.client.get('/api/history/', {'domain': 'a.example'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([scan['job_id'] for scan in response.json()['results']], ['job-a'])
+
+    @override_settings(API_KEYS=['secret'])
+    def test_listing_everything_with_api_key(self):
+        response = self.client.get('/api/history/', HTTP_X_API_KEY='secret')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()['results']), 2)
+        self.assertEqual(self.client.get('/api/history/', HTTP_X_API_KEY='wrong').status_code, 400)
+
+    def test_history_endpoints_throttled(self):
+        self.allowed = False
+        for path in ('/api/history/?domain=a.example', '/api/history/job-a/', '/api/history/trend/?domain=a.example'):
+            self.assertEqual(self.client.get(path).status_code, 429, path)
+
+
+class ScriptSrcDetectionTests(SimpleTestCase):
+    """scriptSrc signatures match script tags whatever their attributes"""
+
+    def detect(self, body):
+        index = fingerprints.load_index(settings.FINGERPRINT_SIGNATURES)
+        page = {'url': 'https://example.com/', 'headers': {}, 'cookies': {}, 'body': body}
+        return {technology['name'] for technology in index.detect(page)}
+
+    def test_bare_script_src(self):
+        detected = self.detect(
+            '<html><head><script src="https://js.stripe.com/v3/"></script>'
+            "<script src='https://static.hotjar.com/c/hotjar-1.js?sv=6'></script></head></html>"
+        )
+        self.assertIn('Stripe', detected)
+        self.assertIn('Hotjar', detected)
+
+    def test_script_src_after_other_attributes(self):
+        detected = self.detect('<script async type="text/javascript"\nsrc=https://js.stripe.com/v3/></script>')
+        self.assertIn('Stripe', detected)
+
+    def test_data_src_not_taken_for_src(self):
+        self.assertNotIn('Stripe', self.detect('<script data-src="https://js.stripe.com/v3/"></script>'))
+
+
+class ThrottledView(APIView):
+    throttle_classes = [ScanRateThrottle]
+
+    def post(self, request):
+        return Response({})
+
+
+@override_settings(
+    API_KEYS=['key-a', 'key-b'],
+    REST_FRAMEWORK={**settings.REST_FRAMEWORK, 'DEFAULT_THROTTLE_RATES': {'scan': '3/min', 'scan_api_key': '6/min'}},
+)
+class TokenBucketTests(SimpleTestCase):
+    """The Lua token bucket allows bursts up to capacity and refills at the rate"""
+
+    def setUp(self):
+        self.redis = fakeredis.FakeRedis()
+        for patcher in (
+            mock.patch.object(throttles, 'get_redis', return_value=self.redis),
+            mock.patch.object(throttles, '_token_bucket', None),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def post(self, ip='203.0.113.7', api_key=None):
+        meta = {'REMOTE_ADDR': ip}
+        if api_key:
+            meta['HTTP_X_API_KEY'] = api_key
+        return ThrottledView.as_view()(RequestFactory().post('/api/scan/', **meta))
+
+    def test_burst_up_to_capacity_then_429(self):
+        for _ in range(3):
+            self.assertEqual(self.post().status_code, 200)
+        response = self.post()
+        self.assertEqual(response.status_code, 429)
+        # One token per 20 seconds at 3/min
+        self.assertIn(int(response['Retry-After']), (19, 20))
+        self.assertIn('Rate limit exceeded', response.data['error'])
+
+    def test_refill_after_time_passes(self):
+        for _ in range(3):
+            self.post()
+        self.assertEqual(self.post().status_code, 429)
+
+        # Wind the bucket's clock back 45 seconds: two tokens at 3/min
+        key = 'throttle:scan:ip:203.0.113.7'
+        self.redis.hset(key, 'ts', float(self.redis.hget(key, 'ts')) - 45)
+        self.assertEqual(self.post().status_code, 200)
+        self.assertEqual(self.post().status_code, 200)
+        self.assertEqual(self.post().status_code, 429)
+
+    def test_separate_buckets_per_api_key_and_ip(self):
+        for _ in range(3):
+            self.post()
+        self.assertEqual(self.post().status_code, 429)
+        self.assertEqual(self.post(ip='198.51.100.1').status_code, 200)
+
+        # API keys get their own larger bucket, wherever the request comes from
+        for _ in range(6):
+            self.assertEqual(self.post(api_key='key-a').status_code, 200)
+        self.assertEqual(self.post(api_key='key-a').status_code, 429)
+        self.assertEqual(self.post(api_key='key-b').status_code, 200)
+
+
+class SingleFlightTests(SimpleTestCase):
+    """Concurrent submissions of one URL share a leader until its lease ends"""
+
+    url = 'https://Example.com/login'
+    key = 'scan_inflight:https://example.com/login'
+
+    def setUp(self):
+        self.redis = fakeredis.FakeRedis()
+        self.single_flight = SingleFlight(self.redis)
+        self.statuses = {}
+        self.convex_client = mock.Mock()
+        self.convex_client.get_scan.side_effect = lambda job_id: (
+            {'status': self.statuses[job_id]} if job_id in self.statuses else None
+        )
+
+    def claim(self, job_id, url=None):
+        self.statuses.setdefault(job_id, 'queued')
+        return self.single_flight.claim(url or self.url, job_id, self.convex_client)
+
+    def test_join_while_in_flight(self):
+        self.assertEqual(self.claim('leader'), 'leader')
+        self.assertEqual(self.claim('second', 'https://example.com:443/login?utm=1'), 'leader')
+        self.statuses['leader'] = 'running'
+        self.assertEqual(self.claim('third'), 'leader')
+        # Another URL gets its own scan
+        self.assertEqual(self.claim('other', 'https://example.com/'), 'other')
+
+    def test_release(self):
+        self.claim('leader')
+        # Only the leader's release drops the lease
+        self.single_flight.release(self.url, 'second')
+        self.assertEqual(self.claim('second'), 'leader')
+        self.single_flight.release(self.url, 'leader')
+        self.assertFalse(self.redis.exists(self.key))
+        self.assertEqual(self.claim('third'), 'third')
+
+    def test_refresh_renews_only_own_lease(self):
+        self.claim('leader')
+        self.redis.expire(self.key, 5)
+        self.single_flight.refresh(self.url, 'second')
+        self.assertLessEqual(self.redis.ttl(self.key), 5)
+        self.single_flight.refresh(self.url, 'leader')
+        self.assertGreater(self.redis.ttl(self.key), 5)
+
+    def test_takeover_after_lease_expiry(self):
+        self.claim('leader')
+        self.statuses['leader'] = 'running'
+        # The leader's worker died: its record still says running but the lease lapses
+        self.redis.pexpire(self.key, 1)
+        time.sleep(0.01)
+        self.assertEqual(self.claim('second'), 'second')
+        self.assertEqual(self.claim('third'), 'second')
+        # The old leader can no longer renew or release the new lease
+        self.single_flight.release(self.url, 'leader')
+        self.assertEqual(self.redis.get(self.key), b'second')
+
+    def test_takeover_from_finished_or_missing_leader(self):
+        self.claim('leader')
+        self.statuses['leader'] = 'done'
+        self.assertEqual(self.claim('second'), 'second')
+        del self.statuses['second']
+        self.assertEqual(self.claim('third'), 'third')
+
+
+class ScanRecordStorageTests(SimpleTestCase):
+    """Hash-stored scan records read back in the JSON shape the frontend has always seen"""
+
+    def setUp(self):
+        self.redis = fakeredis.FakeRedis()
+        patcher = mock.patch.object(convex_client, 'get_redis', return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.records = convex_client.ConvexClient()
+
+    def test_get_scan_keeps_record_shape(self):
+        result = {'tls': {'valid': True, 'days_left': 40}, 'headers': {'missing': ['CSP']}, 'score': 72}
+        self.records.create_scan('job', 'https://example.com/')
+        self.records.update_scan('job', status='running', progress=40, sections={'tls': result['tls']})
+        self.records.update_scan('job', status='done', progress=100, result=result)
+
+        scan = self.records.get_scan('job')
+        created_at = scan['createdAt']
+        self.assertIsInstance(created_at, int)
+        # The record as the single JSON string layout stored it
+        baseline = {
+            'job_id': 'job', 'url': 'https://example.com/', 'status': 'done',
+            'progress': 100, 'result': result, 'createdAt': created_at,
+        }
+        self.assertEqual(json.dumps(scan, sort_keys=True), json.dumps(baseline, sort_keys=True))
+        self.assertEqual(list(scan), list(baseline))
+        self.assertGreater(self.redis.ttl('scan:job'), 0)
+
+    def test_sections_merge_and_result_replaces(self):
+        self.records.create_scan('job', 'https://example.com/')
+        self.records.update_scan('job', sections={'tls': {'valid': True}})
+        self.records.update_scan('job', sections={'dns': {'records': {}}})
+        self.assertEqual(set(self.records.get_scan('job')['result']), {'tls', 'dns'})
+        self.records.update_scan('job', result={'error': 'timeout'})
+        self.assertEqual(self.records.get_scan('job')['result'], {'error': 'timeout'})
+
+    def test_legacy_json_record_upgraded(self):
+        legacy = {
+            'job_id': 'old', 'url': 'https://example.com/', 'status': 'running',
+            'progress': 50, 'result': {'tls': {'valid': False}}, 'createdAt': 1700000000000,
+        }
+        self.redis.set('scan:old', json.dumps(legacy))
+        self.assertEqual(self.records.get_scan_versioned('old'), (legacy, 0))
+
+        self.records.update_scan('old', progress=60, sections={'dns': {'records': {}}})
+        self.assertEqual(self.redis.type('scan:old'), b'hash')
+        scan, version = self.records.get_scan_versioned('old')
+        self.assertEqual(scan, {**legacy, 'progress': 60, 'result': {**legacy['result'], 'dns': {'records': {}}}})
+        self.assertEqual(version, 1)
+
+    def test_update_bumps_version_and_publishes(self):
+        pubsub = self.redis.pubsub()
+        pubsub.subscribe('scan_events:job')
+        pubsub.get_message(timeout=1)
+        self.records.create_scan('job', 'https://example.com/')
+        self.assertEqual(self.records.get_scan_version('job'), 1)
+
+        self.records.update_scan('job', status='running', progress=10)
+        self.records.update_scan('job', sections={'tls': {'valid': True}})
+        self.assertEqual(self.records.get_scan_version('job'), 3)
+
+        messages = [json.loads(pubsub.get_message(timeout=1)['data']) for _ in range(2)]
+        self.assertEqual(messages, [
+            {'version': 2, 'update': {'status': 'running', 'progress': 10}},
+            {'version': 3, 'update': {'sections': {'tls': {'valid': True}}}},
+        ])
+        # A missing record is neither created nor announced
+        self.records.update_scan('missing', status='running')
+        self.assertFalse(self.redis.exists('scan:missing'))
+        self.assertIsNone(pubsub.get_message(timeout=0.1))
+
+
+class CodecTests(SimpleTestCase):
+    """Every record format round-trips, and JSON written before the codec stays readable"""
+
+    value = {'tls': {'valid': True, 'issuer': 'Example CA', 'sans': ['example.com'] * 20}, 'score': 87, 'error': None}
+
+    def test_round_trip(self):
+        for name in ('json', 'msgpack', 'zstd'):
+            with self.subTest(codec=name), override_settings(SCAN_RECORD_CODEC=name, SCAN_RECORD_COMPRESS_MIN=64):
+                encoded = codec.encode(self.value)
+                self.assertEqual(codec.format_of(encoded), name)
+                self.assertEqual(codec.decode(encoded), self.value)
+
+    def test_short_values_not_compressed(self):
+        with override_settings(SCAN_RECORD_CODEC='zstd', SCAN_RECORD_COMPRESS_MIN=64):
+            encoded = codec.encode({'score': 87})
+        self.assertEqual(encoded, '{"score": 87}')
+
+    def test_legacy_json_decodes_under_any_codec(self):
+        legacy = json.dumps(self.value)
+        for name in ('json', 'msgpack', 'zstd'):
+            with self.subTest(codec=name), override_settings(SCAN_RECORD_CODEC=name):
+                self.assertEqual(codec.decode(legacy), self.value)
+                self.assertEqual(codec.decode(legacy.encode()), self.value)
+
+    @override_settings(SCAN_RECORD_CODEC='msgpack')
+    def test_missing_library_writes_json(self):
+        with mock.patch.object(codec, 'msgpack', None), mock.patch('builtins.print'):
+            self.assertEqual(codec.current_format(), 'json')
+            self.assertEqual(codec.decode(codec.encode(self.value)), self.value)
+
+
+@override_settings(SCAN_RECORD_TTL=7 * 86400, SCAN_ERROR_RECORD_TTL=86400)
+class MigrateScanRecordsTests(SimpleTestCase):
+    """migrate_scan_records re-encodes fields, upgrades legacy records and backfills TTLs"""
+
+    result = {'tls': {'valid': True, 'sans': ['example.com'] * 20}, 'headers': {'missing': ['CSP'] * 20}}
+
+    def setUp(self):
+        self.redis = fakeredis.FakeRedis()
+        patcher = mock.patch.object(convex_client, 'get_redis', return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.records = convex_client.ConvexClient()
+        created_at = int((time.time() - 86400) * 1000)
+
+        # Written as JSON by an earlier release: a finished hash without a TTL,
+        # a running hash, and a finished legacy JSON string record
+        with override_settings(SCAN_RECORD_CODEC='json'):
+            for job_id, status in (('done', 'done'), ('running', 'running')):
+                self.records.create_scan(job_id, 'https://example.com/', status=status, result=self.result)
+                self.redis.hset(f'scan:{job_id}', 'createdAt', created_at)
+                self.redis.persist(f'scan:{job_id}')
+        self.legacy = {
+            'job_id': 'legacy', 'url': 'https://example.com/', 'status': 'done',
+            'progress': 100, 'result': self.result, 'createdAt': created_at,
+        }
+        self.redis.set('scan:legacy', json.dumps(self.legacy))
+
+    def migrate(self, **options):
+        out = io.StringIO()
+        with override_settings(SCAN_RECORD_CODEC='zstd', SCAN_RECORD_COMPRESS_MIN=64):
+            call_command('migrate_scan_records', stdout=out, **options)
+        return out.getvalue()
+
+    def test_migrate_with_ttl(self):
+        output = self.migrate(apply_ttl=True)
+        self.assertIn('4 fields re-encoded, 1 legacy records upgraded, 2 TTLs set', output)
+
+        for field in (b'result.tls', b'result.headers'):
+            self.assertEqual(codec.format_of(self.redis.hget('scan:done', field)), 'zstd')
+        self.assertEqual(self.records.get_scan('done')['result'], self.result)
+
+        self.assertEqual(self.redis.type('scan:legacy'), b'hash')
+        self.assertEqual(codec.format_of(self.redis.hget('scan:legacy', 'result.tls')), 'zstd')
+        self.assertEqual(self.records.get_scan('legacy'), self.legacy)
+
+        # Finished records expire a week after creation, a day of which has passed
+        for key in ('scan:done', 'scan:legacy'):
+            self.assertAlmostEqual(self.redis.ttl(key), 6 * 86400, delta=60)
+        self.assertEqual(self.redis.ttl('scan:running'), -1)
+
+    def test_dry_run_changes_nothing(self):
+        before = {key: self.redis.dump(key) for key in self.redis.keys('scan:*')}
+        output = self.migrate(dry_run=True, apply_ttl=True)
+        self.assertIn('Would migrate 3 records', output)
+        self.assertEqual({key: self.redis.dump(key) for key in self.redis.keys('scan:*')}, before)
+        self.assertEqual(self.redis.ttl('scan:done'), -1)
+
+    def test_field_rewritten_during_migration_kept(self):
+        reencode = self.redis.register_script(REENCODE_SCRIPT)
+        self.redis.hset('scan:running', 'result.tls', '{"valid": false}')
+        changed = reencode(keys=['scan:running'], args=['result.tls', json.dumps(self.result['tls']), b'stale'])
+        self.assertEqual(changed, 0)
+        self.assertEqual(self.redis.hget('scan:running', 'result.tls'), b'{"valid": false}')
+
+
+@override_settings(SCAN_MAX_RETRIES=2, SCAN_RETRY_BACKOFF=0, SCAN_HOST_SPACING_MS=0)
+class AsyncEngineTests(SimpleTestCase):
+    """The asyncio engine scans stub targets like scan_website_task does"""
+
+    def setUp(self):
+        self.redis = fakeredis.FakeRedis()
+        patcher = mock.patch.object(convex_client, 'get_redis', return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.records = convex_client.ConvexClient()
+        self.farm = MockFarm()
+        self.farm.__enter__()
+        self.addCleanup(self.farm.__exit__, None, None, None)
+
+    def run_scans(self, urls, **options):
+        jobs = [[f'job-{index}', url] for index, url in enumerate(urls)]
+        for job_id, url in jobs:
+            self.records.create_scan(job_id, url)
+        return asyncio.run(async_engine.run_scans(jobs, concurrency=2, **options))
+
+    def test_scans_complete(self):
+        fingerprint_threads = []
+        analyze_fingerprinting = async_engine.analyze_fingerprinting
+
+        def fingerprinting(url, page):
+            fingerprint_threads.append(threading.current_thread().name)
+            return analyze_fingerprinting(url, page)
+
+        urls = [self.farm.url(0, 'secure'), self.farm.url(1, 'wordpress')]
+        with mock.patch.object(async_engine, 'analyze_fingerprinting', side_effect=fingerprinting):
+            summaries = self.run_scans(urls)
+
+        self.assertEqual([summary['status'] for summary in summaries], ['completed', 'completed'])
+        secure, wordpress = (self.records.get_scan(summary['job_id']) for summary in summaries)
+        self.assertEqual(secure['status'], 'done')
+        self.assertEqual(secure['progress'], 100)
+        self.assertTrue(secure['result']['tls']['valid'])
+        self.assertIn('HSTS', secure['result']['headers']['security_headers'])
+        self.assertEqual(secure['result']['score'], summaries[0]['score'])
+        self.assertIn('WordPress', [detection['name'] for detection in wordpress['result']['fingerprinting']['detections']])
+        # Signature matching ran off the event loop
+        self.assertTrue(fingerprint_threads)
+        self.assertTrue(all(name.startswith('scan-cpu') for name in fingerprint_threads))
+
+    def test_transient_phase_failure_retried(self):
+        analyze_dns_async = async_engine.analyze_dns_async
+        calls = []
+
+        async def flaky_dns(domain):
+            calls.append(domain)
+            if len(calls) == 1:
+                return {'error': 'timed out', 'error_kind': TRANSIENT}
+            return await analyze_dns_async(domain)
+
+        analyze_tls_async = mock.AsyncMock(side_effect=async_engine.analyze_tls_async)
+        with mock.patch.object(async_engine, 'analyze_dns_async', side_effect=flaky_dns), \
+                mock.patch.object(async_engine, 'analyze_tls_async', analyze_tls_async):
+            summaries = self.run_scans([self.farm.url(0)])
+
+        self.assertEqual(summaries[0]['status'], 'completed')
+        self.assertEqual(len(calls), 2)
+        # The retry only reran the failed phase
+        self.assertEqual(analyze_tls_async.call_count, 1)
+        scan = self.records.get_scan('job-0')
+        self.assertNotIn('error', scan['result']['dns'])
+        self.assertTrue(scan['result']['dns']['a_records'])
+
+    def test_deep_and_incremental_rejected(self):
+        for option in ('deep', 'incremental'):
+            with self.subTest(option=option), self.assertRaises(ValueError):
+                asyncio.run(async_engine.run_scans([['job', self.farm.url(0)]], **{option: True}))
+
+
+@override_settings(RESCAN_MAX_REUSE_AGE=3600)
+class RescanBaselineTests(SimpleTestCase):
+    """Each incremental scan leaves a baseline covering every section it can vouch for"""
+
+    def baseline(self):
+        computed_at = time.time() - 60
+        return {'job_id': 'previous', 'sections': {
+            name: {'result': {'section': name}, 'check': f'{name}-check', 'computed_at': computed_at}
+            for name in ('headers', 'dns', 'fingerprinting', 'tls_deep')
+        }}
+
+    def test_sections_checkpointed_before_retry_carried_over(self):
+        baseline = self.baseline()
+        rescan = Rescan(baseline)
+        # An earlier attempt finished headers and fingerprinting; this one runs the rest
+        result = {name: {'section': name, 'fresh': True} for name in ('tls', 'headers', 'dns', 'fingerprinting')}
+        phases = rescan.wrap({'tls': (lambda: result['tls'], ()), 'dns': (lambda domain: result['dns'], ('example.com',))}, result)
+        with mock.patch('app.rescan.dns_fingerprint', return_value='dns-changed'):
+            for function, args in phases.values():
+                function(*args)
+
+        sections = rescan.next_baseline('job', result)['sections']
+        self.assertEqual(sections['dns']['check'], 'dns-changed')
+        self.assertEqual(sections['dns']['result'], result['dns'])
+        for name in ('headers', 'fingerprinting', 'tls_deep'):
+            self.assertEqual(sections[name], baseline['sections'][name])
+
+    def test_failed_section_dropped(self):
+        rescan = Rescan(self.baseline())
+        result = {'dns': {'error': 'timed out'}}
+        phases = rescan.wrap({'dns': (lambda domain: result['dns'], ('example.com',))}, result)
+        with mock.patch('app.rescan.dns_fingerprint', return_value='dns-changed'):
+            phases['dns'][0]('example.com')
+        self.assertNotIn('dns', rescan.next_baseline('job', result)['sections'])
+
+
+class PhaseOutcomeTests(SimpleTestCase):
+    """Phase outcome labels follow the error classification, not the message"""
+
+    def test_outcome_labels(self):
+        self.assertEqual(metrics.outcome({'valid': True}), 'ok')
+        self.assertEqual(metrics.outcome({'error': None}), 'ok')
+        self.assertEqual(metrics.outcome(error_section(TimeoutError('read timed out'))), TRANSIENT)
+        self.assertEqual(metrics.outcome({'error': 'Scan deadline of 30s exceeded', 'error_kind': TRANSIENT}), TRANSIENT)
+        self.assertEqual(metrics.outcome(error_section(ConnectionRefusedError('refused'))), PERMANENT)
+        # A permanent error mentioning a timeout is still permanent
+        self.assertEqual(metrics.outcome({'error': 'certificate verify failed: timed out', 'error_kind': PERMANENT}), PERMANENT)
+        self.assertEqual(metrics.outcome({'error': 'unclassified'}), PERMANENT)
+
+
+class ScanEventHubTests(SimpleTestCase):
+    """One bad message or a dropped connection doesn't stop event delivery"""
+
+    def setUp(self):
+        server = fakeredis.FakeServer()
+        self.redis = fakeredis.FakeRedis(server=server)
+        patcher = mock.patch.object(scan_events, 'new_async_redis', side_effect=lambda: fakeredis.aioredis.FakeRedis(server=server))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def publish(self, job_id, data):
+        self.redis.publish(f'scan_events:{job_id}', data)
+
+    def test_malformed_messages_skipped(self):
+        async def scenario():
+            hub = scan_events.ScanEventHub()
+            first = await hub.subscribe('a')
+            second = await hub.subscribe('b')
+            for data in (b'{not json', b'\xff\xfe', b'[1, 2]', b'{"version": "x", "update": {}}'):
+                self.publish('a', data)
+            self.publish('a', json.dumps({'version': 2, 'update': {'progress': 20}}))
+            self.publish('b', json.dumps({'version': 3, 'update': {'progress': 30}}))
+            events = [await asyncio.wait_for(queue.get(), 5) for queue in (first, second)]
+            hub._reader.cancel()
+            return events
+
+        with mock.patch('builtins.print'):
+            events = asyncio.run(scenario())
+        self.assertEqual(events, [{'version': 2, 'update': {'progress': 20}}, {'version': 3, 'update': {'progress': 30}}])
+
+    def test_reader_restarts_after_connection_loss(self):
+        async def scenario():
+            hub = scan_events.ScanEventHub()
+            queue = await hub.subscribe('a')
+            with mock.patch.object(hub._pubsub, 'get_message', side_effect=redis.ConnectionError('lost')):
+                ended = await asyncio.wait_for(queue.get(), 5)
+            await hub.unsubscribe('a', queue)
+
+            # A reconnecting stream gets events again, over a new connection
+            queue = await hub.subscribe('a')
+            self.publish('a', json.dumps({'version': 4, 'update': {'status': 'done'}}))
+            event = await asyncio.wait_for(queue.get(), 5)
+            hub._reader.cancel()
+            return ended, event
+
+        with mock.patch('builtins.print'):
+            ended, event = asyncio.run(scenario())
+        self.assertIsNone(ended)
+        self.assertEqual(event, {'version': 4, 'update': {'status': 'done'}})
+
+
+@override_settings(SCAN_PHASE_WORKERS=2)
+class PhasePoolTests(SimpleTestCase):
+    """Phases beyond the pool size queue, unless the caller sizes the pool for them"""
+
+    def run_sleeping_phases(self, count, workers=None):
+        phases = {f'phase{index}': (time.sleep, (0.2,)) for index in range(count)}
+        started = time.monotonic()
+        results = list(tasks.run_phases(phases, 5, workers))
+        self.assertEqual(len(results), count)
+        return time.monotonic() - started
+
+    def test_phases_queue_beyond_pool(self):
+        self.assertGreater(self.run_sleeping_phases(3), 0.35)
+
+    def test_pool_sized_for_every_phase(self):
+        self.assertLess(self.run_sleeping_phases(5, workers=5), 0.35)
@@ -0,0 +1,152 @@
+"""
+Token-bucket rate limiting in Redis.
+
+Each check is one Lua script call that refills and debits the bucket
+atomically, so concurrent requests cannot race past the limit and the window
+never resets early. Rates use DRF's ``DEFAULT_THROTTLE_RATES`` format
+("5/min") keyed by scope: clients presenting a known ``X-API-Key`` are limited
+per key under ``<scope>_api_key``, everyone else per IP under ``<scope>``.
+The IP is REMOTE_ADDR, or with NUM_PROXIES set the X-Forwarded-For entry
+appended by the outermost trusted proxy; a client-supplied X-Forwarded-For
+never picks the bucket.
+"""
+import hashlib
+import math
+from django.conf import settings
+from rest_framework.exceptions import Throttled
+from rest_framework.settings import api_settings
+from rest_framework.throttling import BaseThrottle
+from rest_framework.views import exception_handler as drf_exception_handler
+from .redis_pool import get_redis
+
+# KEYS[1] = bucket; ARGV = capacity, refill rate (tokens/second), cost.
+# Returns {allowed, tokens left, seconds until a token is available,
+# seconds until the bucket is full}; floats are returned as strings.
+TOKEN_BUCKET_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+
+local allowed = 0
+local retry_after = 0
+if tokens >= cost then
+    tokens = tokens - cost
+    allowed = 1
+else
+    retry_after = (cost - tokens) / rate
+end
+
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+return {allowed, tostring(tokens), tostring(retry_after), tostring((capacity - tokens) / rate)}
+"""
+
+_token_bucket = None
+
+
+def _script():
+    global _token_bucket
+    if _token_bucket is None:
+        _token_bucket = get_redis().register_script(TOKEN_BUCKET_SCRIPT)
+    return _token_bucket
+
+
+def parse_rate(rate):
+    """``'5/min'`` -> ``(5, 60)``, as in DRF's SimpleRateThrottle"""
+    num, period = rate.split('/')
+    duration = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}[period[0]]
+    return int(num), duration
+
+
+def valid_api_key(request):
+    """The request's ``X-API-Key`` if it is one of API_KEYS, else None"""
+    api_key = request.META.get('HTTP_X_API_KEY')
+    return api_key if api_key and api_key in settings.API_KEYS else None
+
+
+class TokenBucketThrottle(BaseThrottle):
+    """
+    Base class; subclasses set ``scope``. Stores the outcome on the request
+    so ``RateLimitHeadersMiddleware`` can add ``RateLimit-*`` headers.
+    """
+    scope = None
+
+    def get_api_key(self, request):
+        return valid_api_key(request)
+
+    def get_bucket(self, request):
+        """``(redis key, rate)`` for the caller: per API key if it has one, else per IP"""
+        rates = api_settings.DEFAULT_THROTTLE_RATES
+        api_key = self.get_api_key(request)
+        if api_key:
+            digest = hashlib.sha256(api_key.encode()).hexdigest()[:16]
+            return f"throttle:{self.scope}:key:{digest}", rates[f'{self.scope}_api_key']
+        return f"throttle:{self.scope}:ip:{self.get_ident(request)}", rates[self.scope]
+
+    def allow_request(self, request, view):
+        # CORS preflight requests don't consume tokens
+        if request.method == 'OPTIONS':
+            return True
+
+        key, rate = self.get_bucket(request)
+        if rate is None:
+            return True
+        capacity, duration = parse_rate(rate)
+
+        try:
+            allowed, tokens, retry_after, reset = _script()(keys=[key], args=[capacity, capacity / duration, 1])
+        except Exception as e:
+            # If Redis is down, continue without rate limiting
+            print(f"Redis error: {e}")
+            return True
+
+        self.wait_seconds = float(retry_after)
+        request._request.rate_limit = {
+            'RateLimit-Limit': str(capacity),
+            'RateLimit-Remaining': str(int(float(tokens))),
+            'RateLimit-Reset': str(math.ceil(float(reset))),
+        }
+        return bool(allowed)
+
+    def wait(self):
+        return getattr(self, 'wait_seconds', None)
+
+
+class ScanRateThrottle(TokenBucketThrottle):
+    scope = 'scan'
+
+
+class BatchRateThrottle(TokenBucketThrottle):
+    scope = 'batch'
+
+
+class HistoryRateThrottle(TokenBucketThrottle):
+    scope = 'history'
+
+
+class RateLimitHeadersMiddleware:
+    """Copy the throttle outcome recorded on the request into response headers"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        for header, value in getattr(request, 'rate_limit', {}).items():
+            response[header] = value
+        return response
+
+
+def exception_handler(exc, context):
+    """DRF exception handler keeping the API's ``{'error': ...}`` shape for 429s"""
+    response = drf_exception_handler(exc, context)
+    if response is not None and isinstance(exc, Throttled):
+        response.data = {'error': f'Rate limit exceeded. Try again in {math.ceil(exc.wait or 0)} seconds.'}
+    return response
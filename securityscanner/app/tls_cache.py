@@ -0,0 +1,92 @@
+"""
+Process-wide TLS state shared across scans.
+
+Building a default SSL context reloads the system CA store, so every scan in a
+process uses one context. Scans of the same (host, port), which is common when
+many sites sit behind one CDN edge, also reuse the previous TLS session to skip
+a full handshake, and reuse the parsed certificate details as long as the
+server still presents a certificate with the same fingerprint.
+
+Both caches are bounded LRUs whose entries expire after TLS_CACHE_TTL seconds.
+"""
+import hashlib
+import threading
+import time
+import ssl
+from collections import OrderedDict
+from django.conf import settings
+
+_lock = threading.Lock()
+_context = None
+_sessions = OrderedDict()
+_certificates = OrderedDict()
+
+
+def get_ssl_context():
+    """Verifying client context shared by every TLS analysis in the process"""
+    global _context
+    with _lock:
+        if _context is None:
+            context = ssl.create_default_context()
+            context.check_hostname = True
+            context.verify_mode = ssl.CERT_REQUIRED
+            _context = context
+        return _context
+
+
+def _get(cache, key):
+    with _lock:
+        entry = cache.get(key)
+        if entry is None:
+            return None
+        value, expires = entry
+        if expires < time.monotonic():
+            del cache[key]
+            return None
+        cache.move_to_end(key)
+        return value
+
+
+def _put(cache, key, value):
+    with _lock:
+        cache[key] = (value, time.monotonic() + settings.TLS_CACHE_TTL)
+        cache.move_to_end(key)
+        while len(cache) > settings.TLS_CACHE_SIZE:
+            cache.popitem(last=False)
+
+
+def get_session(host, port):
+    """Resumable session from the last handshake with ``host:port``, if any"""
+    return _get(_sessions, (host, port))
+
+
+def store_session(host, port, session):
+    if session is not None:
+        _put(_sessions, (host, port), session)
+
+
+def _name_fields(name):
+    """``getpeercert`` names are tuples of RDNs, each a tuple of (key, value) pairs"""
+    return {key: value for rdn in name for key, value in rdn}
+
+
+def certificate_details(host, port, ssock):
+    """
+    Details of the certificate presented on ``ssock``, parsed once per
+    fingerprint and served from the cache while ``host:port`` keeps
+    presenting the same certificate.
+    """
+    fingerprint = hashlib.sha256(ssock.getpeercert(binary_form=True)).hexdigest()
+    cached = _get(_certificates, (host, port))
+    if cached is not None and cached['fingerprint_sha256'] == fingerprint:
+        return cached
+
+    cert = ssock.getpeercert()
+    details = {
+        'expiry_date': cert.get('notAfter'),
+        'issuer': _name_fields(cert.get('issuer', ())).get('organizationName', 'Unknown'),
+        'serial_number': cert.get('serialNumber'),
+        'fingerprint_sha256': fingerprint,
+    }
+    _put(_certificates, (host, port), details)
+    return details
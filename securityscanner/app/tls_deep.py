@@ -0,0 +1,225 @@
+"""
+Deep TLS capability scan.
+
+Enumerates the protocol versions (TLS 1.0-1.3) and the TLS 1.0-1.2 cipher
+suites a server accepts by offering each one on its own, and reports weak
+ones alongside the certificate key size, chain completeness and OCSP
+stapling. Probe handshakes don't verify the peer and run concurrently on a
+pool of TLS_DEEP_CONNECTIONS threads, so a deep scan costs a few round trips of
+wall time rather than one per probe.
+
+The chain and stapling checks use pyOpenSSL when it is installed, since the
+standard ``ssl`` module can neither request a stapled OCSP response nor
+return the presented chain. Without it, chain completeness is inferred from
+certificate verification and OCSP stapling is reported as ``None``.
+"""
+import select
+import socket
+import ssl
+import time
+from concurrent.futures import ThreadPoolExecutor
+from cryptography import x509
+from cryptography.hazmat.primitives.asymmetric import dsa, ec, rsa
+from django.conf import settings
+from . import tracing
+from .scan_errors import error_section
+from .tls_cache import get_ssl_context
+
+try:
+    from OpenSSL import SSL, crypto
+except ImportError:
+    SSL = crypto = None
+
+PROTOCOLS = (
+    ('TLSv1.0', ssl.TLSVersion.TLSv1),
+    ('TLSv1.1', ssl.TLSVersion.TLSv1_1),
+    ('TLSv1.2', ssl.TLSVersion.TLSv1_2),
+    ('TLSv1.3', ssl.TLSVersion.TLSv1_3),
+)
+
+LEGACY_PROTOCOLS = ('TLSv1.0', 'TLSv1.1')
+
+# Everything OpenSSL can offer, minus suites that need a pre-shared key or SRP
+# password and so can never be negotiated by a probe
+ALL_CIPHERS = 'ALL:COMPLEMENTOFALL:!PSK:!SRP:@SECLEVEL=0'
+
+# OpenSSL's X509_V_ERR_UNABLE_TO_GET_ISSUER_CERT_LOCALLY: an intermediate is missing
+MISSING_ISSUER = 20
+
+# Smallest public keys not reported as weak, in bits
+MIN_KEY_SIZES = {'RSA': 2048, 'DSA': 2048, 'EC': 256}
+
+
+def _probe_context(version, ciphers=ALL_CIPHERS):
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    context.minimum_version = version
+    context.maximum_version = version
+    # OpenSSL 3's default security level refuses to offer NULL, RC4, 3DES and
+    # export suites, which are exactly the ones the probes look for
+    if '@SECLEVEL' not in ciphers:
+        ciphers = f'{ciphers}:@SECLEVEL=0'
+    context.set_ciphers(ciphers)
+    return context
+
+
+def cipher_suites(protocol):
+    """OpenSSL cipher descriptions that can be offered for a TLS 1.0-1.2 ``protocol``"""
+    ciphers = _probe_context(ssl.TLSVersion.TLSv1_2).get_ciphers()
+    if protocol == 'TLSv1.2':
+        return [cipher for cipher in ciphers if cipher['protocol'] != 'TLSv1.3']
+    return [cipher for cipher in ciphers if cipher['protocol'] not in ('TLSv1.2', 'TLSv1.3')]
+
+
+def is_weak_cipher(cipher):
+    """Under 128-bit strength (export, DES, 3DES), RC4, MD5 MACs or unauthenticated key exchange"""
+    return (
+        cipher['strength_bits'] < 128
+        or cipher['symmetric'] == 'rc4'
+        or cipher['digest'] == 'md5'
+        or cipher['auth'] == 'auth-null'
+    )
+
+
+def _handshake(host, port, version, ciphers=ALL_CIPHERS):
+    """Negotiated ``(protocol, cipher, leaf DER)``, or None if the server refused the offer"""
+    with tracing.span('tls.probe', {'tls.version': version.name, 'tls.ciphers': ciphers}):
+        try:
+            context = _probe_context(version, ciphers)
+            with socket.create_connection((host, port), timeout=settings.SCAN_TIMEOUT) as sock:
+                with context.wrap_socket(sock, server_hostname=host) as ssock:
+                    return ssock.version(), ssock.cipher()[0], ssock.getpeercert(binary_form=True)
+        except (ssl.SSLError, OSError, ValueError):
+            # ValueError: the local OpenSSL can't offer this protocol at all
+            return None
+
+
+def describe_key(cert_der):
+    """Type and size of the certificate's public key"""
+    public_key = x509.load_der_x509_certificate(cert_der).public_key()
+    for key_type, key_class in (('RSA', rsa.RSAPublicKey), ('EC', ec.EllipticCurvePublicKey), ('DSA', dsa.DSAPublicKey)):
+        if isinstance(public_key, key_class):
+            return key_type, public_key.key_size
+    return type(public_key).__name__, None
+
+
+@tracing.traced('tls.chain')
+def _chain_openssl(host, port):
+    """Presented chain length, whether it verifies without fetching intermediates, and OCSP stapling"""
+    stapled = {'ocsp': False}
+
+    def ocsp_callback(connection, ocsp_data, data):
+        stapled['ocsp'] = bool(ocsp_data)
+        return True
+
+    context = SSL.Context(SSL.TLS_CLIENT_METHOD)
+    context.set_default_verify_paths()
+    context.set_ocsp_client_callback(ocsp_callback)
+
+    deadline = time.monotonic() + settings.SCAN_TIMEOUT
+    with socket.create_connection((host, port), timeout=settings.SCAN_TIMEOUT) as sock:
+        sock.setblocking(False)
+        connection = SSL.Connection(context, sock)
+        connection.set_tlsext_host_name(host.encode())
+        connection.request_ocsp()
+        connection.set_connect_state()
+        while True:
+            try:
+                connection.do_handshake()
+                break
+            except (SSL.WantReadError, SSL.WantWriteError):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError('TLS handshake timed out')
+                select.select([sock], [], [], remaining)
+        chain = connection.get_peer_cert_chain() or []
+
+    if not chain:
+        return {'chain_length': 0, 'chain_complete': False, 'ocsp_stapled': stapled['ocsp']}
+    try:
+        crypto.X509StoreContext(context.get_cert_store(), chain[0], chain[1:]).verify_certificate()
+        complete = True
+    except crypto.X509StoreContextError:
+        complete = False
+
+    return {'chain_length': len(chain), 'chain_complete': complete, 'ocsp_stapled': stapled['ocsp']}
+
+
+@tracing.traced('tls.chain')
+def _chain_ssl(host, port):
+    """Chain completeness from a verifying handshake; stapling can't be observed with ``ssl``"""
+    try:
+        with socket.create_connection((host, port), timeout=settings.SCAN_TIMEOUT) as sock:
+            with get_ssl_context().wrap_socket(sock, server_hostname=host):
+                complete = True
+    except ssl.SSLCertVerificationError as e:
+        complete = False if e.verify_code == MISSING_ISSUER else None
+    return {'chain_length': None, 'chain_complete': complete, 'ocsp_stapled': None}
+
+
+def analyze_tls_deep(domain, port=443):
+    """Enumerate supported protocols and cipher suites and inspect the certificate chain"""
+    result = {
+        'protocols': {},
+        'ciphers': {},
+        'weak_protocols': [],
+        'weak_ciphers': [],
+        'key_type': None,
+        'key_size': None,
+        'weak_key': False,
+        'chain_length': None,
+        'chain_complete': None,
+        'ocsp_stapled': None,
+        'probes': 0,
+        'probe_ms': None
+    }
+
+    started = time.monotonic()
+    executor = ThreadPoolExecutor(max_workers=settings.TLS_DEEP_CONNECTIONS, thread_name_prefix='scan-tls-deep')
+    handshake = tracing.bind_context(_handshake)
+    try:
+        chain = executor.submit(tracing.bind_context(_chain_openssl if SSL is not None else _chain_ssl), domain, port)
+        protocol_probes = {name: executor.submit(handshake, domain, port, version) for name, version in PROTOCOLS}
+
+        leaf = None
+        cipher_probes = {}
+        for name, version in PROTOCOLS:
+            negotiated = protocol_probes[name].result()
+            result['protocols'][name] = negotiated is not None
+            if negotiated is None:
+                continue
+            leaf = leaf or negotiated[2]
+            if name == 'TLSv1.3':
+                # ssl can't restrict TLS 1.3 suites; report the negotiated one
+                result['ciphers'][name] = [negotiated[1]]
+                continue
+            for cipher in cipher_suites(name):
+                cipher_probes[name, cipher['name']] = (cipher, executor.submit(handshake, domain, port, version, cipher['name']))
+
+        weak = set()
+        for (name, cipher_name), (cipher, probe) in cipher_probes.items():
+            if probe.result() is not None:
+                result['ciphers'].setdefault(name, []).append(cipher_name)
+                if is_weak_cipher(cipher):
+                    weak.add(cipher_name)
+
+        result['weak_protocols'] = [name for name in LEGACY_PROTOCOLS if result['protocols'].get(name)]
+        result['weak_ciphers'] = sorted(weak)
+        result['probes'] = len(PROTOCOLS) + len(cipher_probes)
+
+        if leaf:
+            result['key_type'], result['key_size'] = describe_key(leaf)
+            minimum = MIN_KEY_SIZES.get(result['key_type'])
+            result['weak_key'] = bool(minimum and result['key_size'] and result['key_size'] < minimum)
+
+        result.update(chain.result())
+
+    except Exception as e:
+        result.update(error_section(e))
+
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    result['probe_ms'] = round((time.monotonic() - started) * 1000, 2)
+    return result
@@ -0,0 +1,185 @@
+"""
+OpenTelemetry tracing for scans.
+
+One scan is one trace. It holds:
+
+- the request span of ``scan_view``, continuing a ``traceparent`` the client sent;
+- the Celery task that runs the scan;
+- a span per analyzer phase and one for scoring;
+- spans for the page fetch, DNS lookups, deep TLS probes and every
+  ConvexClient call.
+
+The trace context travels to the worker in the task message headers, so
+retries and host deferrals, which re-publish the task, stay in the same
+trace. Work submitted to thread pools goes through ``bind_context`` to keep
+its parent.
+
+TRACING_EXPORTER selects where finished spans go:
+
+- ``otlp``: OTLP/HTTP to ``OTEL_EXPORTER_OTLP_ENDPOINT`` (a local collector
+  on port 4318 by default);
+- ``file``: one JSON span per line appended to TRACING_FILE;
+- ``console``: stdout.
+
+When it is unset, no tracer provider is installed and the spans below are
+no-ops.
+"""
+import functools
+import threading
+from celery.signals import before_task_publish, task_failure, task_postrun, task_prerun, worker_process_shutdown
+from django.conf import settings
+from opentelemetry import context, propagate, trace
+from opentelemetry.trace import SpanKind, Status, StatusCode
+from .metrics import outcome
+
+tracer = trace.get_tracer('securityscanner')
+
+_lock = threading.Lock()
+_provider = None
+_task_spans = {}
+
+
+def configure():
+    """Install the tracer provider for TRACING_EXPORTER; called once per process at startup"""
+    global _provider
+    with _lock:
+        if _provider is not None or not settings.TRACING_EXPORTER:
+            return
+
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter
+        from opentelemetry.sdk.trace.sampling import ParentBased, TraceIdRatioBased
+
+        if settings.TRACING_EXPORTER == 'otlp':
+            from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+            exporter = OTLPSpanExporter()
+        elif settings.TRACING_EXPORTER == 'file':
+            exporter = ConsoleSpanExporter(
+                out=open(settings.TRACING_FILE, 'a', encoding='utf-8'),
+                formatter=lambda span: span.to_json(indent=None) + '\n',
+            )
+        elif settings.TRACING_EXPORTER == 'console':
+            exporter = ConsoleSpanExporter()
+        else:
+            print(f"Tracing error: unknown TRACING_EXPORTER {settings.TRACING_EXPORTER!r}")
+            return
+
+        # Requests and tasks that arrive with a sampled parent stay sampled
+        provider = TracerProvider(
+            resource=Resource.create({'service.name': settings.TRACING_SERVICE_NAME}),
+            sampler=ParentBased(TraceIdRatioBased(settings.TRACING_SAMPLE_RATIO)),
+        )
+        provider.add_span_processor(BatchSpanProcessor(exporter))
+        trace.set_tracer_provider(provider)
+        _provider = provider
+
+
+def span(name, attributes=None, kind=SpanKind.INTERNAL):
+    """Context manager for a child span of the current one; exceptions are recorded on it"""
+    return tracer.start_as_current_span(name, kind=kind, attributes=attributes)
+
+
+def traced(name=None):
+    """Decorator running the function in a span named ``name`` (its qualified name by default)"""
+    def decorator(func):
+        span_name = name or func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(span_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def bind_context(func):
+    """``func`` bound to the caller's trace context, for running on another thread"""
+    parent = context.get_current()
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        token = context.attach(parent)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            context.detach(token)
+    return wrapper
+
+
+def annotate(attributes):
+    """Set attributes on the current span"""
+    trace.get_current_span().set_attributes({key: value for key, value in attributes.items() if value is not None})
+
+
+def mark_error(description):
+    """Mark the current span as failed"""
+    trace.get_current_span().set_status(Status(StatusCode.ERROR, str(description)))
+
+
+def record_outcome(result):
+    """Label the current span with a phase result's outcome, failed unless it's ``ok``"""
+    result_outcome = outcome(result)
+    annotate({'scan.outcome': result_outcome})
+    if result_outcome != 'ok':
+        mark_error(result.get('error'))
+
+
+def server_span(name):
+    """View decorator tracing each request as a server span"""
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(request, *args, **kwargs):
+            parent = propagate.extract(request.headers)
+            attributes = {'http.method': request.method, 'http.target': request.path}
+            with tracer.start_as_current_span(name, context=parent, kind=SpanKind.SERVER, attributes=attributes) as current:
+                response = view(request, *args, **kwargs)
+                current.set_attribute('http.status_code', response.status_code)
+                if response.status_code >= 500:
+                    current.set_status(Status(StatusCode.ERROR))
+                return response
+        return wrapper
+    return decorator
+
+
+@before_task_publish.connect
+def inject_trace_context(headers=None, **kwargs):
+    if headers is not None:
+        propagate.inject(headers)
+
+
+@task_prerun.connect
+def start_task_span(task_id=None, task=None, **kwargs):
+    # Published tasks carry their parent in the headers; eager ones run inside it
+    parent = propagate.extract(task.request, context=context.get_current())
+    task_span = tracer.start_span(
+        task.name,
+        context=parent,
+        kind=SpanKind.CONSUMER,
+        attributes={'celery.task_id': task_id, 'celery.retries': task.request.retries or 0},
+    )
+    _task_spans[task_id] = (task_span, context.attach(trace.set_span_in_context(task_span, parent)))
+
+
+@task_failure.connect
+def record_task_failure(task_id=None, exception=None, **kwargs):
+    entry = _task_spans.get(task_id)
+    if entry is not None and exception is not None:
+        entry[0].record_exception(exception)
+        entry[0].set_status(Status(StatusCode.ERROR, str(exception)))
+
+
+@task_postrun.connect
+def end_task_span(task_id=None, state=None, **kwargs):
+    entry = _task_spans.pop(task_id, None)
+    if entry is not None:
+        task_span, token = entry
+        task_span.set_attribute('celery.state', state or 'UNKNOWN')
+        task_span.end()
+        context.detach(token)
+
+
+@worker_process_shutdown.connect
+def flush_spans(**kwargs):
+    if _provider is not None:
+        _provider.force_flush()
@@ -4,6 +4,13 @@ from . import views
 urlpatterns = [
     path('scan/', views.scan_view, name='scan'),
     path('status/<str:job_id>/', views.status_view, name='status'),
+    path('status/<str:job_id>/stream/', views.status_stream_view, name='status_stream'),
+    path('batch/', views.batch_scan_view, name='batch_scan'),
+    path('batch/<str:batch_id>/', views.batch_status_view, name='batch_status'),
+    path('batch/<str:batch_id>/results/', views.batch_results_view, name='batch_results'),
+    path('history/', views.scan_history_view, name='scan_history'),
+    path('history/trend/', views.scan_trend_view, name='scan_trend'),
+    path('history/<str:job_id>/', views.scan_history_detail_view, name='scan_history_detail'),
     path('cors-test/', views.cors_test, name='cors_test'),
     path('health/', views.health_check, name='health'),
 ]
@@ -1,5 +1,6 @@
 import os
 from celery import Celery
+from celery.signals import worker_init, worker_process_init
 from django.conf import settings
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'securityscanner.settings')
@@ -8,6 +9,17 @@ app = Celery('securityscanner')
 app.config_from_object('django.conf:settings', namespace='CELERY')
 app.autodiscover_tasks()
 
+@worker_process_init.connect
+def compile_fingerprints(**kwargs):
+    # Compile the signature index before the first scan instead of during it
+    from app.fingerprints import get_index
+    get_index()
+
 @app.task(bind=True)
 def debug_task(self):
     print(f'Request: {self.request!r}')
+
+@worker_init.connect
+def start_metrics_exporter(**kwargs):
+    from app.metrics import start_worker_exporter
+    start_worker_exporter()
@@ -5,15 +5,26 @@ set -e
 
 echo "🚀 Starting both Gunicorn and Celery..."
 
-# Start Celery worker in background
-echo "🔄 Starting Celery worker..."
-cd securityscanner && celery -A securityscanner worker --loglevel=info --concurrency=2 &
-CELERY_PID=$!
+cd securityscanner
+
+# Gunicorn and Celery processes share metrics through this directory; stale
+# files from a previous run would be aggregated too
+export PROMETHEUS_MULTIPROC_DIR=${PROMETHEUS_MULTIPROC_DIR:-/tmp/prometheus}
+mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+rm -rf "${PROMETHEUS_MULTIPROC_DIR:?}"/*
+
+# Start Celery workers in background: interactive scans get their own
+# consumers so bulk and rescan work never queues in front of them
+echo "🔄 Starting Celery workers..."
+celery -A securityscanner worker --loglevel=info --concurrency=2 -Q interactive -n interactive@%h &
+CELERY_INTERACTIVE_PID=$!
+celery -A securityscanner worker --loglevel=info --concurrency=2 -Q bulk,rescan -n bulk@%h &
+CELERY_BULK_PID=$!
 
 # Function to cleanup on exit
 cleanup() {
     echo "🛑 Shutting down..."
-    kill $CELERY_PID 2>/dev/null || true
+    kill $CELERY_INTERACTIVE_PID $CELERY_BULK_PID 2>/dev/null || true
     exit 0
 }
 
@@ -22,7 +33,8 @@ trap cleanup SIGTERM SIGINT
 
 # Start Gunicorn in foreground
 echo "🌐 Starting Gunicorn server on port ${PORT:-8000}..."
-cd securityscanner && exec gunicorn securityscanner.wsgi:application \
+exec gunicorn securityscanner.asgi:application \
+    --worker-class uvicorn.workers.UvicornWorker \
     --bind 0.0.0.0:${PORT:-8000} \
     --workers 3 \
     --timeout 120 \